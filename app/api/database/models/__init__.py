@@ -1,3 +1,5 @@
 """Model import"""
-from app.api.database.models.interrogate import InterrogateRequest, InterrogateResponse
+from app.api.database.models.interrogate import InterrogateRequest, InterrogateResponse, InterrogateBatchRequest, InterrogateBatchResponse
 from app.api.database.models.img2img import StableDiffusionImg2ImgProcessingAPI, ImageToImageResponse
+from app.api.database.models.jobs import JobResponse, JobQueueResponse
+from app.api.database.models.system import ResidentModelResponse, ModelResidencyResponse, ProfilingRequest, ProfilingResponse
@@ -19,6 +19,9 @@ StableDiffusionImg2ImgProcessingAPI = PydanticModelGenerator(
         {"key": "send_images", "type": bool, "default": True},
         {"key": "save_images", "type": bool, "default": False},
         {"key": "alwayson_scripts", "type": dict, "default": {}},
+        {"key": "id_task", "type": str, "default": None},
+        {"key": "priority", "type": int, "default": 0},
+        {"key": "profile", "type": bool, "default": False},
     ]
 ).generate_model()
 
@@ -32,3 +35,5 @@ class ImageToImageResponse(BaseModel):
                               description="The generated image in base64 format.")
     parameters: dict
     info: str
+    id_task: str = Field(default=None, title="Task ID",
+                         description="id of the job that produced the images.")
@@ -1,3 +1,5 @@
+from typing import List
+
 from pydantic import BaseModel, Field
 
 
@@ -6,8 +8,24 @@ class InterrogateRequest(BaseModel):
                        description="Image to work on, must be a Base64 string containing the image's data.")
     model: str = Field(default="clip", title="Model",
                        description="The interrogate model used.")
+    priority: int = Field(default=0, title="Priority",
+                          description="Jobs with a higher priority are taken from the queue first.")
 
 
 class InterrogateResponse(BaseModel):
     caption: str = Field(default=None, title="Caption",
                          description="The generated caption for the image.")
+
+
+class InterrogateBatchRequest(BaseModel):
+    images: List[str] = Field(default=[], title="Images",
+                              description="Images to work on, each a Base64 string containing the image's data.")
+    model: str = Field(default="clip", title="Model",
+                       description="The interrogate model used.")
+    priority: int = Field(default=0, title="Priority",
+                          description="Jobs with a higher priority are taken from the queue first.")
+
+
+class InterrogateBatchResponse(BaseModel):
+    captions: List[str] = Field(default=[], title="Captions",
+                                description="The generated captions, in the order of the input images.")
@@ -0,0 +1,26 @@
+from typing import List
+
+from pydantic import BaseModel, Field
+
+
+class JobResponse(BaseModel):
+    id_task: str = Field(title="Task ID")
+    status: str = Field(title="Status",
+                        description="One of queued, running, succeeded, failed or cancelled.")
+    priority: int = Field(default=0, title="Priority")
+    queue_wait: float = Field(default=None, title="Queue wait",
+                              description="Seconds the job spent waiting for the GPU worker.")
+    compute_time: float = Field(default=None, title="Compute time",
+                                description="Seconds the job spent running on the GPU worker.")
+
+
+class JobQueueResponse(BaseModel):
+    busy: bool = Field(title="Whether the GPU worker has work")
+    depth: int = Field(title="Number of jobs waiting in queue")
+    max_size: int = Field(title="Maximum number of jobs allowed to wait in queue")
+    current: List[str] = Field(default=[], title="Task IDs of the running jobs",
+                               description="More than one when compatible jobs are batched together.")
+    queued: List[str] = Field(default=[], title="Task IDs of waiting jobs, by priority and submission order",
+                              description="Jobs for the checkpoint and VAE already loaded may run before older jobs of the same priority.")
+    model_switches_last_hour: int = Field(default=0, title="Model switches in the last hour",
+                                          description="Jobs that ran with a different checkpoint or VAE than the job before them on the same worker.")
@@ -0,0 +1,29 @@
+from typing import List
+
+from pydantic import BaseModel, Field
+
+
+class ResidentModelResponse(BaseModel):
+    name: str = Field(title="Name")
+    device: str = Field(title="Device the model runs on")
+    loaded: bool = Field(title="Whether the model is loaded at all")
+    resident: bool = Field(title="Whether the model is on its device right now")
+    size_mb: float = Field(title="Size in MB")
+    uses: int = Field(default=0, title="Number of times the model was required")
+    loads: int = Field(default=0, title="Number of times the model was moved to its device")
+    evictions: int = Field(default=0, title="Number of times the model was moved to RAM to make room")
+    moved_mb: float = Field(default=0, title="MB moved between RAM and device for this model")
+    last_used: float = Field(default=None, title="Unix time the model was last required")
+
+
+class ModelResidencyResponse(BaseModel):
+    models: List[ResidentModelResponse] = Field(default=[], title="Models tracked by the residency manager")
+
+
+class ProfilingRequest(BaseModel):
+    jobs: int = Field(default=1, ge=0, title="Number of upcoming jobs to run under torch.profiler")
+
+
+class ProfilingResponse(BaseModel):
+    pending: int = Field(default=0, title="Jobs still to be profiled")
+    traces: List[str] = Field(default=[], title="Chrome trace files kept in the profiling directory, oldest first")
@@ -0,0 +1,124 @@
+"""Output image encoding, off the event loop and optionally in a pool of worker processes"""
+import asyncio
+import io
+import multiprocessing
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import piexif
+import piexif.helper
+from PIL import PngImagePlugin
+
+pool = None
+pool_workers = None
+pool_lock = threading.Lock()
+
+
+def encoding_settings():
+    from app.ml.modules.shared import opts
+
+    return {
+        "format": opts.samples_format.lower(),
+        "quality": opts.jpeg_quality,
+        "compress_level": 1 if opts.api_lossless_fast else opts.api_png_compress_level,
+        "webp_method": 0 if opts.api_lossless_fast else opts.api_webp_method,
+        "lossless": opts.api_lossless_fast,
+    }
+
+
+def encode_image(image, format="png", quality=80, compress_level=6, webp_method=4, lossless=False):
+    """
+    Encodes image to bytes, keeping generation parameters as PNG text or EXIF user comment.
+    This runs in pool processes, so it must only depend on PIL and piexif.
+    """
+    with io.BytesIO() as output_bytes:
+        if format == 'png':
+            use_metadata = False
+            metadata = PngImagePlugin.PngInfo()
+            for key, value in image.info.items():
+                if isinstance(key, str) and isinstance(value, str):
+                    metadata.add_text(key, value)
+                    use_metadata = True
+            image.save(output_bytes, format="PNG", pnginfo=(
+                metadata if use_metadata else None), compress_level=compress_level)
+
+        elif format in ("jpg", "jpeg", "webp"):
+            parameters = image.info.get('parameters', None)
+            exif_bytes = piexif.dump({
+                "Exif": {piexif.ExifIFD.UserComment: piexif.helper.UserComment.dump(parameters, encoding="unicode")}
+            }) if parameters else b""
+
+            if format in ("jpg", "jpeg"):
+                if image.mode not in ("RGB", "L"):
+                    image = image.convert("RGB")
+                image.save(output_bytes, format="JPEG", exif=exif_bytes, quality=quality)
+            else:
+                image.save(output_bytes, format="WEBP", exif=exif_bytes, quality=quality,
+                           method=webp_method, lossless=lossless)
+
+        else:
+            raise ValueError(f"Invalid image format {format}")
+
+        return output_bytes.getvalue()
+
+
+def get_pool():
+    """
+    Returns the executor for encoding, recreated when api_image_encoding_workers changes: a process pool,
+    or threads of this process if the setting is 0. PNG compression holds the GIL for most of its
+    work, so only processes really take it off the server.
+    """
+    global pool, pool_workers
+
+    from app.ml.modules.shared import opts
+
+    workers = opts.api_image_encoding_workers
+
+    with pool_lock:
+        if pool is None or pool_workers != workers:
+            if pool is not None:
+                pool.shutdown(wait=False)
+
+            # spawned, not forked: the server has threads and CUDA, and forked children could inherit held locks.
+            # Spawned children import the server's main script again; app/main.py skips startup in them
+            pool = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn")) if workers > 0 else ThreadPoolExecutor(max_workers=2)
+            pool_workers = workers
+
+        return pool
+
+
+def submit(image):
+    """starts encoding image with the current settings and returns a concurrent.futures.Future for the bytes"""
+    from app.ml.modules import metrics
+
+    started = time.perf_counter()
+    future = get_pool().submit(encode_image, image, **encoding_settings())
+    future.add_done_callback(lambda _: metrics.stage_duration.observe(time.perf_counter() - started, stage="response_encode"))
+
+    return future
+
+
+class EncodingSession:
+    """
+    Encodes images of one request as soon as they are ready. Pass submit as the image_ready_callback
+    of a processing object so encoding of one image overlaps with postprocessing of the next; images that
+    were not submitted that way (grids, images replaced by scripts) are encoded when results are collected.
+    """
+
+    def __init__(self):
+        self.started = {}
+
+    def submit(self, image):
+        self.started[id(image)] = (image, submit(image))
+
+    def futures(self, images):
+        res = []
+        for image in images:
+            started_image, future = self.started.get(id(image), (None, None))
+            res.append(future if started_image is image else submit(image))
+
+        return res
+
+    async def encode(self, images):
+        return [await asyncio.wrap_future(future) for future in self.futures(images)]
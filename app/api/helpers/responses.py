@@ -0,0 +1,93 @@
+"""Binary responses carrying generated images"""
+import json
+import uuid
+import zipfile
+
+from fastapi.responses import StreamingResponse
+
+from app.api.helpers.utils import image_media_type
+
+
+def image_extension():
+    from app.ml.modules.shared import opts
+
+    return opts.samples_format.lower()
+
+
+def images_multipart_response(result, encoded):
+    """
+    Streams a multipart/mixed response: a JSON part with result, then one part per image with its raw
+    encoded bytes. encoded holds futures from image_encoding; each part is sent as soon as its image is
+    encoded (starlette runs the generator in its threadpool), so the full response is never held in memory.
+    """
+    boundary = uuid.uuid4().hex
+    media_type = image_media_type()
+    extension = image_extension()
+
+    def parts():
+        yield (f"--{boundary}\r\nContent-Type: application/json\r\n\r\n").encode()
+        yield json.dumps(result, default=str).encode()
+        yield b"\r\n"
+
+        for i, future in enumerate(encoded):
+            data = future.result()
+            yield (
+                f"--{boundary}\r\n"
+                f"Content-Type: {media_type}\r\n"
+                f"Content-Disposition: attachment; filename=\"{i:05}.{extension}\"\r\n"
+                f"Content-Length: {len(data)}\r\n\r\n"
+            ).encode()
+            yield data
+            yield b"\r\n"
+
+        yield f"--{boundary}--\r\n".encode()
+
+    return StreamingResponse(parts(), media_type=f"multipart/mixed; boundary={boundary}")
+
+
+class ZipStream:
+    """write-only file object collecting what zipfile writes, so it can be yielded in pieces"""
+
+    def __init__(self):
+        self.chunks = []
+        self.position = 0
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def flush(self):
+        pass
+
+    def take(self):
+        data = b"".join(self.chunks)
+        self.chunks = []
+        return data
+
+
+def images_zip_response(result, encoded):
+    """
+    Streams a zip archive with result as info.json followed by the images from the encoded futures.
+    Images are stored without recompression since png, jpeg and webp data is already compressed.
+    """
+    extension = image_extension()
+
+    def archive():
+        stream = ZipStream()
+
+        with zipfile.ZipFile(stream, mode="w", compression=zipfile.ZIP_STORED) as zip_file:
+            zip_file.writestr("info.json", json.dumps(result, default=str))
+            yield stream.take()
+
+            for i, future in enumerate(encoded):
+                zip_file.writestr(f"{i:05}.{extension}", future.result())
+                yield stream.take()
+
+        yield stream.take()
+
+    return StreamingResponse(archive(), media_type="application/zip",
+                             headers={"Content-Disposition": "attachment; filename=\"images.zip\""})
@@ -1,59 +1,65 @@
 import base64
-import io
 import os
 import subprocess
 from io import BytesIO
 
 import git
-import piexif
-from fastapi import HTTPException
-from PIL import Image, PngImagePlugin
+from fastapi import HTTPException, UploadFile
+from PIL import Image
+from starlette.concurrency import run_in_threadpool
 
 from app.api.helpers.constant import SCRIPT_PATH, RepositoryConstant
+from app.api.helpers.image_encoding import encode_image, encoding_settings
+from app.ml.modules import metrics
 
 
 def decode_base64_to_image(encoding):
     if encoding.startswith("data:image/"):
         encoding = encoding.split(";")[1].split(",")[1]
     try:
-        image = Image.open(BytesIO(base64.b64decode(encoding)))
+        with metrics.stage_duration.time(stage="image_decode"):
+            image = Image.open(BytesIO(base64.b64decode(encoding)))
+            image.load()
         return image
     except Exception as err:
         raise HTTPException(status_code=500, detail="Invalid encoded image")
 
 
-def encode_pil_to_base64(image):
+def decode_file_to_image(file):
+    try:
+        with metrics.stage_duration.time(stage="image_decode"):
+            image = Image.open(file)
+            image.load()
+        return image
+    except Exception as err:
+        raise HTTPException(status_code=500, detail="Invalid image file")
+
+
+async def decode_upload_to_image(upload: UploadFile):
+    """decodes an uploaded image straight from its spooled buffer, without copying it into bytes first"""
+    return await run_in_threadpool(decode_file_to_image, upload.file)
+
+
+def image_media_type():
     from app.ml.modules.shared import opts
-    with io.BytesIO() as output_bytes:
-
-        if opts.samples_format.lower() == 'png':
-            use_metadata = False
-            metadata = PngImagePlugin.PngInfo()
-            for key, value in image.info.items():
-                if isinstance(key, str) and isinstance(value, str):
-                    metadata.add_text(key, value)
-                    use_metadata = True
-            image.save(output_bytes, format="PNG", pnginfo=(
-                metadata if use_metadata else None), quality=opts.jpeg_quality)
-
-        elif opts.samples_format.lower() in ("jpg", "jpeg", "webp"):
-            parameters = image.info.get('parameters', None)
-            exif_bytes = piexif.dump({
-                "Exif": {piexif.ExifIFD.UserComment: piexif.helper.UserComment.dump(parameters or "", encoding="unicode")}
-            })
-            if opts.samples_format.lower() in ("jpg", "jpeg"):
-                image.save(output_bytes, format="JPEG",
-                           exif=exif_bytes, quality=opts.jpeg_quality)
-            else:
-                image.save(output_bytes, format="WEBP",
-                           exif=exif_bytes, quality=opts.jpeg_quality)
-
-        else:
-            raise HTTPException(status_code=500, detail="Invalid image format")
-
-        bytes_data = output_bytes.getvalue()
-
-    return base64.b64encode(bytes_data)
+
+    return {
+        "png": "image/png",
+        "jpg": "image/jpeg",
+        "jpeg": "image/jpeg",
+        "webp": "image/webp",
+    }.get(opts.samples_format.lower(), "application/octet-stream")
+
+
+def encode_pil_to_base64(image):
+    return base64.b64encode(encode_pil_to_bytes(image))
+
+
+def encode_pil_to_bytes(image):
+    try:
+        return encode_image(image, **encoding_settings())
+    except ValueError:
+        raise HTTPException(status_code=500, detail="Invalid image format")
 
 
 def run(command, desc=None, errdesc=None, custom_env=None, live=False):
@@ -1,8 +1,11 @@
 from fastapi import APIRouter
 
-from app.api.routes import interrogate, img2img
+from app.api.routes import interrogate, img2img, jobs, progress, system
 
 app = APIRouter()
 
 app.include_router(interrogate.router, tags=["CLIP"], prefix="/clip")
 app.include_router(img2img.router, tags=["Stable Diffusion"], prefix="/img2img")
+app.include_router(jobs.router, tags=["Jobs"], prefix="/jobs")
+app.include_router(progress.router, tags=["Progress"], prefix="/progress")
+app.include_router(system.router, tags=["System"], prefix="/system")
@@ -1,14 +1,24 @@
 """Img2img route"""
-from fastapi import APIRouter, HTTPException, Response
+import base64
+import functools
+import uuid
+from typing import List
+
+from fastapi import APIRouter, File, Form, HTTPException, Response, UploadFile
+from pydantic import ValidationError
 
 import app.ml.modules.shared as shared
 from app.api.database.models import *
+from app.api.helpers.responses import (images_multipart_response,
+                                       images_zip_response)
+from app.api.helpers.image_encoding import EncodingSession
 from app.api.helpers.utils import (decode_base64_to_image,
-                                   encode_pil_to_base64)
+                                   decode_upload_to_image)
+from app.api.services.batching import img2img_batch_key, process_img2img_batch
+from app.api.services.job_queue import job_queue, run_in_queue
+from app.api.services.tasks import process_img2img
 from app.logger.logger import configure_logging
-from app.ml.modules import scripts, sd_samplers
-from app.ml.modules.processing import (StableDiffusionProcessingImg2Img,
-                                       process_images)
+from app.ml.modules import scripts, sd_models, sd_samplers
 from app.ml.modules.shared import opts
 
 # to get a string like this run:
@@ -19,9 +29,9 @@ router = APIRouter()
 
 @router.get("/")
 async def check_status():
-    if shared.state.job_count == 0:
-        return {'status': "succeeded"}
-    return {'status': "busy"}
+    if shared.state.job_count == 0 and not job_queue.busy():
+        return {'status': "succeeded", 'queued': 0}
+    return {'status': "busy", 'queued': job_queue.depth()}
 
 def validate_sampler_name(name):
     config = sd_samplers.all_samplers_map.get(name, None)
@@ -95,6 +105,64 @@ async def img2imgapi(img2imgreq: StableDiffusionImg2ImgProcessingAPI):
     if mask:
         mask = decode_base64_to_image(mask)
 
+    init_images = [decode_base64_to_image(x) for x in init_images]
+
+    encoder = EncodingSession() if img2imgreq.send_images else None
+    processed, id_task = await run_img2img(img2imgreq, init_images, mask, encoder)
+
+    b64images = list(map(base64.b64encode, await encoder.encode(processed.images))) if encoder is not None else []
+
+    if not img2imgreq.include_init_images:
+        img2imgreq.init_images = None
+        img2imgreq.mask = None
+
+    return ImageToImageResponse(images=b64images, parameters=vars(img2imgreq), info=processed.js(), id_task=id_task)
+
+
+@router.post("/multipart")
+async def img2img_multipart_api(
+    init_images: List[UploadFile] = File(..., description="Init images as binary file uploads."),
+    mask: UploadFile = File(None, description="Optional mask as a binary file upload."),
+    params: str = Form("{}", description="JSON object with the same fields as the JSON endpoint, without images."),
+    response_format: str = Form("multipart", description="multipart for a multipart/mixed response, zip for a zip archive."),
+):
+    """
+    Same as POST /img2img but images travel as raw bytes instead of base64 JSON: init images and mask
+    are decoded straight from the upload buffers, and the result is streamed back as multipart/mixed
+    (a JSON part with parameters and info followed by one part per image) or as a zip archive.
+    """
+    try:
+        img2imgreq = StableDiffusionImg2ImgProcessingAPI.parse_raw(params)
+    except ValidationError as e:
+        raise HTTPException(status_code=422, detail=e.errors())
+
+    if response_format not in ("multipart", "zip"):
+        raise HTTPException(status_code=422, detail=f"Unknown response format {response_format}")
+
+    decoded_init_images = [await decode_upload_to_image(x) for x in init_images]
+    decoded_mask = await decode_upload_to_image(mask) if mask is not None else None
+
+    img2imgreq.init_images = None
+    img2imgreq.mask = None
+
+    encoder = EncodingSession() if img2imgreq.send_images else None
+    processed, id_task = await run_img2img(img2imgreq, decoded_init_images, decoded_mask, encoder)
+
+    result = {"parameters": vars(img2imgreq), "info": processed.js(), "id_task": id_task}
+    encoded = encoder.futures(processed.images) if encoder is not None else []
+
+    if response_format == "zip":
+        return images_zip_response(result, encoded)
+
+    return images_multipart_response(result, encoded)
+
+
+async def run_img2img(img2imgreq, init_images, mask, encoder=None):
+    """
+    Queues the img2img job described by img2imgreq with already decoded init images and mask,
+    and returns the Processed result together with the job's task id. If an EncodingSession is
+    given, images start encoding as soon as each one is finished.
+    """
     script_runner = scripts.scripts_img2img
     if not script_runner.scripts:
         script_runner.initialize_scripts(True)
@@ -122,29 +190,30 @@ async def img2imgapi(img2imgreq: StableDiffusionImg2ImgProcessingAPI):
     script_args = init_script_args(
         img2imgreq, selectable_scripts, selectable_script_idx, script_runner)
 
-    send_images = args.pop('send_images', True)
+    args.pop('send_images', None)
     args.pop('save_images', None)
-
-    p = StableDiffusionProcessingImg2Img(sd_model=shared.sd_model, **args)
-    p.init_images = [decode_base64_to_image(x) for x in init_images]
-    p.scripts = script_runner
-    p.outpath_grids = opts.outdir_img2img_grids
-    p.outpath_samples = opts.outdir_img2img_samples
-
-    shared.state.begin()
-    if selectable_scripts != None:
-        p.script_args = script_args
-        processed = scripts.scripts_img2img.run(
-            p, *p.script_args)  # Need to pass args as list here
+    id_task = args.pop('id_task', None) or uuid.uuid4().hex
+    priority = args.pop('priority', None) or 0
+    profile = args.pop('profile', None) or False
+    image_ready_callback = encoder.submit if encoder is not None else None
+    override_settings = img2imgreq.override_settings or {}
+    checkpoint_info = sd_models.checkpoint_alisases.get(override_settings.get('sd_model_checkpoint', None), None)
+    # named by title like executors report theirs, so the queue can tell which jobs share a model
+    checkpoint = checkpoint_info.title if checkpoint_info is not None else override_settings.get('sd_model_checkpoint', None)
+    vae = override_settings.get('sd_vae', None)
+
+    # a profiled request runs alone, so its trace only shows its own work
+    batch_key = None if profile else img2img_batch_key(args, init_images, script_args, selectable_scripts, img2imgreq.alwayson_scripts)
+
+    # the GPU worker owns shared.state and the model; we only wait for it here
+    if batch_key is not None:
+        payload = {'args': args, 'init_images': init_images, 'script_args': script_args}
+        processed = await run_in_queue(process_img2img_batch, priority=priority, id_task=id_task, batch_key=batch_key,
+                                       payload=payload, image_ready_callback=image_ready_callback, checkpoint=checkpoint, vae=vae)
     else:
-        p.script_args = tuple(script_args)  # Need to pass args as tuple here
-        processed = process_images(p)
-    shared.state.end()
-
-    b64images = list(map(encode_pil_to_base64, processed.images)) if send_images else []
-
-    if not img2imgreq.include_init_images:
-        img2imgreq.init_images = None
-        img2imgreq.mask = None
+        # a module level function, so the job can be sent to a GPU worker process
+        process = functools.partial(process_img2img, args, init_images, script_args, selectable_script_idx, profile=profile)
+        processed = await run_in_queue(process, priority=priority, id_task=id_task,
+                                       image_ready_callback=image_ready_callback, checkpoint=checkpoint, vae=vae)
 
-    return ImageToImageResponse(images=b64images, parameters=vars(img2imgreq), info=processed.js())
+    return processed, id_task
@@ -1,8 +1,16 @@
 """Interrogate route"""
-from fastapi import APIRouter, HTTPException
+import asyncio
+import functools
 
-from app.api.database.models import InterrogateRequest, InterrogateResponse
-from app.api.helpers.utils import decode_base64_to_image
+from fastapi import APIRouter, File, Form, HTTPException, UploadFile
+from starlette.concurrency import run_in_threadpool
+
+from app.api.database.models import (InterrogateBatchRequest,
+                                     InterrogateBatchResponse,
+                                     InterrogateRequest, InterrogateResponse)
+from app.api.helpers.utils import decode_base64_to_image, decode_upload_to_image
+from app.api.services.job_queue import run_in_queue
+from app.api.services.tasks import interrogate_image, interrogate_images
 from app.logger.logger import configure_logging
 from app.ml.modules import shared
 
@@ -31,10 +39,60 @@ async def interrogateapi(interrogatereq: InterrogateRequest):
         raise HTTPException(status_code=404, detail="Image not found")
 
     img = decode_base64_to_image(image_b64)
+
+    return await run_interrogate(img, interrogatereq.model, interrogatereq.priority)
+
+
+@router.post("/multipart", response_model=InterrogateResponse)
+async def interrogate_multipart_api(
+    image: UploadFile = File(..., description="Image to work on, as a binary file upload."),
+    model: str = Form("clip", description="The interrogate model used."),
+    priority: int = Form(0, description="Jobs with a higher priority are taken from the queue first."),
+):
+    """
+    Same as POST /clip, but the image is uploaded as multipart form data and decoded directly from
+    the upload buffer instead of a base64 string.
+    """
+    img = await decode_upload_to_image(image)
+
+    return await run_interrogate(img, model, priority)
+
+
+@router.post("/batch", response_model=InterrogateBatchResponse)
+async def interrogate_batch_api(interrogatereq: InterrogateBatchRequest):
+    """
+    Captions many images in one job. Images are decoded concurrently interrogate_batch_size at a time,
+    then BLIP and CLIP run on them in batches of that size; captions come back in the order of the input
+    images. Requests with more than --api-interrogate-max-images images are rejected with 413.
+    """
+    if not interrogatereq.images:
+        raise HTTPException(status_code=404, detail="Image not found")
+
+    max_images = shared.cmd_opts.api_interrogate_max_images
+    if len(interrogatereq.images) > max_images:
+        raise HTTPException(status_code=413, detail=f"At most {max_images} images can be interrogated in one request, got {len(interrogatereq.images)}")
+
+    if interrogatereq.model != "clip":
+        raise HTTPException(status_code=404, detail="Model not found")
+
+    def decode(image_b64):
+        return decode_base64_to_image(image_b64).convert('RGB')
+
+    chunk_size = max(shared.opts.interrogate_batch_size, 1)
+    imgs = []
+    for i in range(0, len(interrogatereq.images), chunk_size):
+        imgs += await asyncio.gather(*[run_in_threadpool(decode, x) for x in interrogatereq.images[i:i + chunk_size]])
+
+    captions = await run_in_queue(functools.partial(interrogate_images, imgs), priority=interrogatereq.priority, checkpoint=False)
+
+    return InterrogateBatchResponse(captions=captions)
+
+
+async def run_interrogate(img, model, priority):
     img = img.convert('RGB')
 
-    if interrogatereq.model == "clip":
-        processed = shared.interrogator.interrogate(img)
+    if model == "clip":
+        processed = await run_in_queue(functools.partial(interrogate_image, img), priority=priority, checkpoint=False)
     else:
         raise HTTPException(status_code=404, detail="Model not found")
 
@@ -0,0 +1,39 @@
+"""Jobs route"""
+from fastapi import APIRouter, HTTPException
+
+from app.api.database.models import JobQueueResponse, JobResponse
+from app.api.services.job_queue import job_queue
+from app.logger.logger import configure_logging
+
+logger = configure_logging(__name__)
+router = APIRouter()
+
+
+@router.get("/", response_model=JobQueueResponse)
+async def queue_status():
+    return JobQueueResponse(**job_queue.dict())
+
+
+@router.get("/{id_task}", response_model=JobResponse)
+async def job_status(id_task: str):
+    job = job_queue.get(id_task)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+
+    return JobResponse(**job.dict())
+
+
+@router.post("/{id_task}/cancel", response_model=JobResponse)
+async def cancel_job(id_task: str):
+    """
+    Cancels a job: a queued job is removed from the queue, a running job is interrupted at the
+    next sampling step and returns whatever it has produced so far.
+    """
+    job = job_queue.get(id_task)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+
+    if not job_queue.cancel(id_task):
+        raise HTTPException(status_code=409, detail="Job has already finished")
+
+    return JobResponse(**job.dict())
@@ -0,0 +1,67 @@
+"""Progress route"""
+from fastapi import APIRouter, HTTPException, WebSocket, WebSocketDisconnect
+from fastapi.responses import StreamingResponse
+
+from app.api.services.job_queue import job_queue
+from app.api.services.progress_stream import progress_stream
+from app.logger.logger import configure_logging
+from app.ml.modules import progress
+
+logger = configure_logging(__name__)
+router = APIRouter()
+
+
+def known_task(id_task):
+    return job_queue.get(id_task) is not None or id_task in progress.pending_tasks \
+        or id_task in progress.finished_tasks or id_task == progress.current_task
+
+
+@router.get("/{id_task}/events")
+async def progress_events(id_task: str):
+    """
+    Streams progress of a job as Server-Sent Events. Every event carries a JSON object with status,
+    progress, ETA and sampling step; events during sampling may also carry a low-resolution live preview.
+    The stream ends once the job has completed.
+    """
+    if not known_task(id_task):
+        raise HTTPException(status_code=404, detail="Job not found")
+
+    queue = progress_stream.subscribe(id_task)
+
+    async def events():
+        try:
+            while True:
+                message = await queue.get()
+                if message is None:
+                    break
+
+                yield f"data: {message}\n\n"
+        finally:
+            progress_stream.unsubscribe(id_task, queue)
+
+    return StreamingResponse(events(), media_type="text/event-stream", headers={"Cache-Control": "no-cache"})
+
+
+@router.websocket("/{id_task}/ws")
+async def progress_websocket(websocket: WebSocket, id_task: str):
+    """Same messages as the Server-Sent Events stream, sent as text frames; the socket is closed once the job has completed."""
+    await websocket.accept()
+
+    if not known_task(id_task):
+        await websocket.close(code=4404)
+        return
+
+    queue = progress_stream.subscribe(id_task)
+    try:
+        while True:
+            message = await queue.get()
+            if message is None:
+                break
+
+            await websocket.send_text(message)
+
+        await websocket.close()
+    except WebSocketDisconnect:
+        pass
+    finally:
+        progress_stream.unsubscribe(id_task, queue)
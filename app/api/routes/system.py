@@ -0,0 +1,39 @@
+"""System route"""
+from fastapi import APIRouter
+
+from app.api.database.models import (ModelResidencyResponse, ProfilingRequest,
+                                     ProfilingResponse)
+from app.logger.logger import configure_logging
+from app.ml.modules import model_residency, profiling
+
+logger = configure_logging(__name__)
+router = APIRouter()
+
+
+@router.get("/models", response_model=ModelResidencyResponse)
+async def model_residency_status():
+    """
+    Lists the models tracked by the residency manager: whether each is on its device, its size,
+    and how often it was used, moved to the device and evicted to RAM.
+    """
+    return ModelResidencyResponse(models=model_residency.manager.stats())
+
+
+@router.get("/profiling", response_model=ProfilingResponse)
+async def profiling_status():
+    """
+    Shows how many upcoming jobs will be profiled and the trace files written so far.
+    """
+    return ProfilingResponse(pending=profiling.pending(), traces=profiling.list_traces())
+
+
+@router.post("/profiling", response_model=ProfilingResponse)
+async def profile_jobs(profilingreq: ProfilingRequest):
+    """
+    Runs the next profilingreq.jobs generation jobs under torch.profiler. Each one writes a Chrome trace
+    with markers for p.init, conditioning, every sampler step and VAE decode to the profiling directory,
+    which only keeps the newest profiling_max_traces files.
+    """
+    profiling.arm(profilingreq.jobs)
+
+    return ProfilingResponse(pending=profiling.pending(), traces=profiling.list_traces())
@@ -0,0 +1,99 @@
+"""Cross-request batching of img2img jobs"""
+from app.ml.modules import extra_networks, scripts, shared
+from app.ml.modules.processing import (Processed,
+                                       StableDiffusionProcessingImg2Img,
+                                       get_fixed_seed, process_images)
+from app.ml.modules.shared import opts
+
+# arguments that may differ between requests sharing one batch
+per_request_args = ['prompt', 'negative_prompt', 'seed', 'subseed', 'init_images']
+
+
+def img2img_batch_key(args, init_images, script_args, selectable_script=None, alwayson_scripts=None):
+    """
+    Returns a hashable key shared by all requests that can run in the same UNet batch, or None if
+    this request has to run on its own. Requests with masks, scripts, override settings, more than one
+    image, or extra networks in the prompt (which are activated for the whole batch) are never batched.
+    """
+    if args.get('mask') is not None or selectable_script is not None or alwayson_scripts:
+        return None
+
+    if len(init_images) != 1 or args.get('batch_size', 1) != 1 or args.get('n_iter', 1) != 1:
+        return None
+
+    if args.get('override_settings'):
+        return None
+
+    for key in ['prompt', 'negative_prompt']:
+        if extra_networks.re_extra_net.search(args.get(key) or ""):
+            return None
+
+    shared_args = [(key, repr(value)) for key, value in sorted(args.items()) if key not in per_request_args]
+
+    return tuple(shared_args) + (('script_args', repr(script_args)),)
+
+
+def process_img2img_batch(payloads, image_ready_callbacks=None):
+    """
+    Runs the img2img requests described by payloads as a single batch and returns one Processed per
+    payload. Every payload is a dict with the processing 'args', decoded 'init_images' and 'script_args'.
+    image_ready_callbacks optionally has a callback per payload for its finished image.
+    """
+    args = dict(payloads[0]['args'])
+    args['prompt'] = [payload['args'].get('prompt', "") for payload in payloads]
+    args['negative_prompt'] = [payload['args'].get('negative_prompt', None) for payload in payloads]
+    args['seed'] = [get_fixed_seed(payload['args'].get('seed', -1)) for payload in payloads]
+    args['subseed'] = [get_fixed_seed(payload['args'].get('subseed', -1)) for payload in payloads]
+    args['batch_size'] = len(payloads)
+    args['do_not_save_grid'] = True
+
+    if not scripts.scripts_img2img.scripts:
+        scripts.scripts_img2img.initialize_scripts(True)
+
+    p = StableDiffusionProcessingImg2Img(sd_model=shared.sd_model, **args)
+    p.init_images = [payload['init_images'][0] for payload in payloads]
+    p.scripts = scripts.scripts_img2img
+    p.script_args = tuple(payloads[0]['script_args'])
+    p.outpath_grids = opts.outdir_img2img_grids
+    p.outpath_samples = opts.outdir_img2img_samples
+
+    # the batch produces one image per payload, in payload order
+    callbacks = iter(image_ready_callbacks or [])
+
+    def image_ready(image):
+        callback = next(callbacks, None)
+        if callback is not None:
+            callback(image)
+
+    p.image_ready_callback = image_ready
+
+    processed = process_images(p)
+
+    return split_processed(p, processed, len(payloads))
+
+
+def split_processed(p, processed, count):
+    results = []
+
+    for i in range(count):
+        index = processed.index_of_first_image + i
+        images = processed.images[index:index + 1]
+        infotexts = processed.infotexts[index:index + 1]
+
+        res = Processed(
+            p,
+            images,
+            seed=processed.all_seeds[i],
+            info=infotexts[0] if infotexts else "",
+            subseed=processed.all_subseeds[i],
+            all_prompts=[processed.all_prompts[i]],
+            all_negative_prompts=[processed.all_negative_prompts[i]],
+            all_seeds=[processed.all_seeds[i]],
+            all_subseeds=[processed.all_subseeds[i]],
+            infotexts=infotexts,
+            comments=processed.comments,
+        )
+        res.batch_size = 1
+        results.append(res)
+
+    return results
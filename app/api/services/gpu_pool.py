@@ -0,0 +1,194 @@
+"""Pool of GPU worker processes, one per device, each with its own model replica"""
+import multiprocessing
+import os
+import queue
+import threading
+import traceback
+
+from fastapi import HTTPException
+
+from app.logger.logger import configure_logging
+from app.ml.modules import metrics, profiling, shared
+
+logger = configure_logging(__name__)
+
+# set in the environment of worker processes, so they load a model instead of starting a pool of their own
+worker_env_key = "SD_GPU_WORKER"
+
+# os.environ is process-wide, so workers are spawned one at a time
+spawn_lock = threading.Lock()
+
+
+def is_worker_process():
+    return os.environ.get(worker_env_key, None) is not None
+
+
+def enabled():
+    return bool(shared.cmd_opts.gpu_workers) and not is_worker_process()
+
+
+def device_ids():
+    return [x.strip() for x in shared.cmd_opts.gpu_workers.split(",") if x.strip()]
+
+
+def create_executors():
+    if shared.cmd_opts.device_id is not None:
+        logger.warning("--device-id is ignored by GPU workers; each worker only sees the device from --gpu-workers")
+
+    return [GpuWorker(device_id) for device_id in device_ids()]
+
+
+class RemoteError(Exception):
+    pass
+
+
+class GpuWorker:
+    """
+    Executor for JobQueue that runs jobs in a separate process pinned to one device through
+    CUDA_VISIBLE_DEVICES. The process loads its own checkpoint and has its own shared.state, so workers
+    never contend for a lock. Images announced by image_ready_callback in the worker are sent back as they
+    are made, so callbacks in this process still run while the job is going.
+    """
+
+    def __init__(self, device_id):
+        self.device_id = device_id
+        self.name = f"cuda:{device_id}"
+        self.context = multiprocessing.get_context("spawn")
+        self.requests = self.context.Queue()
+        self.responses = self.context.Queue()
+        self.interrupt_event = self.context.Event()
+        self.process = None
+        self.checkpoint = None
+
+    def start(self):
+        if self.process is not None and self.process.is_alive():
+            return
+
+        # spawned children inherit the environment at start; CUDA_VISIBLE_DEVICES has to be set before they import torch
+        with spawn_lock:
+            saved = {key: os.environ.get(key, None) for key in ("CUDA_VISIBLE_DEVICES", worker_env_key)}
+            os.environ["CUDA_VISIBLE_DEVICES"] = self.device_id
+            os.environ[worker_env_key] = self.device_id
+            try:
+                self.process = self.context.Process(target=worker_main, args=(self.requests, self.responses, self.interrupt_event), name=f"GPU worker {self.name}", daemon=True)
+                self.process.start()
+            finally:
+                for key, value in saved.items():
+                    if value is None:
+                        os.environ.pop(key, None)
+                    else:
+                        os.environ[key] = value
+
+        kind, value = self.receive()
+        if kind != "ready":
+            raise RemoteError(f"GPU worker {self.name} failed to start: {value}")
+
+        self.checkpoint = value
+        logger.info(f"GPU worker {self.name} ready with {self.checkpoint}")
+
+    def interrupt(self):
+        self.interrupt_event.set()
+
+    def receive(self):
+        while True:
+            try:
+                return self.responses.get(timeout=1)
+            except queue.Empty:
+                if not self.process.is_alive():
+                    raise RemoteError(f"GPU worker {self.name} exited with code {self.process.exitcode}")
+
+    def run(self, func, payloads, image_ready_callbacks):
+        self.interrupt_event.clear()
+        self.requests.put((func, payloads, [callback is not None for callback in image_ready_callbacks]))
+
+        while True:
+            kind, value = self.receive()
+
+            if kind == "image":
+                index, image = value
+                image_ready_callbacks[index](image)
+            elif kind == "metrics":
+                metrics.registry.update_worker(self.name, value)
+            elif kind == "profiling":
+                # jobs are armed for profiling in the server; the worker asks for one when a generation job starts
+                self.requests.put(profiling.take())
+            elif kind == "result":
+                results, self.checkpoint = value
+                return results
+            elif kind == "error":
+                raise value
+            elif kind == "http_error":
+                status_code, detail = value
+                raise HTTPException(status_code=status_code, detail=detail)
+            else:
+                raise RemoteError(f"Unexpected message from GPU worker {self.name}: {kind}")
+
+
+def worker_main(requests, responses, interrupt_event):
+    """entry point of a GPU worker process: loads the model, then runs jobs until it gets None"""
+
+    try:
+        from app.ml.modules import shared as worker_shared
+
+        # when the server was started as a script, spawn has already run it as __mp_main__ here
+        if worker_shared.sd_model is None:
+            import app.main  # noqa: F401 initializes this process and loads the checkpoint onto its device
+
+        from app.api.services.job_queue import LocalExecutor
+    except BaseException as e:
+        responses.put(("error", f"{type(e).__name__}: {e}"))
+        return
+
+    executor = LocalExecutor()
+    responses.put(("ready", executor.checkpoint))
+
+    def watch_interrupts():
+        while True:
+            interrupt_event.wait()
+            interrupt_event.clear()
+            executor.interrupt()
+
+    threading.Thread(target=watch_interrupts, name="interrupt watcher", daemon=True).start()
+
+    # the job runs on this thread, so nothing else reads requests while it waits for the answer
+    profiling.remote_take = lambda: ask_server(requests, responses, "profiling")
+
+    while True:
+        request = requests.get()
+        if request is None:
+            break
+
+        func, payloads, has_callbacks = request
+        callbacks = [make_image_sender(responses, i) if has_callback else None for i, has_callback in enumerate(has_callbacks)]
+
+        try:
+            results = executor.run(func, payloads, callbacks)
+        except HTTPException as e:
+            message = ("http_error", (e.status_code, e.detail))
+        except Exception as e:
+            message = ("error", picklable_exception(e))
+        else:
+            message = ("result", (results, executor.checkpoint))
+
+        # stages of the job were timed in this process; the server shows them with a worker label
+        responses.put(("metrics", metrics.registry.snapshot()))
+        responses.put(message)
+
+
+def ask_server(requests, responses, kind):
+    responses.put((kind, None))
+    return requests.get()
+
+
+def make_image_sender(responses, index):
+    return lambda image: responses.put(("image", (index, image)))
+
+
+def picklable_exception(e):
+    import pickle
+
+    try:
+        pickle.loads(pickle.dumps(e))
+        return e
+    except Exception:
+        return RemoteError("".join(traceback.format_exception(type(e), e, e.__traceback__)))
@@ -0,0 +1,479 @@
+"""GPU job queue"""
+import asyncio
+import collections
+import heapq
+import itertools
+import threading
+import time
+import uuid
+from concurrent.futures import Future
+
+from fastapi import HTTPException
+
+from app.api.services import gpu_pool
+from app.logger.logger import configure_logging
+from app.ml.modules import metrics, progress, shared
+from app.ml.modules.call_queue import queue_lock
+
+logger = configure_logging(__name__)
+
+
+class NoWorkersError(Exception):
+    pass
+
+
+class QueueFullError(Exception):
+    pass
+
+
+def call_job_func(func, payloads, image_ready_callbacks):
+    """
+    Calls the func of a job the way JobQueue documents it and returns a list with one result per job:
+    without arguments for a single job, with the list of payloads for a batch. Callbacks are only passed
+    when one was given, so plain functions work too.
+    """
+    if payloads is None:
+        callback = image_ready_callbacks[0]
+        return [func(image_ready_callback=callback) if callback is not None else func()]
+
+    if any(callback is not None for callback in image_ready_callbacks):
+        return func(payloads, image_ready_callbacks=image_ready_callbacks)
+
+    return func(payloads)
+
+
+class LocalExecutor:
+    """Runs jobs in this process, on shared.sd_model."""
+
+    name = "local"
+
+    def start(self):
+        pass
+
+    @property
+    def checkpoint(self):
+        checkpoint_info = getattr(shared.sd_model, 'sd_checkpoint_info', None)
+        return checkpoint_info.title if checkpoint_info is not None else None
+
+    def interrupt(self):
+        shared.state.interrupt()
+
+    def run(self, func, payloads, image_ready_callbacks):
+        with queue_lock:
+            run_memmon = shared.opts.memmon_poll_rate > 0 and not shared.mem_mon.disabled
+            if run_memmon:
+                shared.mem_mon.monitor()
+
+            shared.state.begin()
+            try:
+                return call_job_func(func, payloads, image_ready_callbacks)
+            finally:
+                shared.state.end()
+
+                if run_memmon:
+                    metrics.record_memory(shared.mem_mon.stop())
+
+
+class Job:
+    """A unit of GPU work together with the future its submitter awaits on."""
+
+    def __init__(self, func, priority=0, id_task=None, batch_key=None, payload=None, image_ready_callback=None, checkpoint=None, vae=None):
+        self.id_task = id_task or uuid.uuid4().hex
+        self.func = func
+        self.priority = priority
+        self.batch_key = batch_key
+        self.payload = payload
+        self.image_ready_callback = image_ready_callback
+        self.checkpoint = checkpoint
+        self.vae = vae
+        self.future = Future()
+        self.cancelled = False
+        self.passed_over = 0
+        self.time_queued = time.time()
+        self.time_started = None
+        self.time_finished = None
+
+    @property
+    def queue_wait(self):
+        end = self.time_started or time.time()
+        return end - self.time_queued
+
+    @property
+    def compute_time(self):
+        if self.time_started is None:
+            return None
+
+        end = self.time_finished or time.time()
+        return end - self.time_started
+
+    def status(self):
+        if self.cancelled:
+            return "cancelled"
+        if self.time_finished is not None:
+            return "failed" if self.future.exception() is not None else "succeeded"
+        if self.time_started is not None:
+            return "running"
+
+        return "queued"
+
+    def dict(self):
+        return {
+            "id_task": self.id_task,
+            "status": self.status(),
+            "priority": self.priority,
+            "queue_wait": self.queue_wait,
+            "compute_time": self.compute_time,
+        }
+
+
+class JobQueue:
+    """
+    Bounded priority queue served by one worker thread per executor. Executors are the only place that
+    runs jobs touching a model, so route handlers never block the event loop on the GPU. By default there
+    is a single LocalExecutor; with --gpu-workers every GPU worker process gets its own executor.
+    Jobs with a higher priority run first; jobs with equal priority run in submission order.
+
+    func of a job is called without arguments, or with image_ready_callback= if the job has one. It must
+    be picklable (e.g. a functools.partial of a module-level function) to run in a GPU worker process.
+
+    Jobs submitted with the same batch_key can be run together: once a worker picks such a job it
+    waits up to batch_window seconds for more jobs with that key, then calls func once with the list of
+    their payloads (and image_ready_callbacks= if any job has one). func must return one result per
+    payload, in order.
+
+    A job may name the checkpoint and VAE it needs, otherwise it uses the ones from settings; a job that
+    doesn't use the SD model at all passes checkpoint=False and can run on any worker. To switch
+    models less often, a worker runs jobs for the model it has loaded before older jobs of the same priority
+    that need another one, but passes over each job at most affinity_limit times. An idle worker leaves a
+    job to another idle worker that already has its model loaded.
+    """
+
+    finished_jobs_to_keep = 16
+
+    def __init__(self, max_size, batch_window=0, max_batch_size=1, executors=None, affinity_limit=0):
+        self.max_size = max_size
+        self.batch_window = batch_window
+        self.max_batch_size = max_batch_size
+        self.affinity_limit = affinity_limit
+        self.executors = executors or [LocalExecutor()]
+        self.jobs = {}
+        self.pending = []
+        self.finished = []
+        self.running = {}
+        self.counter = itertools.count()
+        self.condition = threading.Condition()
+        self.workers = []
+        self.vaes = {}
+        self.switch_times = collections.deque()
+
+    def start(self):
+        with self.condition:
+            if self.workers:
+                return
+
+            for executor in self.executors:
+                worker = threading.Thread(target=self.run, args=(executor, ), name=f"GPU worker ({executor.name})", daemon=True)
+                worker.start()
+                self.workers.append(worker)
+
+    @property
+    def current_jobs(self):
+        return [job for jobs in self.running.values() for job in jobs]
+
+    def depth(self):
+        return len(self.pending)
+
+    def busy(self):
+        return len(self.running) > 0 or len(self.pending) > 0
+
+    def submit(self, func, priority=0, id_task=None, batch_key=None, payload=None, image_ready_callback=None, checkpoint=None, vae=None):
+        """queues func to be called on a worker thread; raises QueueFullError if the queue is at capacity"""
+
+        with self.condition:
+            if not self.executors:
+                raise NoWorkersError("no worker could be started to run jobs")
+            if len(self.pending) >= self.max_size:
+                raise QueueFullError(f"queue is full ({self.max_size} jobs waiting)")
+
+            job = Job(func, priority=priority, id_task=id_task, batch_key=batch_key, payload=payload,
+                      image_ready_callback=image_ready_callback, checkpoint=checkpoint, vae=vae)
+            heapq.heappush(self.pending, (-job.priority, next(self.counter), job))
+            self.jobs[job.id_task] = job
+            progress.add_task_to_queue(job.id_task)
+
+            self.condition.notify_all()
+
+        self.start()
+
+        return job
+
+    def get(self, id_task):
+        return self.jobs.get(id_task, None)
+
+    def cancel(self, id_task):
+        """removes a queued job, or interrupts it if it is already running; returns False if there was nothing to cancel"""
+
+        with self.condition:
+            job = self.jobs.get(id_task, None)
+            if job is None or job.future.done():
+                return False
+
+            job.cancelled = True
+
+            for executor, jobs in self.running.items():
+                if job in jobs:
+                    # other callers share this batch, so only a job running alone is interrupted;
+                    # otherwise its result is dropped when the batch finishes
+                    if len(jobs) == 1:
+                        executor.interrupt()
+                    return True
+
+            self.pending = [entry for entry in self.pending if entry[2] is not job]
+            heapq.heapify(self.pending)
+            progress.pending_tasks.pop(id_task, None)
+            self.forget(job)
+
+        metrics.jobs.inc(status="cancelled")
+        job.future.set_exception(HTTPException(status_code=409, detail=f"Job {id_task} was cancelled"))
+
+        return True
+
+    def forget(self, job):
+        self.finished.append(job)
+        while len(self.finished) > self.finished_jobs_to_keep:
+            self.jobs.pop(self.finished.pop(0).id_task, None)
+
+    def take_compatible(self, batch_key, count):
+        taken = [entry for entry in sorted(self.pending) if entry[2].batch_key == batch_key][:count]
+        if taken:
+            self.pending = [entry for entry in self.pending if entry not in taken]
+            heapq.heapify(self.pending)
+
+        return [entry[2] for entry in taken]
+
+    def wanted_model(self, job):
+        """the (checkpoint, VAE) job runs with, or None if it doesn't use the SD model"""
+
+        if job.checkpoint is False:
+            return None
+
+        return job.checkpoint or shared.opts.sd_model_checkpoint, job.vae or shared.opts.sd_vae
+
+    def loaded_model(self, executor):
+        """the (checkpoint, VAE) executor has loaded; the VAE is None until it has run a job"""
+
+        return executor.checkpoint, self.vaes.get(executor, None)
+
+    @staticmethod
+    def same_model(wanted, loaded):
+        if wanted is None:
+            return True
+
+        return wanted[0] == loaded[0] and (loaded[1] is None or wanted[1] == loaded[1])
+
+    def select(self, executor):
+        """the pending entry executor should run next, or None if everything waiting is better left to other workers"""
+
+        # a worker whose jobs have their results is about to look for more, so it counts as idle
+        idle = [other for other in self.executors if other is not executor and all(job.future.done() for job in self.running.get(other, ()))]
+        loaded = self.loaded_model(executor)
+
+        entries = []
+        for entry in sorted(self.pending):
+            wanted = self.wanted_model(entry[2])
+            if not self.same_model(wanted, loaded) and any(self.same_model(wanted, self.loaded_model(other)) for other in idle):
+                continue
+
+            entries.append((entry, self.same_model(wanted, loaded)))
+
+        if not entries:
+            return None
+
+        first, first_loaded = entries[0]
+        if first_loaded or first[2].passed_over >= self.affinity_limit:
+            return first
+
+        for i, (entry, is_loaded) in enumerate(entries):
+            if entry[0] != first[0]:
+                break
+
+            if is_loaded:
+                for passed, _ in entries[:i]:
+                    passed[2].passed_over += 1
+
+                return entry
+
+        return first
+
+    def next_jobs(self, executor):
+        with self.condition:
+            while True:
+                entry = self.select(executor) if self.pending else None
+                if entry is not None:
+                    break
+
+                self.condition.wait(1 if self.pending else None)
+
+            self.pending.remove(entry)
+            heapq.heapify(self.pending)
+
+            job = entry[2]
+            jobs = [job]
+
+            if job.batch_key is not None and self.max_batch_size > 1:
+                deadline = time.time() + self.batch_window
+                while True:
+                    jobs += self.take_compatible(job.batch_key, self.max_batch_size - len(jobs))
+
+                    remaining = deadline - time.time()
+                    if len(jobs) >= self.max_batch_size or remaining <= 0:
+                        break
+
+                    self.condition.wait(remaining)
+
+            self.running[executor] = jobs
+
+        return jobs
+
+    def start_executor(self, executor):
+        """
+        Starts executor, or starts it again if its process has died; returns False and stops giving it jobs if
+        that fails. Jobs still waiting when the last executor goes fail, as nothing would ever run them.
+        """
+
+        try:
+            executor.start()
+            return True
+        except Exception as e:
+            logger.error(f"Could not start {executor.name}: {e}")
+
+        with self.condition:
+            self.executors.remove(executor)
+            self.vaes.pop(executor, None)
+
+            stranded = [] if self.executors else [entry[2] for entry in self.pending]
+            if stranded:
+                self.pending = []
+
+            for job in stranded:
+                job.time_finished = time.time()
+                progress.pending_tasks.pop(job.id_task, None)
+                self.forget(job)
+
+            self.condition.notify_all()
+
+        for job in stranded:
+            job.future.set_exception(HTTPException(status_code=503, detail="No worker could be started to run the job"))
+            metrics.jobs.inc(status=job.status())
+
+        return False
+
+    def run(self, executor):
+        while True:
+            # a worker process that died while running or waiting is replaced before it gets more jobs
+            if not self.start_executor(executor):
+                return
+
+            jobs = self.next_jobs(executor)
+
+            try:
+                self.execute(executor, jobs)
+            finally:
+                with self.condition:
+                    self.running.pop(executor, None)
+                    for job in jobs:
+                        self.forget(job)
+
+                    self.condition.notify_all()
+
+    def execute(self, executor, jobs):
+        for job in jobs:
+            job.time_started = time.time()
+            metrics.queue_wait.observe(job.queue_wait)
+
+        metrics.batch_size.observe(len(jobs))
+
+        progress.start_task(jobs[0].id_task)
+        for job in jobs[1:]:
+            progress.pending_tasks.pop(job.id_task, None)
+
+        payloads = [job.payload for job in jobs] if jobs[0].batch_key is not None else None
+        image_ready_callbacks = [job.image_ready_callback for job in jobs]
+        loaded = self.loaded_model(executor)
+        wanted = self.wanted_model(jobs[0])
+
+        try:
+            executor.start()
+            results = executor.run(jobs[0].func, payloads, image_ready_callbacks)
+        except Exception as e:
+            for job in jobs:
+                job.future.set_exception(e)
+        else:
+            for job, result in zip(jobs, results):
+                if job.cancelled and len(jobs) > 1:
+                    job.future.set_exception(HTTPException(status_code=409, detail=f"Job {job.id_task} was cancelled"))
+                else:
+                    job.future.set_result(result)
+        finally:
+            for job in jobs:
+                job.time_finished = time.time()
+                progress.finish_task(job.id_task)
+                metrics.jobs.inc(status=job.status())
+
+            if wanted is not None:
+                if loaded[0] is not None and (executor.checkpoint != loaded[0] or loaded[1] not in (None, wanted[1])):
+                    self.record_switch()
+                self.vaes[executor] = wanted[1]
+
+        for job in jobs:
+            logger.info(f"Job {job.id_task} waited {job.queue_wait:.2f}s in queue, ran for {job.compute_time:.2f}s in a batch of {len(jobs)} on {executor.name}")
+
+    def record_switch(self):
+        metrics.model_switches.inc()
+
+        with self.condition:
+            self.switch_times.append(time.time())
+
+    def switches_last_hour(self):
+        hour_ago = time.time() - 3600
+        while self.switch_times and self.switch_times[0] < hour_ago:
+            self.switch_times.popleft()
+
+        return len(self.switch_times)
+
+    def dict(self):
+        with self.condition:
+            return {
+                "busy": self.busy(),
+                "depth": self.depth(),
+                "max_size": self.max_size,
+                "current": [job.id_task for job in self.current_jobs],
+                "queued": [entry[2].id_task for entry in sorted(self.pending)],
+                "model_switches_last_hour": self.switches_last_hour(),
+                "workers": [{"name": executor.name, "checkpoint": executor.checkpoint, "busy": executor in self.running} for executor in self.executors],
+            }
+
+
+job_queue = JobQueue(
+    max_size=shared.cmd_opts.api_queue_size,
+    batch_window=shared.cmd_opts.api_batch_window,
+    max_batch_size=shared.cmd_opts.api_max_batch_size,
+    executors=gpu_pool.create_executors() if gpu_pool.enabled() else None,
+    affinity_limit=shared.cmd_opts.api_affinity_limit,
+)
+
+
+async def run_in_queue(func, priority=0, id_task=None, batch_key=None, payload=None, image_ready_callback=None, checkpoint=None, vae=None):
+    """
+    Submits func to the GPU worker and waits for its result without blocking the event loop.
+    Responds with 429 when the queue is full so clients can back off and retry.
+    """
+    try:
+        job = job_queue.submit(func, priority=priority, id_task=id_task, batch_key=batch_key, payload=payload,
+                               image_ready_callback=image_ready_callback, checkpoint=checkpoint, vae=vae)
+    except QueueFullError as e:
+        raise HTTPException(status_code=429, detail=str(e))
+    except NoWorkersError as e:
+        raise HTTPException(status_code=503, detail=str(e))
+
+    return await asyncio.wrap_future(job.future)
@@ -0,0 +1,191 @@
+"""Push-based progress for queued jobs"""
+import asyncio
+import base64
+import io
+import json
+import time
+
+import numpy as np
+import torch
+from PIL import Image
+from starlette.concurrency import run_in_threadpool
+
+from app.api.services.job_queue import job_queue
+from app.logger.logger import configure_logging
+from app.ml.modules import progress, sd_vae_approx, shared
+from app.ml.modules.shared import opts
+
+logger = configure_logging(__name__)
+
+
+class ProgressStream:
+    """
+    Fans progress of jobs out to any number of subscribers. A single loop builds one message per
+    watched job each refresh period and every subscriber of that job gets the same serialized message,
+    so the cost does not grow with the number of clients. Live previews are made from the current
+    latent with sd_vae_approx.cheap_approximation and encoded once per new id_live_preview.
+    """
+
+    def __init__(self):
+        self.subscribers = {}
+        # the last message sent for every job, and whether it was the job's final one
+        self.last_messages = {}
+        self.last_preview_ids = {}
+        self.task = None
+        self.preview_step = -1
+        self.preview_job_timestamp = None
+        self.preview = (-1, None)
+
+    def subscribe(self, id_task):
+        queue = asyncio.Queue(maxsize=4)
+        self.subscribers.setdefault(id_task, set()).add(queue)
+
+        if id_task in self.last_messages:
+            message, finished = self.last_messages[id_task]
+            publish(queue, message)
+            if finished:
+                publish(queue, None)
+
+        if self.task is None or self.task.done():
+            self.task = asyncio.ensure_future(self.run())
+
+        return queue
+
+    def unsubscribe(self, id_task, queue):
+        queues = self.subscribers.get(id_task, set())
+        queues.discard(queue)
+
+        if not queues:
+            self.subscribers.pop(id_task, None)
+            self.last_messages.pop(id_task, None)
+            self.last_preview_ids.pop(id_task, None)
+
+    async def run(self):
+        while self.subscribers:
+            try:
+                messages = await run_in_threadpool(self.build_messages, list(self.subscribers))
+            except Exception as e:
+                logger.error(f"Error building progress messages: {e}")
+                messages = {}
+
+            for id_task, (message, finished) in messages.items():
+                if message == self.last_messages.get(id_task, (None, False))[0]:
+                    continue
+
+                self.last_messages[id_task] = (message, finished)
+                for queue in list(self.subscribers.get(id_task, [])):
+                    publish(queue, message)
+                    if finished:
+                        publish(queue, None)
+
+            await asyncio.sleep(max(opts.live_preview_refresh_period, 50) / 1000)
+
+    def build_messages(self, ids):
+        preview_id, preview = self.update_preview()
+        res = {}
+
+        for id_task in ids:
+            data = self.job_progress(id_task)
+            finished = data["completed"]
+
+            if data["active"] and preview is not None and preview_id != self.last_preview_ids.get(id_task, None):
+                self.last_preview_ids[id_task] = preview_id
+                data["id_live_preview"] = preview_id
+                data["live_preview"] = preview
+
+            res[id_task] = (json.dumps(data), finished)
+
+        return res
+
+    def job_progress(self, id_task):
+        job = job_queue.get(id_task)
+        status = job.status() if job is not None else None
+
+        active = id_task == progress.current_task or status == "running"
+        queued = status == "queued" or id_task in progress.pending_tasks
+        completed = status in ("succeeded", "failed", "cancelled") or (id_task in progress.finished_tasks and not active)
+
+        data = {
+            "id_task": id_task,
+            "status": status,
+            "active": active,
+            "queued": queued,
+            "completed": completed,
+            "progress": None,
+            "eta": None,
+            "sampling_step": None,
+            "sampling_steps": None,
+            "queue_position": None,
+            "textinfo": "In queue..." if queued else None,
+        }
+
+        if queued:
+            waiting = job_queue.dict()["queued"]
+            data["queue_position"] = waiting.index(id_task) if id_task in waiting else None
+
+        if not active:
+            return data
+
+        state = shared.state
+        job_count, job_no = state.job_count, state.job_no
+        sampling_steps, sampling_step = state.sampling_steps, state.sampling_step
+
+        fraction = 0
+        if job_count > 0:
+            fraction += job_no / job_count
+        if sampling_steps > 0 and job_count > 0:
+            fraction += 1 / job_count * sampling_step / sampling_steps
+        fraction = min(fraction, 1)
+
+        elapsed_since_start = time.time() - state.time_start if state.time_start is not None else 0
+        predicted_duration = elapsed_since_start / fraction if fraction > 0 else None
+
+        data["progress"] = fraction
+        data["eta"] = predicted_duration - elapsed_since_start if predicted_duration is not None else None
+        data["sampling_step"] = sampling_step
+        data["sampling_steps"] = sampling_steps
+        data["textinfo"] = state.textinfo
+
+        return data
+
+    def update_preview(self):
+        """makes a new preview from the current latent every show_progress_every_n_steps steps; returns (id_live_preview, data uri)"""
+
+        state = shared.state
+        latent = state.current_latent
+        if latent is None or not opts.live_previews_enable or opts.show_progress_every_n_steps <= 0:
+            return self.preview
+
+        if state.job_timestamp != self.preview_job_timestamp:
+            self.preview_job_timestamp = state.job_timestamp
+            self.preview_step = -1
+
+        if self.preview_step >= 0 and state.sampling_step - self.preview_step < opts.show_progress_every_n_steps:
+            return self.preview
+
+        with torch.no_grad():
+            x_sample = sd_vae_approx.cheap_approximation(latent[0].float())
+            x_sample = torch.clamp((x_sample + 1.0) / 2.0, min=0.0, max=1.0)
+            x_sample = 255. * np.moveaxis(x_sample.cpu().numpy(), 0, 2)
+
+        image = Image.fromarray(x_sample.astype(np.uint8))
+        state.assign_current_image(image)
+
+        buffered = io.BytesIO()
+        image.save(buffered, format="png")
+
+        self.preview_step = state.sampling_step
+        self.preview = (state.id_live_preview, 'data:image/png;base64,' + base64.b64encode(buffered.getvalue()).decode("ascii"))
+
+        return self.preview
+
+
+def publish(queue, message):
+    """puts message into a subscriber's queue, dropping the oldest message if a slow client fell behind"""
+    if queue.full():
+        queue.get_nowait()
+
+    queue.put_nowait(message)
+
+
+progress_stream = ProgressStream()
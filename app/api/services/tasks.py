@@ -0,0 +1,42 @@
+"""GPU work behind the API routes, runnable in this process or in a GPU worker process"""
+from app.ml.modules import scripts, shared
+from app.ml.modules.processing import (StableDiffusionProcessingImg2Img,
+                                       process_images)
+from app.ml.modules.shared import opts
+
+
+def process_img2img(args, init_images, script_args, selectable_script_idx=None, image_ready_callback=None, profile=False):
+    """
+    Runs one img2img request. args are the StableDiffusionProcessingImg2Img arguments, script_args the
+    full argument list of the img2img script runner, and selectable_script_idx the index of the selectable
+    script to run, if any. With profile, the request is run under torch.profiler.
+    """
+    script_runner = scripts.scripts_img2img
+    if not script_runner.scripts:
+        script_runner.initialize_scripts(True)
+
+    p = StableDiffusionProcessingImg2Img(sd_model=shared.sd_model, **args)
+    p.init_images = init_images
+    p.scripts = script_runner
+    p.outpath_grids = opts.outdir_img2img_grids
+    p.outpath_samples = opts.outdir_img2img_samples
+    p.image_ready_callback = image_ready_callback
+    p.profile = profile
+
+    if selectable_script_idx is not None:
+        p.script_args = script_args
+        processed = scripts.scripts_img2img.run(
+            p, *p.script_args)  # Need to pass args as list here
+    else:
+        p.script_args = tuple(script_args)  # Need to pass args as tuple here
+        processed = process_images(p)
+
+    return processed
+
+
+def interrogate_image(image):
+    return shared.interrogator.interrogate(image)
+
+
+def interrogate_images(images):
+    return shared.interrogator.interrogate_batch(images)
@@ -0,0 +1,92 @@
+"""
+Per-step overhead of assembling CFGDenoiser input and combining guidance, without the UNet.
+
+    python -m app.benchmarks.cfg_denoiser --batch-size 4 --conds 3 --steps 50
+
+Compares the list comprehensions CFGDenoiser used before with CFGPlan, which is made once per run.
+"""
+import argparse
+import time
+
+import torch
+
+from app.ml.modules.sd_samplers_kdiffusion import CFGPlan
+
+
+def assemble_with_lists(x, sigma, image_cond, conds_list):
+    repeats = [len(conds) for conds in conds_list]
+    x_in = torch.cat([torch.stack([x[i] for _ in range(n)]) for i, n in enumerate(repeats)] + [x])
+    sigma_in = torch.cat([torch.stack([sigma[i] for _ in range(n)]) for i, n in enumerate(repeats)] + [sigma])
+    image_cond_in = torch.cat([torch.stack([image_cond[i] for _ in range(n)]) for i, n in enumerate(repeats)] + [image_cond])
+
+    return x_in, sigma_in, image_cond_in
+
+
+def combine_with_lists(x_out, conds_list, batch_size, cond_scale):
+    denoised_uncond = x_out[-batch_size:]
+    denoised = torch.clone(denoised_uncond)
+
+    for i, conds in enumerate(conds_list):
+        for cond_index, weight in conds:
+            denoised[i] += (x_out[cond_index] - denoised_uncond[i]) * (weight * cond_scale)
+
+    return denoised
+
+
+def run_lists(x, sigma, image_cond, x_out, conds_list, steps):
+    for _ in range(steps):
+        assemble_with_lists(x, sigma, image_cond, conds_list)
+        combine_with_lists(x_out, conds_list, x.shape[0], 7.0)
+
+
+def run_plan(x, sigma, image_cond, x_out, conds_list, steps):
+    plan = CFGPlan(conds_list, x.device)
+
+    for _ in range(steps):
+        torch.cat([plan.repeat(x), x])
+        torch.cat([plan.repeat(sigma), sigma])
+        torch.cat([plan.repeat(image_cond), image_cond])
+        plan.combine(x_out, x_out[-x.shape[0]:], 7.0)
+
+
+def measure(func, device, *args):
+    func(*args)  # warm up
+
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+    start = time.perf_counter()
+    func(*args)
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--batch-size", type=int, default=4)
+    parser.add_argument("--conds", type=int, default=3, help="AND-sub-conds per prompt")
+    parser.add_argument("--steps", type=int, default=50)
+    parser.add_argument("--width", type=int, default=512)
+    parser.add_argument("--height", type=int, default=512)
+    parser.add_argument("--device", type=str, default="cuda" if torch.cuda.is_available() else "cpu")
+    args = parser.parse_args()
+
+    device = torch.device(args.device)
+    shape = (4, args.height // 8, args.width // 8)
+
+    conds_list = [[(i * args.conds + j, 1.0 / args.conds) for j in range(args.conds)] for i in range(args.batch_size)]
+    cond_rows = args.batch_size * args.conds
+
+    x = torch.randn(args.batch_size, *shape, device=device)
+    sigma = torch.rand(args.batch_size, device=device)
+    image_cond = torch.randn(args.batch_size, 5, *shape[1:], device=device)
+    x_out = torch.randn(cond_rows + args.batch_size, *shape, device=device)
+
+    for name, func in [("lists", run_lists), ("plan", run_plan)]:
+        elapsed = measure(func, device, x, sigma, image_cond, x_out, conds_list, args.steps)
+        print(f"{name:>6}: {elapsed / args.steps * 1000:.3f} ms per step ({elapsed:.3f}s for {args.steps} steps)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,105 @@
+"""
+Cost of finding textual inversion embeddings in tokenized prompts, with made-up token ids and no model.
+
+    python -m app.benchmarks.embedding_matcher --embeddings 500 --prompts 200
+
+Compares the per-first-token candidate lists EmbeddingDatabase used before, which were re-sorted on every
+registration and compared to the prompt by slicing, with EmbeddingTrie, both for building the tables and for
+matching every position of every prompt the way tokenize_line does.
+"""
+import argparse
+import random
+import time
+
+from app.ml.modules.textual_inversion.token_trie import EmbeddingTrie
+
+
+def build_lists(embeddings_with_ids):
+    ids_lookup = {}
+
+    for ids, embedding in embeddings_with_ids:
+        first_id = ids[0]
+        if first_id not in ids_lookup:
+            ids_lookup[first_id] = []
+
+        ids_lookup[first_id] = sorted(ids_lookup[first_id] + [(ids, embedding)], key=lambda x: len(x[0]), reverse=True)
+
+    return ids_lookup
+
+
+def match_lists(ids_lookup, tokens):
+    matches = []
+
+    for offset, token in enumerate(tokens):
+        found = None, None
+
+        for ids, embedding in ids_lookup.get(token, ()):
+            if tokens[offset:offset + len(ids)] == ids:
+                found = embedding, len(ids)
+                break
+
+        matches.append(found)
+
+    return matches
+
+
+def make_data(args, rng):
+    """
+    Embedding names of 1 to --max-name-tokens tokens, many sharing their first tokens the way names with common
+    prefixes do, and prompts of random tokens with --embeddings-per-prompt names in them.
+    """
+
+    prefixes = [[rng.randrange(args.vocab)] for _ in range(max(args.embeddings // 8, 1))]
+    names = []
+    for i in range(args.embeddings):
+        prefix = rng.choice(prefixes)
+        names.append((prefix + [rng.randrange(args.vocab) for _ in range(rng.randrange(args.max_name_tokens))], f"embedding-{i}"))
+
+    prompts = []
+    for _ in range(args.prompts):
+        tokens = [rng.randrange(args.vocab) for _ in range(args.prompt_tokens)]
+        for _ in range(args.embeddings_per_prompt):
+            ids, _ = rng.choice(names)
+            position = rng.randrange(len(tokens))
+            tokens[position:position] = ids
+        prompts.append(tokens)
+
+    return names, prompts
+
+
+def measure(func, *args):
+    start = time.perf_counter()
+    result = func(*args)
+
+    return time.perf_counter() - start, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--embeddings", type=int, default=500)
+    parser.add_argument("--max-name-tokens", type=int, default=6)
+    parser.add_argument("--prompts", type=int, default=200)
+    parser.add_argument("--prompt-tokens", type=int, default=150, help="tokens of every prompt besides embedding names")
+    parser.add_argument("--embeddings-per-prompt", type=int, default=3)
+    parser.add_argument("--vocab", type=int, default=49408, help="token ids are drawn from range(vocab)")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    names, prompts = make_data(args, random.Random(args.seed))
+    tokens_total = sum(len(tokens) for tokens in prompts)
+
+    build_time_lists, ids_lookup = measure(build_lists, names)
+    build_time_trie, trie = measure(EmbeddingTrie, names)
+
+    match_time_lists, matches_lists = measure(lambda: [match_lists(ids_lookup, tokens) for tokens in prompts])
+    match_time_trie, matches_trie = measure(lambda: [trie.match_all(tokens) for tokens in prompts])
+
+    assert matches_lists == matches_trie, "the matchers disagree"
+
+    print(f"{len(names)} embeddings, {len(prompts)} prompts of {tokens_total / len(prompts):.0f} tokens on average")
+    for name, build_time, match_time in [("lists", build_time_lists, match_time_lists), ("trie", build_time_trie, match_time_trie)]:
+        print(f"{name:>6}: build {build_time * 1000:.3f} ms, match {match_time / tokens_total * 1e6:.3f} us per token ({match_time * 1000:.3f} ms in all)")
+
+
+if __name__ == "__main__":
+    main()
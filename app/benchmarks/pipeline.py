@@ -0,0 +1,380 @@
+"""
+End-to-end CPU benchmark of the generation pipeline on a tiny random-weight checkpoint; needs no GPU and no downloads.
+
+    python -m app.benchmarks.pipeline --output bench.json
+    python -m app.benchmarks.pipeline --baseline bench.json --tolerance 0.25
+
+Times the prompt parser, text conditioning, mask/crop preparation, CFGDenoiser steps, process_images, output
+image encoding and the img2img API route, and reports for every benchmark the median, min and max time of
+--repeat runs, the peak of Python allocations during one more run, and the process's peak RSS afterwards.
+process_images and the route also report the time spent per stage and per sampler step, from the metrics
+the pipeline records anyway. With --baseline, medians are compared to an earlier report and the exit
+status is 1 if any benchmark got slower by more than --tolerance.
+
+Timings measure pipeline overhead around tiny models, so they are only comparable between runs on the same
+machine, and say little about the time a real checkpoint spends in the UNet.
+"""
+import argparse
+import base64
+import io
+import json
+import os
+import platform
+import resource
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+from PIL import Image
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--output", type=str, default=None, help="write the JSON report to this file instead of stdout")
+    parser.add_argument("--baseline", type=str, default=None, help="JSON report of an earlier run to compare with")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="allowed slowdown against the baseline, as a fraction")
+    parser.add_argument("--only", type=str, default=None, help="comma-separated names of benchmarks to run")
+    parser.add_argument("--repeat", type=int, default=5, help="timed runs of every benchmark")
+    parser.add_argument("--steps", type=int, default=8, help="sampling steps")
+    parser.add_argument("--batch-size", type=int, default=2)
+    parser.add_argument("--width", type=int, default=64)
+    parser.add_argument("--height", type=int, default=64)
+    parser.add_argument("--mask-size", type=int, default=2048, help="side of the mask for the mask benchmark")
+    parser.add_argument("--workdir", type=str, default=None, help="directory for the tiny checkpoint and outputs; a temporary one by default")
+
+    return parser.parse_args()
+
+
+def setup(args, workdir):
+    """
+    Points the command line of the app at workdir and the CPU, writes the tiny checkpoint there and loads it
+    the way the server does. Must run before anything imports app.ml.modules.shared.
+    """
+    ckpt_dir = os.path.join(workdir, "models", "Stable-diffusion")
+
+    sys.argv = [sys.argv[0], "--data-dir", workdir, "--ckpt-dir", ckpt_dir, "--ckpt", os.path.join(ckpt_dir, "tiny-sd.safetensors"),
+                "--use-cpu", "all", "--no-half", "--precision", "full", "--no-download-sd-model", "--skip-version-check"]
+
+    from app.benchmarks import tiny_model
+    from app.ml.modules import shared
+
+    tiny_model.write_checkpoint(ckpt_dir, os.path.join(workdir, "clip"))
+
+    from app.ml.modules import sd_models, sd_vae
+
+    shared.opts.live_previews_enable = False
+    shared.opts.samples_save = False
+    shared.opts.grid_save = False
+
+    started = time.perf_counter()
+    sd_models.setup_model()
+    sd_vae.refresh_vae_list()
+    sd_models.load_model()
+
+    return time.perf_counter() - started
+
+
+def stage_counts():
+    """count and total time of every pipeline stage and sampler step recorded so far in this process"""
+    from app.ml.modules import metrics
+
+    res = {}
+    for name, metric in [("stage", metrics.stage_duration), ("step", metrics.sampling_step)]:
+        for key, (counts, total) in metric.snapshot().items():
+            res[f"{name}:{key[0]}"] = (sum(counts), total)
+
+    return res
+
+
+def stage_means(before, after):
+    res = {}
+    for key, (count, total) in after.items():
+        count_before, total_before = before.get(key, (0, 0))
+        if count > count_before:
+            res[key] = (total - total_before) / (count - count_before)
+
+    return res
+
+
+def measure(run, repeat):
+    run()  # warm up; also fills lazily created state such as sampler plans
+
+    before = stage_counts()
+    times = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        run()
+        times.append(time.perf_counter() - started)
+    stages = stage_means(before, stage_counts())
+
+    tracemalloc.start()
+    try:
+        run()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    res = {
+        "median": statistics.median(times),
+        "min": min(times),
+        "max": max(times),
+        "runs": repeat,
+        "python_alloc_peak_bytes": peak,
+        "max_rss_bytes": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+    }
+    if stages:
+        res["stages"] = stages
+
+    return res
+
+
+def test_image(width, height, seed=0):
+    """a smooth image with some noise, so encoders and the VAE see something like a photo"""
+    rng = np.random.default_rng(seed)
+    y, x = np.mgrid[0:height, 0:width]
+    base = np.stack([x / max(width - 1, 1), y / max(height - 1, 1), (x + y) / max(width + height - 2, 1)], axis=-1) * 255
+    noise = rng.normal(0, 8, size=base.shape)
+
+    return Image.fromarray(np.clip(base + noise, 0, 255).astype(np.uint8))
+
+
+def test_mask(width, height):
+    mask = np.zeros((height, width), dtype=np.uint8)
+    mask[height // 4:height // 2, width // 3:width * 2 // 3] = 255
+
+    return Image.fromarray(mask)
+
+
+prompts = [
+    "a (photo:1.2) of a [red:blue:0.5] room, ((wooden floor)), large windows",
+    "a modern kitchen AND a garden:0.5, [sunset|night], detailed",
+    "living room, [[minimalist]], white walls, plants, 4k, (soft light:0.8)",
+]
+negative_prompt = "blurry, (lowres:1.3), text"
+
+
+def bench_prompt_parser(args):
+    from app.ml.modules import prompt_parser
+
+    def run():
+        prompt_parser.get_learned_conditioning_prompt_schedules(prompts, args.steps)
+        for prompt in prompts:
+            prompt_parser.parse_prompt_attention(prompt)
+
+    return run
+
+
+def bench_conditioning(args):
+    from app.ml.modules import caching, devices, prompt_parser, shared
+
+    def run():
+        # every run encodes the prompts again instead of taking them from the conditioning cache
+        caching.invalidate("model")
+        with devices.autocast():
+            prompt_parser.get_learned_conditioning(shared.sd_model, [negative_prompt] * len(prompts), args.steps)
+            prompt_parser.get_multicond_learned_conditioning(shared.sd_model, prompts, args.steps)
+
+    return run
+
+
+def bench_mask(args):
+    from PIL import ImageFilter
+
+    from app.ml.modules import masking
+
+    mask = test_mask(args.mask_size, args.mask_size)
+
+    def run():
+        blurred = mask.filter(ImageFilter.GaussianBlur(4))
+        crop_region = masking.get_crop_region(np.asarray(blurred), 32)
+        crop_region = masking.expand_crop_region(crop_region, args.width, args.height, blurred.width, blurred.height)
+        cropped = blurred.crop(crop_region).resize((args.width, args.height))
+        masking.overlay_masks(cropped)
+        masking.latent_mask(cropped, args.width // 8, args.height // 8)
+
+    return run
+
+
+def bench_cfg_denoiser(args):
+    import torch
+
+    from app.ml.modules import devices, prompt_parser, sd_samplers, shared
+
+    sampler = sd_samplers.create_sampler("Euler", shared.sd_model)
+    denoiser = sampler.model_wrap_cfg
+    batch_prompts = (prompts * args.batch_size)[:args.batch_size]
+
+    with devices.autocast(), torch.no_grad():
+        uncond = prompt_parser.get_learned_conditioning(shared.sd_model, [negative_prompt] * args.batch_size, args.steps)
+        cond = prompt_parser.get_multicond_learned_conditioning(shared.sd_model, batch_prompts, args.steps)
+
+    generator = torch.Generator().manual_seed(0)
+    x = torch.randn(args.batch_size, 4, args.height // 8, args.width // 8, generator=generator).to(shared.device)
+    sigmas = sampler.model_wrap.get_sigmas(args.steps).to(shared.device)
+    image_cond = x.new_zeros(args.batch_size, 5, 1, 1)
+
+    def run():
+        denoiser.plan = None
+        with devices.autocast(), torch.no_grad():
+            for step in range(args.steps):
+                denoiser.step = step
+                denoiser(x, sigmas[step].expand(args.batch_size), uncond=uncond, cond=cond, cond_scale=7.0, image_cond=image_cond)
+
+    return run
+
+
+def img2img_args(args):
+    return {
+        "prompt": prompts[0],
+        "negative_prompt": negative_prompt,
+        "seed": 1,
+        "sampler_name": "Euler a",
+        "steps": args.steps,
+        "batch_size": args.batch_size,
+        "width": args.width,
+        "height": args.height,
+        "denoising_strength": 0.75,
+        "do_not_save_samples": True,
+        "do_not_save_grid": True,
+    }
+
+
+def bench_process_images(args):
+    from app.ml.modules import shared
+    from app.ml.modules.processing import StableDiffusionProcessingImg2Img, process_images
+
+    init_image = test_image(args.width, args.height)
+    mask = test_mask(args.width, args.height)
+
+    def run():
+        p = StableDiffusionProcessingImg2Img(sd_model=shared.sd_model, init_images=[init_image], mask=mask, **img2img_args(args))
+        process_images(p)
+
+    return run
+
+
+def bench_image_encode(args):
+    from app.api.helpers.image_encoding import encode_image
+
+    image = test_image(512, 512)
+    image.info["parameters"] = prompts[0]
+
+    def run():
+        for format in ("png", "jpeg", "webp"):
+            encode_image(image, format=format)
+
+    return run
+
+
+def bench_api_img2img(args):
+    from fastapi import FastAPI
+    from fastapi.testclient import TestClient
+
+    from app.api.routes.api import app as api_router
+    from app.core.config import API_PREFIX
+
+    application = FastAPI()
+    application.include_router(api_router, prefix=API_PREFIX)
+    client = TestClient(application)
+
+    buffer = io.BytesIO()
+    test_image(args.width, args.height).save(buffer, format="PNG")
+    request = dict(img2img_args(args), init_images=[base64.b64encode(buffer.getvalue()).decode()], sampler_index="Euler a")
+    for key in ("do_not_save_samples", "do_not_save_grid"):
+        request.pop(key)
+
+    def run():
+        response = client.post(f"{API_PREFIX}/img2img/", json=request)
+        if response.status_code != 200:
+            raise RuntimeError(f"img2img route failed with {response.status_code}: {response.text}")
+
+    return run
+
+
+benchmarks = [
+    ("prompt_parser", bench_prompt_parser),
+    ("conditioning", bench_conditioning),
+    ("mask", bench_mask),
+    ("cfg_denoiser", bench_cfg_denoiser),
+    ("process_images", bench_process_images),
+    ("image_encode", bench_image_encode),
+    ("api_img2img", bench_api_img2img),
+]
+
+
+def compare(report, baseline, tolerance):
+    """prints how every benchmark's median changed against baseline; returns the names of those that got too slow"""
+    regressions = []
+
+    for name, result in report["benchmarks"].items():
+        previous = baseline.get("benchmarks", {}).get(name, None)
+        if previous is None:
+            print(f"{name:>16}: {result['median'] * 1000:10.2f} ms (not in baseline)", file=sys.stderr)
+            continue
+
+        ratio = result["median"] / previous["median"] if previous["median"] > 0 else float("inf")
+        slower = ratio > 1 + tolerance
+        if slower:
+            regressions.append(name)
+
+        print(f"{name:>16}: {result['median'] * 1000:10.2f} ms, baseline {previous['median'] * 1000:10.2f} ms, {ratio:6.2f}x{'  REGRESSION' if slower else ''}", file=sys.stderr)
+
+    return regressions
+
+
+def main():
+    args = parse_args()
+
+    only = set(args.only.split(",")) if args.only else None
+    unknown = (only or set()) - {name for name, _ in benchmarks}
+    if unknown:
+        raise SystemExit(f"Unknown benchmarks: {', '.join(sorted(unknown))}")
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        workdir = os.path.abspath(args.workdir or tmpdir)
+        load_time = setup(args, workdir)
+
+        import torch
+
+        report = {
+            "environment": {
+                "python": platform.python_version(),
+                "torch": torch.__version__,
+                "machine": platform.machine(),
+                "processor": platform.processor(),
+                "threads": torch.get_num_threads(),
+            },
+            "settings": {key: getattr(args, key) for key in ("repeat", "steps", "batch_size", "width", "height", "mask_size")},
+            "load_model_seconds": load_time,
+            "benchmarks": {},
+        }
+
+        for name, bench in benchmarks:
+            if only is not None and name not in only:
+                continue
+
+            print(f"Running {name}...", file=sys.stderr)
+            report["benchmarks"][name] = measure(bench(args), args.repeat)
+
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf8") as file:
+            file.write(text)
+    else:
+        print(text)
+
+    if args.baseline:
+        with open(args.baseline, "r", encoding="utf8") as file:
+            baseline = json.load(file)
+
+        regressions = compare(report, baseline, args.tolerance)
+        if regressions:
+            print(f"Slower than the baseline by more than {args.tolerance:.0%}: {', '.join(regressions)}", file=sys.stderr)
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
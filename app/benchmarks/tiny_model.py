@@ -0,0 +1,112 @@
+"""
+A miniature Stable Diffusion 1.x checkpoint with random weights: the v1 inference config with a small UNet,
+VAE and CLIP text model, and a character-level CLIP tokenizer, all written to a local directory so nothing
+is downloaded. Images it makes are noise, but every code path of a real checkpoint runs, on CPU in seconds.
+"""
+import json
+import os
+
+import torch
+from omegaconf import OmegaConf
+
+checkpoint_name = "tiny-sd"
+
+unet_params = {
+    "model_channels": 32,
+    "attention_resolutions": [1],
+    "num_res_blocks": 1,
+    "channel_mult": [1, 2],
+    "num_heads": 2,
+    "context_dim": 32,
+    "use_checkpoint": False,
+}
+
+# four levels keep the VAE's downscale factor at 8, which processing assumes
+vae_params = {
+    "ch": 32,
+    "ch_mult": [1, 1, 1, 1],
+    "num_res_blocks": 1,
+    "resolution": 64,
+}
+
+clip_params = {
+    "hidden_size": 32,
+    "intermediate_size": 64,
+    "num_hidden_layers": 2,
+    "num_attention_heads": 2,
+    "max_position_embeddings": 77,
+}
+
+
+def write_clip(directory):
+    """
+    Writes a random CLIP text model and a tokenizer whose vocabulary has only the byte-level characters
+    of the real one, so prompts are tokenized one character per token.
+    """
+    from transformers import CLIPTextConfig, CLIPTextModel, CLIPTokenizer
+    from transformers.models.clip.tokenization_clip import bytes_to_unicode
+
+    os.makedirs(directory, exist_ok=True)
+
+    chars = list(bytes_to_unicode().values())
+    tokens = chars + [char + "</w>" for char in chars] + ["<|startoftext|>", "<|endoftext|>"]
+    vocab = {token: i for i, token in enumerate(tokens)}
+
+    vocab_file = os.path.join(directory, "vocab.json")
+    merges_file = os.path.join(directory, "merges.txt")
+    with open(vocab_file, "w", encoding="utf8") as file:
+        json.dump(vocab, file)
+    with open(merges_file, "w", encoding="utf8") as file:
+        file.write("#version: 0.2\n")
+
+    tokenizer = CLIPTokenizer(vocab_file, merges_file, model_max_length=clip_params["max_position_embeddings"])
+    tokenizer.save_pretrained(directory)
+
+    config = CLIPTextConfig(
+        vocab_size=len(vocab),
+        bos_token_id=vocab["<|startoftext|>"],
+        eos_token_id=vocab["<|endoftext|>"],
+        pad_token_id=vocab["<|endoftext|>"],
+        **clip_params,
+    )
+    CLIPTextModel(config).save_pretrained(directory)
+
+
+def make_config(clip_dir):
+    from app.ml.modules import sd_models_config
+
+    config = OmegaConf.load(sd_models_config.config_default)
+
+    return OmegaConf.merge(config, {
+        "model": {
+            "params": {
+                "unet_config": {"params": unet_params},
+                "first_stage_config": {"params": {"ddconfig": vae_params}},
+                "cond_stage_config": {"params": {"version": clip_dir}},
+            }
+        }
+    })
+
+
+def write_checkpoint(directory, clip_dir, seed=0):
+    """
+    Writes checkpoint_name.safetensors with random weights to directory, with its config next to it as
+    checkpoint_name.yaml so sd_models picks that config when loading it. Returns the checkpoint's path.
+    """
+    import safetensors.torch
+    from ldm.util import instantiate_from_config
+
+    os.makedirs(directory, exist_ok=True)
+    write_clip(clip_dir)
+
+    config = make_config(clip_dir)
+    OmegaConf.save(config, os.path.join(directory, checkpoint_name + ".yaml"))
+
+    torch.manual_seed(seed)
+    model = instantiate_from_config(config.model)
+    state_dict = {key: value.detach().clone().contiguous() for key, value in model.state_dict().items()}
+
+    filename = os.path.join(directory, checkpoint_name + ".safetensors")
+    safetensors.torch.save_file(state_dict, filename)
+
+    return filename
@@ -60,8 +60,10 @@ from app.api.errors import errors
 from app.api.errors.http_error import http_error_handler
 from app.api.errors.validation_error import http422_error_handler
 from app.api.helpers import extensions, localization
+from app.api.services import gpu_pool
+from app.api.services.job_queue import job_queue
 from app.core.config import ALLOWED_HOSTS, API_PREFIX, DEBUG, PROJECT_NAME, VERSION
-from app.ml.modules import modelloader, script_callbacks, shared, timer
+from app.ml.modules import metrics, modelloader, progress, script_callbacks, shared, timer
 from app.ml.modules.call_queue import wrap_queued_call
 from app.ml.modules.shared import cmd_opts
 
@@ -164,21 +166,27 @@ def initialize():
     # app.ml.modules.textual_inversion.textual_inversion.list_textual_inversion_templates()
     # startup_timer.record("refresh textual inversion templates")
 
-    try:
-        app.ml.modules.sd_models.load_model()
-    except Exception as e:
-        errors.display(e, "loading stable diffusion model")
-        print("", file=sys.stderr)
-        print("Stable diffusion model failed to load, exiting", file=sys.stderr)
-        exit(1)
-    startup_timer.record("load SD checkpoint")
-
-    shared.opts.data["sd_model_checkpoint"] = shared.sd_model.sd_checkpoint_info.title
-
-    shared.opts.onchange(
-        "sd_model_checkpoint",
-        wrap_queued_call(lambda: app.ml.modules.sd_models.reload_model_weights()),
-    )
+    if gpu_pool.enabled():
+        # every GPU worker loads its own copy of the checkpoint; this process only serves requests
+        job_queue.start()
+        startup_timer.record("start GPU workers")
+    else:
+        try:
+            app.ml.modules.sd_models.load_model()
+        except Exception as e:
+            errors.display(e, "loading stable diffusion model")
+            print("", file=sys.stderr)
+            print("Stable diffusion model failed to load, exiting", file=sys.stderr)
+            exit(1)
+        startup_timer.record("load SD checkpoint")
+
+        with app.ml.modules.sd_models.checkpoints_lock:
+            shared.opts.data["sd_model_checkpoint"] = shared.sd_model.sd_checkpoint_info.title
+
+        shared.opts.onchange(
+            "sd_model_checkpoint",
+            wrap_queued_call(lambda: app.ml.modules.sd_models.reload_model_weights()),
+        )
     shared.opts.onchange(
         "sd_vae",
         wrap_queued_call(lambda: app.ml.modules.sd_vae.reload_vae_weights()),
@@ -220,7 +228,12 @@ def initialize():
     signal.signal(signal.SIGINT, sigint_handler)
 
 
-initialize()
+# children spawned for the image encoding pool run this file again as __mp_main__ before they get any work;
+# only GPU workers, which serve jobs with their own model, should start up like the server does
+is_pool_process = __name__ == "__mp_main__" and not gpu_pool.is_worker_process()
+
+if not is_pool_process:
+    initialize()
 
 
 def get_application() -> FastAPI:
@@ -243,6 +256,8 @@ def get_application() -> FastAPI:
     application.add_exception_handler(RequestValidationError, http422_error_handler)
 
     application.include_router(api_router, prefix=API_PREFIX)
+    progress.setup_progress_api(application)
+    metrics.setup_metrics_api(application)
 
     application.mount(
         "/static", StaticFiles(directory="app/frontend/static"), name="static"
@@ -257,7 +272,8 @@ def get_application() -> FastAPI:
     return application
 
 
-app = get_application()
+if not is_pool_process:
+    app = get_application()
 
 if __name__ == "__main__":
     import uvicorn
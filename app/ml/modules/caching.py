@@ -0,0 +1,85 @@
+"""Size-bounded in-memory caches that live for the whole process and are shared between requests"""
+import threading
+from collections import OrderedDict
+
+from app.ml.modules import metrics
+
+caches = {}
+
+
+class LRUCache:
+    """
+    Thread-safe least-recently-used cache. maxsize is either a number or a function returning one,
+    so the limit can follow a setting; a limit of 0 disables caching. Caches are registered by name,
+    and invalidate_on lists the events (see invalidate()) that empty them.
+    """
+
+    def __init__(self, name, maxsize, invalidate_on=()):
+        self.name = name
+        self.maxsize = maxsize
+        self.invalidate_on = set(invalidate_on)
+        self.data = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+        caches[name] = self
+
+    def limit(self):
+        return int(self.maxsize() if callable(self.maxsize) else self.maxsize)
+
+    def get(self, key, default=None):
+        with self.lock:
+            hit = key in self.data
+            if hit:
+                self.data.move_to_end(key)
+                self.hits += 1
+                value = self.data[key]
+            else:
+                self.misses += 1
+                value = default
+
+        metrics.record_cache_lookup(self.name, hit)
+
+        return value
+
+    def put(self, key, value):
+        limit = self.limit()
+
+        with self.lock:
+            if limit <= 0:
+                self.data.clear()
+                return
+
+            self.data[key] = value
+            self.data.move_to_end(key)
+
+            while len(self.data) > limit:
+                self.data.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.data.clear()
+
+    def __len__(self):
+        return len(self.data)
+
+    def stats(self):
+        return {
+            "size": len(self.data),
+            "limit": self.limit(),
+            "hits": self.hits,
+            "misses": self.misses,
+        }
+
+
+def invalidate(event):
+    """empties every cache registered with this event in its invalidate_on, e.g. "model" or "embeddings"."""
+
+    for cache in list(caches.values()):
+        if event in cache.invalidate_on:
+            cache.clear()
+
+
+def stats():
+    return {name: cache.stats() for name, cache in caches.items()}
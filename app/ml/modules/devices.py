@@ -65,6 +65,11 @@ def torch_gc():
             torch.cuda.ipc_collect()
 
 
+def is_out_of_memory(e):
+    """True for the errors torch raises when an allocation on the device fails"""
+    return isinstance(e, RuntimeError) and "out of memory" in str(e).lower()
+
+
 def enable_tf32():
     if torch.cuda.is_available():
 
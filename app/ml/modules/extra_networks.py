@@ -2,6 +2,7 @@ import re
 from collections import defaultdict
 
 from app.api.errors import errors
+from app.ml.modules import caching, prompt_parser
 
 extra_network_registry = {}
 
@@ -118,6 +119,11 @@ re_extra_net = re.compile(r"<(\w+):([^>]+)>")
 
 
 def parse_prompt(prompt):
+    cached = prompt_cache.get(prompt, None)
+    if cached is not None:
+        updated_prompt, res = cached
+        return updated_prompt, defaultdict(list, {name: list(params) for name, params in res.items()})
+
     res = defaultdict(list)
 
     def found(m):
@@ -128,9 +134,13 @@ def parse_prompt(prompt):
 
         return ""
 
-    prompt = re.sub(re_extra_net, found, prompt)
+    updated_prompt = re.sub(re_extra_net, found, prompt)
+    prompt_cache.put(prompt, (updated_prompt, {name: tuple(params) for name, params in res.items()}))
+
+    return updated_prompt, res
+
 
-    return prompt, res
+prompt_cache = caching.LRUCache("extra network prompts", prompt_parser.parse_cache_size)
 
 
 def parse_prompts(prompts):
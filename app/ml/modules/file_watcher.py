@@ -0,0 +1,143 @@
+"""Calls a function from a background thread when files under some directories change: on inotify events on Linux, by polling elsewhere"""
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+import sys
+import threading
+import time
+import traceback
+
+# inotify events for files and directories being added, removed, renamed or finished writing
+IN_ATTRIB = 0x4
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_FROM = 0x40
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_DELETE_SELF = 0x400
+IN_MOVE_SELF = 0x800
+IN_IGNORED = 0x8000
+
+watch_mask = IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF
+
+event_header = struct.Struct("iIII")
+
+
+class Inotify:
+    """The inotify API of Linux through ctypes; raises OSError where it is not available."""
+
+    def __init__(self):
+        if not sys.platform.startswith("linux"):
+            raise OSError("inotify is only available on Linux")
+
+        self.libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        self.fd = self.libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+
+        self.paths = {}
+
+    def watch(self, path):
+        if path in self.paths.values():
+            return
+
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), watch_mask)
+        if wd < 0:
+            raise OSError(ctypes.get_errno(), f"inotify_add_watch failed for {path}")
+
+        self.paths[wd] = path
+
+    def wait(self, timeout):
+        """waits up to timeout seconds for events and reads all that came; returns False if there were none"""
+
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return False
+
+        while True:
+            try:
+                data = os.read(self.fd, 65536)
+            except BlockingIOError:
+                break
+
+            offset = 0
+            while offset < len(data):
+                wd, mask, _, length = event_header.unpack_from(data, offset)
+                offset += event_header.size + length
+
+                # the directory is gone, so it has to be watched again if it comes back
+                if mask & IN_IGNORED:
+                    self.paths.pop(wd, None)
+
+        return True
+
+    def close(self):
+        os.close(self.fd)
+
+
+class DirectoryWatcher:
+    """
+    Calls on_change from a background thread once at the start and then whenever files under the directories
+    returned by get_paths may have changed, subdirectories included; on_change finds out what changed by itself.
+    With inotify it waits for events, letting bursts of them settle for settle_time seconds, and also calls
+    on_change every rescan_interval seconds to notice directories created after it started. Without inotify
+    it calls on_change every poll_interval seconds.
+    """
+
+    def __init__(self, name, get_paths, on_change, poll_interval=5, rescan_interval=60, settle_time=0.5):
+        self.name = name
+        self.get_paths = get_paths
+        self.on_change = on_change
+        self.poll_interval = poll_interval
+        self.rescan_interval = rescan_interval
+        self.settle_time = settle_time
+        self.thread = None
+        self.lock = threading.Lock()
+
+    def start(self):
+        with self.lock:
+            if self.thread is not None:
+                return
+
+            self.thread = threading.Thread(target=self.run, name=self.name, daemon=True)
+            self.thread.start()
+
+    def watch_all(self, inotify):
+        for path in self.get_paths():
+            if not os.path.isdir(path):
+                continue
+
+            for root, _, _ in os.walk(path, followlinks=True):
+                inotify.watch(root)
+
+    def call(self):
+        try:
+            self.on_change()
+        except Exception:
+            print(f"Error in {self.name}:", file=sys.stderr)
+            print(traceback.format_exc(), file=sys.stderr)
+
+    def run(self):
+        try:
+            inotify = Inotify()
+        except OSError:
+            inotify = None
+
+        while True:
+            if inotify is not None:
+                try:
+                    self.watch_all(inotify)
+                except OSError as e:
+                    print(f"{self.name} can't use inotify ({e}); checking for changes every {self.poll_interval}s instead", file=sys.stderr)
+                    inotify.close()
+                    inotify = None
+
+            self.call()
+
+            if inotify is None:
+                time.sleep(self.poll_interval)
+            elif inotify.wait(self.rescan_interval):
+                while inotify.wait(self.settle_time):
+                    pass
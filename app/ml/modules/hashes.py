@@ -1,6 +1,10 @@
+import atexit
 import hashlib
 import json
 import os.path
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
 
 import filelock
 
@@ -10,82 +14,186 @@ from app.ml.modules.paths import data_path
 
 cache_filename = os.path.join(data_path, "cache.json")
 cache_data = None
+cache_lock = threading.RLock()
 
+# cache.json is written once writes stop coming for this many seconds, instead of after every new hash
+dump_cache_delay = 5
+dump_cache_after = None
+dump_cache_thread = None
+
+hashing_pool = None
+hashing_futures = {}
+
+
+def write_cache():
+    with cache_lock:
+        data = json.dumps(cache_data, indent=4)
 
-def dump_cache():
     with filelock.FileLock(cache_filename+".lock"):
-        with open(cache_filename, "w", encoding="utf8") as file:
-            json.dump(cache_data, file, indent=4)
+        with open(cache_filename + ".tmp", "w", encoding="utf8") as file:
+            file.write(data)
+
+        os.replace(cache_filename + ".tmp", cache_filename)
+
+
+def dump_cache():
+    """schedules writing cache.json; writes that come in quick succession are done together"""
+
+    global dump_cache_after, dump_cache_thread
+
+    def thread_func():
+        global dump_cache_after, dump_cache_thread
+
+        while True:
+            with cache_lock:
+                if time.time() >= dump_cache_after:
+                    dump_cache_after = None
+                    dump_cache_thread = None
+                    break
+
+            time.sleep(1)
+
+        write_cache()
+
+    with cache_lock:
+        dump_cache_after = time.time() + dump_cache_delay
+        if dump_cache_thread is None:
+            dump_cache_thread = threading.Thread(target=thread_func, name="cache.json writer", daemon=True)
+            dump_cache_thread.start()
+
+
+@atexit.register
+def flush_cache():
+    """writes cache.json right away if a write is still scheduled"""
+
+    global dump_cache_after
+
+    with cache_lock:
+        pending = dump_cache_after is not None
+        dump_cache_after = 0
+
+    if pending:
+        write_cache()
 
 
 def cache(subsection):
+    """the dict of a section of cache.json; it is shared with other threads, so read and change it only while holding cache_lock"""
+
     global cache_data
 
-    if cache_data is None:
-        with filelock.FileLock(cache_filename+".lock"):
-            if not os.path.isfile(cache_filename):
-                cache_data = {}
-            else:
-                with open(cache_filename, "r", encoding="utf8") as file:
-                    cache_data = json.load(file)
+    with cache_lock:
+        if cache_data is None:
+            with filelock.FileLock(cache_filename+".lock"):
+                if not os.path.isfile(cache_filename):
+                    cache_data = {}
+                else:
+                    with open(cache_filename, "r", encoding="utf8") as file:
+                        cache_data = json.load(file)
 
-    s = cache_data.get(subsection, {})
-    cache_data[subsection] = s
+        s = cache_data.get(subsection, {})
+        cache_data[subsection] = s
 
     return s
 
 
 def calculate_sha256(filename):
     hash_sha256 = hashlib.sha256()
-    blksize = 1024 * 1024
+    blksize = 16 * 1024 * 1024
 
-    with open(filename, "rb") as f:
-        for chunk in iter(lambda: f.read(blksize), b""):
-            hash_sha256.update(chunk)
+    # one reused buffer; hashlib and reads both release the GIL for blocks this size
+    buffer = bytearray(blksize)
+    view = memoryview(buffer)
+
+    with open(filename, "rb", buffering=0) as f:
+        while True:
+            size = f.readinto(buffer)
+            if not size:
+                break
+
+            hash_sha256.update(view[:size])
 
     return hash_sha256.hexdigest()
 
 
+def file_stat(filename):
+    stat = os.stat(filename)
+
+    return {"mtime": stat.st_mtime, "size": stat.st_size, "inode": stat.st_ino}
+
+
 def sha256_from_cache(filename, title):
     hashes = cache("hashes")
-    ondisk_mtime = os.path.getmtime(filename)
 
-    if title not in hashes:
+    with cache_lock:
+        entry = hashes.get(title, None)
+
+    if entry is None or entry.get("sha256", None) is None:
         return None
 
-    cached_sha256 = hashes[title].get("sha256", None)
-    cached_mtime = hashes[title].get("mtime", 0)
+    ondisk = file_stat(filename)
+
+    # entries written before size and inode were recorded are only checked by mtime
+    if "size" not in entry:
+        return entry["sha256"] if ondisk["mtime"] <= entry.get("mtime", 0) else None
 
-    if ondisk_mtime > cached_mtime or cached_sha256 is None:
+    if any(entry.get(key, None) != value for key, value in ondisk.items()):
         return None
 
-    return cached_sha256
+    return entry["sha256"]
 
 
-def sha256(filename, title):
-    hashes = cache("hashes")
+def get_hashing_pool():
+    global hashing_pool
 
-    sha256_value = sha256_from_cache(filename, title)
-    if sha256_value is not None:
-        return sha256_value
+    with cache_lock:
+        if hashing_pool is None:
+            hashing_pool = ThreadPoolExecutor(max_workers=shared.cmd_opts.hashing_workers, thread_name_prefix="sha256")
 
-    if shared.cmd_opts.no_hashing:
-        return None
+        return hashing_pool
+
+
+def calculate_and_store_sha256(filename, title):
+    ondisk = file_stat(filename)
 
-    print(f"Calculating sha256 for {filename}: ", end='')
+    print(f"Calculating sha256 for {filename}")
     sha256_value = calculate_sha256(filename)
-    print(f"{sha256_value}")
+    print(f"sha256 for {filename}: {sha256_value}")
 
-    hashes[title] = {
-        "mtime": os.path.getmtime(filename),
-        "sha256": sha256_value,
-    }
+    hashes = cache("hashes")
+    with cache_lock:
+        hashes[title] = dict(ondisk, sha256=sha256_value)
 
     dump_cache()
 
     return sha256_value
 
 
+def sha256_async(filename, title):
+    """
+    Starts hashing filename in a background thread and returns a concurrent.futures.Future for the hash;
+    its result is None with --no-hashing. A file that is already being hashed under title is not read twice.
+    """
+    sha256_value = sha256_from_cache(filename, title)
+    if sha256_value is not None or shared.cmd_opts.no_hashing:
+        future = Future()
+        future.set_result(sha256_value)
+        return future
 
+    with cache_lock:
+        future = hashing_futures.get(title, None)
+        if future is None:
+            future = get_hashing_pool().submit(calculate_and_store_sha256, filename, title)
+            hashing_futures[title] = future
+            future.add_done_callback(lambda _: forget_future(title, future))
 
+    return future
 
+
+def forget_future(title, future):
+    with cache_lock:
+        if hashing_futures.get(title, None) is future:
+            del hashing_futures[title]
+
+
+def sha256(filename, title):
+    return sha256_async(filename, title).result()
@@ -1,3 +1,5 @@
+import hashlib
+import json
 import os
 import re
 import sys
@@ -5,18 +7,22 @@ import traceback
 from collections import namedtuple
 from pathlib import Path
 
+import numpy as np
 import torch
 import torch.hub
 from torchvision import transforms
 from torchvision.transforms.functional import InterpolationMode
 from app.api.errors import errors
 
-from app.ml.modules import devices, lowvram, modelloader, paths, shared
+from app.ml.modules import devices, model_residency, modelloader, paths, shared
 
 blip_image_eval_size = 384
 clip_model_name = 'ViT-L/14'
 
-Category = namedtuple("Category", ["name", "topn", "items"])
+Category = namedtuple("Category", ["name", "topn", "items", "content_hash"])
+
+# normalized CLIP text features of category lines, one matrix per category and clip model
+features_dir = os.path.join(paths.models_path, "interrogate", "features")
 
 re_topn = re.compile(r"\.top(\d+)\.")
 
@@ -54,10 +60,25 @@ class InterrogateModels:
 
     def __init__(self, content_dir):
         self.loaded_categories = None
+        self.loaded_features = {}
         self.skip_categories = []
         self.content_dir = content_dir
         self.running_on_cpu = devices.device_interrogate == torch.device("cpu")
 
+        def keep():
+            return shared.opts.interrogate_keep_models_in_memory
+
+        # load() loads them from disk again after model_residency drops them to stay within the RAM budget
+        def unload_blip(module):
+            self.blip_model = None
+
+        def unload_clip(module):
+            self.clip_model = None
+            self.clip_preprocess = None
+
+        model_residency.manager.register("interrogate_blip", lambda: self.blip_model, lambda: devices.device_interrogate, keep=keep, unload=unload_blip)
+        model_residency.manager.register("interrogate_clip", lambda: self.clip_model, lambda: devices.device_interrogate, keep=keep, unload=unload_clip)
+
     def categories(self):
         if not os.path.exists(self.content_dir):
             download_default_clip_interrogate_categories(self.content_dir)
@@ -79,8 +100,10 @@ class InterrogateModels:
                 with open(filename, "r", encoding="utf8") as file:
                     lines = [x.strip() for x in file.readlines()]
 
+                content_hash = hashlib.sha256("\n".join(lines).encode("utf8")).hexdigest()
+
                 self.loaded_categories.append(
-                    Category(name=filename.stem, topn=topn, items=lines))
+                    Category(name=filename.stem, topn=topn, items=lines, content_hash=content_hash))
 
         return self.loaded_categories
 
@@ -111,15 +134,11 @@ class InterrogateModels:
     def load_clip_model(self):
         import clip
 
-        if self.running_on_cpu:
-            model, preprocess = clip.load(
-                clip_model_name, device="cpu", download_root=shared.cmd_opts.clip_models_path)
-        else:
-            model, preprocess = clip.load(
-                clip_model_name, download_root=shared.cmd_opts.clip_models_path)
+        # loaded into RAM; model_residency moves it to the device once there is room for it
+        model, preprocess = clip.load(
+            clip_model_name, device="cpu", download_root=shared.cmd_opts.clip_models_path)
 
         model.eval()
-        model = model.to(devices.device_interrogate)
 
         return model, preprocess
 
@@ -129,14 +148,12 @@ class InterrogateModels:
             if not shared.cmd_opts.no_half and not self.running_on_cpu:
                 self.blip_model = self.blip_model.half()
 
-        self.blip_model = self.blip_model.to(devices.device_interrogate)
-
         if self.clip_model is None:
             self.clip_model, self.clip_preprocess = self.load_clip_model()
             if not shared.cmd_opts.no_half and not self.running_on_cpu:
                 self.clip_model = self.clip_model.half()
 
-        self.clip_model = self.clip_model.to(devices.device_interrogate)
+        model_residency.manager.require("interrogate_blip", "interrogate_clip")
 
         self.dtype = next(self.clip_model.parameters()).dtype
 
@@ -151,87 +168,168 @@ class InterrogateModels:
                 self.blip_model = self.blip_model.to(devices.cpu)
 
     def unload(self):
-        self.send_clip_to_ram()
-        self.send_blip_to_ram()
+        # models stay on the device until model_residency needs the room for something else, except with lowvram/medvram:
+        # there the sd_model entry only counts the part of the model on the device, so it would never evict them
+        if shared.cmd_opts.lowvram or shared.cmd_opts.medvram:
+            self.send_clip_to_ram()
+            self.send_blip_to_ram()
 
         devices.torch_gc()
 
-    def rank(self, image_features, text_array, top_count=1):
+    def encode_texts(self, texts, batch_size=256):
         import clip
 
-        devices.torch_gc()
-
+        res = []
+        for i in range(0, len(texts), batch_size):
+            text_tokens = clip.tokenize(texts[i:i + batch_size], truncate=True).to(devices.device_interrogate)
+            text_features = self.clip_model.encode_text(text_tokens).type(self.dtype)
+            text_features /= text_features.norm(dim=-1, keepdim=True)
+            res.append(text_features.float().cpu().numpy())
+
+        return np.concatenate(res) if res else np.zeros((0, self.clip_model.text_projection.shape[1]), dtype=np.float32)
+
+    def category_features(self, category):
+        """
+        Returns normalized CLIP text features of every line of category as a tensor on the interrogate device.
+        Features are stored on disk per category and clip model; when the category file changes, only its
+        new lines are encoded.
+        """
+        loaded = self.loaded_features.get(category.name, None)
+        if loaded is not None and loaded[0] == category.content_hash:
+            return loaded[1]
+
+        basename = os.path.join(features_dir, f"{category.name}-{clip_model_name.replace('/', '-')}")
+        matrix = None
+        info = {}
+
+        if os.path.exists(basename + ".json") and os.path.exists(basename + ".npy"):
+            try:
+                with open(basename + ".json", "r", encoding="utf8") as file:
+                    info = json.load(file)
+                matrix = np.load(basename + ".npy", mmap_mode="c")
+            except Exception as e:
+                errors.display(e, f"loading CLIP features for {category.name}")
+                info, matrix = {}, None
+
+        if matrix is None or info.get("hash", None) != category.content_hash:
+            rows = {line: i for i, line in enumerate(info.get("lines", []))} if matrix is not None else {}
+            missing = [line for line in dict.fromkeys(category.items) if line not in rows]
+
+            print(f"Encoding {len(missing)} CLIP texts for {category.name}")
+            encoded = self.encode_texts(missing)
+            rows_new = {line: i for i, line in enumerate(missing)}
+
+            matrix = np.stack([matrix[rows[line]] if line in rows else encoded[rows_new[line]] for line in category.items]) if category.items else encoded
+
+            os.makedirs(features_dir, exist_ok=True)
+            with open(basename + ".npy.tmp", "wb") as file:
+                np.save(file, matrix.astype(np.float32))
+            with open(basename + ".json.tmp", "w", encoding="utf8") as file:
+                json.dump({"model": clip_model_name, "hash": category.content_hash, "lines": category.items}, file)
+            os.replace(basename + ".npy.tmp", basename + ".npy")
+            os.replace(basename + ".json.tmp", basename + ".json")
+
+        text_features = torch.from_numpy(np.ascontiguousarray(matrix)).to(devices.device_interrogate, dtype=self.dtype)
+        self.loaded_features[category.name] = (category.content_hash, text_features)
+
+        return text_features
+
+    def ranking_features(self, text_array, text_features=None):
         if shared.opts.interrogate_clip_dict_limit != 0:
             text_array = text_array[0:int(shared.opts.interrogate_clip_dict_limit)]
 
+        if text_features is None:
+            text_features = torch.from_numpy(self.encode_texts(text_array)).to(devices.device_interrogate, dtype=self.dtype)
+
+        return text_array, text_features[0:len(text_array)]
+
+    def rank(self, image_features, text_array, top_count=1, text_features=None):
+        """
+        Returns the top_count lines of text_array that match image_features best, with their scores. text_features
+        are the normalized features of text_array, as returned by category_features; they are encoded if not given.
+        """
+        devices.torch_gc()
+
+        text_array, text_features = self.ranking_features(text_array, text_features)
         top_count = min(top_count, len(text_array))
-        text_tokens = clip.tokenize([text for text in text_array], truncate=True).to(
-            devices.device_interrogate)
-        text_features = self.clip_model.encode_text(text_tokens).type(self.dtype)
-        text_features /= text_features.norm(dim=-1, keepdim=True)
 
-        similarity = torch.zeros((1, len(text_array))).to(devices.device_interrogate)
-        for i in range(image_features.shape[0]):
-            similarity += (100.0 * image_features[i].unsqueeze(0)
-                           @ text_features.T).softmax(dim=-1)
-        similarity /= image_features.shape[0]
+        similarity = (100.0 * image_features @ text_features.T).softmax(dim=-1).float().mean(dim=0, keepdim=True)
 
         top_probs, top_labels = similarity.cpu().topk(top_count, dim=-1)
         return [(text_array[top_labels[0][i].numpy()], (top_probs[0][i].numpy() * 100)) for i in range(top_count)]
 
-    def generate_caption(self, pil_image):
-        gpu_image = transforms.Compose([
+    def rank_batch(self, image_features, text_array, top_count=1, text_features=None):
+        """same as rank, but every row of image_features is a separate image; returns a list of matches per image"""
+
+        text_array, text_features = self.ranking_features(text_array, text_features)
+        top_count = min(top_count, len(text_array))
+
+        similarity = (100.0 * image_features @ text_features.T).softmax(dim=-1).float()
+
+        top_probs, top_labels = similarity.cpu().topk(top_count, dim=-1)
+        return [[(text_array[top_labels[j][i].numpy()], (top_probs[j][i].numpy() * 100)) for i in range(top_count)] for j in range(image_features.shape[0])]
+
+    def generate_captions(self, pil_images):
+        transform = transforms.Compose([
             transforms.Resize((blip_image_eval_size, blip_image_eval_size),
                               interpolation=InterpolationMode.BICUBIC),
             transforms.ToTensor(),
             transforms.Normalize((0.48145466, 0.4578275, 0.40821073),
                                  (0.26862954, 0.26130258, 0.27577711))
-        ])(pil_image).unsqueeze(0).type(self.dtype).to(devices.device_interrogate)
+        ])
+        gpu_images = torch.stack([transform(pil_image) for pil_image in pil_images]).type(self.dtype).to(devices.device_interrogate)
 
         with torch.no_grad():
-            caption = self.blip_model.generate(gpu_image, sample=False, num_beams=shared.opts.interrogate_clip_num_beams,
-                                               min_length=shared.opts.interrogate_clip_min_length, max_length=shared.opts.interrogate_clip_max_length)
+            captions = self.blip_model.generate(gpu_images, sample=False, num_beams=shared.opts.interrogate_clip_num_beams,
+                                                min_length=shared.opts.interrogate_clip_min_length, max_length=shared.opts.interrogate_clip_max_length)
 
-        return caption[0]
+        return captions
+
+    def generate_caption(self, pil_image):
+        return self.generate_captions([pil_image])[0]
 
     def interrogate(self, pil_image):
-        res = ""
+        return self.interrogate_batch([pil_image])[0]
+
+    def interrogate_batch(self, pil_images):
+        """
+        Captions pil_images with BLIP and appends the best matching lines of every category, returning one
+        result per image in input order. Images go through BLIP and CLIP interrogate_batch_size at a time.
+        """
+        res = [""] * len(pil_images)
+        batch_size = max(1, int(shared.opts.interrogate_batch_size))
+        batches = [(i, pil_images[i:i + batch_size]) for i in range(0, len(pil_images), batch_size)]
+
         shared.state.begin()
         shared.state.job = 'interrogate'
         try:
-            if shared.cmd_opts.lowvram or shared.cmd_opts.medvram:
-                lowvram.send_everything_to_cpu()
-                devices.torch_gc()
-
             self.load()
 
-            caption = self.generate_caption(pil_image)
-            self.send_blip_to_ram()
-            devices.torch_gc()
-
-            res = caption
-
-            clip_image = self.clip_preprocess(pil_image).unsqueeze(
-                0).type(self.dtype).to(devices.device_interrogate)
+            for i, batch in batches:
+                res[i:i + len(batch)] = self.generate_captions(batch)
 
             with torch.no_grad(), devices.autocast():
-                image_features = self.clip_model.encode_image(
-                    clip_image).type(self.dtype)
+                categories = [(category, self.category_features(category)) for category in self.categories()]
+
+                for i, batch in batches:
+                    clip_images = torch.stack([self.clip_preprocess(pil_image) for pil_image in batch]).type(self.dtype).to(devices.device_interrogate)
 
-                image_features /= image_features.norm(dim=-1, keepdim=True)
+                    image_features = self.clip_model.encode_image(clip_images).type(self.dtype)
+                    image_features /= image_features.norm(dim=-1, keepdim=True)
 
-                for name, topn, items in self.categories():
-                    matches = self.rank(image_features, items, top_count=topn)
-                    for match, score in matches:
-                        if shared.opts.interrogate_return_ranks:
-                            res += f", ({match}:{score/100:.3f})"
-                        else:
-                            res += ", " + match
+                    for category, text_features in categories:
+                        all_matches = self.rank_batch(image_features, category.items, top_count=category.topn, text_features=text_features)
+                        for j, matches in enumerate(all_matches):
+                            for match, score in matches:
+                                if shared.opts.interrogate_return_ranks:
+                                    res[i + j] += f", ({match}:{score/100:.3f})"
+                                else:
+                                    res[i + j] += ", " + match
 
         except Exception:
             print("Error interrogating", file=sys.stderr)
             print(traceback.format_exc(), file=sys.stderr)
-            res += "<error>"
+            res = [x + "<error>" for x in res]
 
         self.unload()
         shared.state.end()
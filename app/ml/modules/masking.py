@@ -1,35 +1,23 @@
+import numpy as np
 from PIL import Image, ImageFilter, ImageOps
 
 
 def get_crop_region(mask, pad=0):
     """finds a rectangular region that contains all masked ares in an image. Returns (x1, y1, x2, y2) coordinates of the rectangle.
     For example, if a user has painted the top-right part of a 512x512 image", the result may be (256, 0, 512, 256)"""
-    
+
+    mask = np.asarray(mask)
     h, w = mask.shape
 
-    crop_left = 0
-    for i in range(w):
-        if not (mask[:, i] == 0).all():
-            break
-        crop_left += 1
-
-    crop_right = 0
-    for i in reversed(range(w)):
-        if not (mask[:, i] == 0).all():
-            break
-        crop_right += 1
-
-    crop_top = 0
-    for i in range(h):
-        if not (mask[i] == 0).all():
-            break
-        crop_top += 1
-
-    crop_bottom = 0
-    for i in reversed(range(h)):
-        if not (mask[i] == 0).all():
-            break
-        crop_bottom += 1
+    cols = np.flatnonzero(mask.any(axis=0))
+    rows = np.flatnonzero(mask.any(axis=1))
+
+    if len(cols) == 0:
+        # nothing is masked: every column and row counts as empty from both sides
+        crop_left, crop_right, crop_top, crop_bottom = w, w, h, h
+    else:
+        crop_left, crop_right = cols[0], w - 1 - cols[-1]
+        crop_top, crop_bottom = rows[0], h - 1 - rows[-1]
 
     return (
         int(max(crop_left-pad, 0)),
@@ -97,3 +85,25 @@ def fill(image, mask):
 
     return image_mod.convert("RGB")
 
+
+
+def overlay_masks(mask):
+    """for the 'L' mask used on full images, returns the mask with its edges made fully opaque, and its inverse used to paste the
+    unmasked parts of source images on top of results, both as 'L' images made in one pass"""
+
+    np_mask = np.asarray(mask)
+    np_mask = np.where(np_mask >= 128, 255, np_mask * 2).astype(np.uint8)
+
+    return Image.fromarray(np_mask), Image.fromarray(255 - np_mask)
+
+
+def latent_mask(mask, width, height):
+    """mask resized to the latent size and rounded to 0 or 1 as a float32 array of shape (height, width);
+    colored masks are taken by their red channel"""
+
+    if mask.mode != 'L':
+        mask = mask.convert('RGB').getchannel('R')
+
+    np_mask = np.asarray(mask.resize((width, height)))
+
+    return (np_mask >= 128).astype(np.float32)
@@ -0,0 +1,209 @@
+"""Counters and latency histograms of request handling, served in the Prometheus text format"""
+import contextlib
+import math
+import threading
+import time
+
+from fastapi.responses import PlainTextResponse
+
+content_type = "text/plain; version=0.0.4; charset=utf-8"
+
+latency_buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+step_buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
+batch_buckets = (1, 2, 4, 8, 16, 32)
+
+
+def format_value(value):
+    if value == math.inf:
+        return "+Inf"
+
+    return repr(float(value))
+
+
+def format_labels(names, values):
+    if not names:
+        return ""
+
+    escaped = [str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n") for value in values]
+    return "{" + ",".join(f'{name}="{value}"' for name, value in zip(names, escaped)) + "}"
+
+
+class Metric:
+    """
+    A metric with a value per combination of labels. Values are kept in plain dicts so a registry can be
+    pickled and sent from a GPU worker process to the server, which shows it next to its own values.
+    """
+
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"{self.name} needs labels {self.labelnames}, got {tuple(labels)}")
+
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def snapshot(self):
+        with self.lock:
+            return {key: self.copy_value(value) for key, value in self.values.items()}
+
+    def copy_value(self, value):
+        return value
+
+    def samples(self, values, extra_names=(), extra_values=()):
+        names = extra_names + self.labelnames
+        for key, value in sorted(values.items()):
+            yield f"{self.name}{format_labels(names, extra_values + key)} {format_value(value)}"
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def set(self, value, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = value
+
+    def set_max(self, value, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = max(self.values.get(key, value), value)
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=latency_buckets):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets) + (math.inf, )
+
+    def observe(self, value, **labels):
+        key = self.key(labels)
+        with self.lock:
+            counts, total = self.values.get(key, (None, 0))
+            if counts is None:
+                counts = [0] * len(self.buckets)
+
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+                    break
+
+            self.values[key] = (counts, total + value)
+
+    @contextlib.contextmanager
+    def time(self, **labels):
+        """observes the time spent in the with block, also when it raises"""
+
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def copy_value(self, value):
+        counts, total = value
+        return list(counts), total
+
+    def samples(self, values, extra_names=(), extra_values=()):
+        names = extra_names + self.labelnames
+        for key, (counts, total) in sorted(values.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                yield f"{self.name}_bucket{format_labels(names + ('le', ), extra_values + key + (format_value(bound), ))} {format_value(cumulative)}"
+
+            yield f"{self.name}_sum{format_labels(names, extra_values + key)} {format_value(total)}"
+            yield f"{self.name}_count{format_labels(names, extra_values + key)} {format_value(cumulative)}"
+
+
+class Registry:
+    """
+    All metrics of this process, plus the last snapshot received from every GPU worker process;
+    values of a worker are shown with a worker label.
+    """
+
+    def __init__(self):
+        self.metrics = {}
+        self.workers = {}
+        self.lock = threading.Lock()
+
+    def add(self, metric):
+        self.metrics[metric.name] = metric
+        return metric
+
+    def snapshot(self):
+        return {name: metric.snapshot() for name, metric in self.metrics.items()}
+
+    def update_worker(self, worker, snapshot):
+        with self.lock:
+            self.workers[worker] = snapshot
+
+    def render(self):
+        with self.lock:
+            workers = dict(self.workers)
+
+        lines = []
+        for name, metric in self.metrics.items():
+            lines.append(f"# HELP {name} {metric.documentation}")
+            lines.append(f"# TYPE {name} {metric.kind}")
+            lines.extend(metric.samples(metric.snapshot()))
+
+            for worker, snapshot in sorted(workers.items()):
+                lines.extend(metric.samples(snapshot.get(name, {}), ("worker", ), (worker, )))
+
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+queue_wait = registry.add(Histogram("sd_queue_wait_seconds", "Time jobs waited in the queue before a worker took them."))
+jobs = registry.add(Counter("sd_jobs_total", "Finished jobs by outcome: succeeded, failed or cancelled.", ["status"]))
+batch_size = registry.add(Histogram("sd_batch_size", "Number of requests run together in one job.", buckets=batch_buckets))
+stage_duration = registry.add(Histogram("sd_stage_duration_seconds", "Time spent in each stage of a request: image_decode, init, conditioning, sampling, vae_decode, postprocess and response_encode.", ["stage"]))
+sampling_step = registry.add(Histogram("sd_sampling_step_seconds", "Time between sampler steps.", ["sampler"], buckets=step_buckets))
+cache_requests = registry.add(Counter("sd_cache_requests_total", "Lookups in in-memory caches by result: hit or miss.", ["cache", "result"]))
+model_loads = registry.add(Counter("sd_model_loads_total", "Weights loaded into the model, counting every switch of checkpoint or VAE.", ["kind"]))
+model_switches = registry.add(Counter("sd_model_switches_total", "Jobs that ran with a different checkpoint or VAE than the job before them on the same worker."))
+checkpoint_switch = registry.add(Histogram("sd_checkpoint_switch_seconds", "Time taken to switch checkpoints by where the new one came from: hot (kept on the device), warm (state dict in RAM) or cold (file).", ["tier"]))
+checkpoints_cached = registry.add(Gauge("sd_checkpoints_cached", "Checkpoints kept loaded besides the current one: hot on the device, warm in RAM.", ["tier"]))
+memory_peak = registry.add(Gauge("sd_memory_peak_bytes", "GPU memory peaks of the last job, as measured by the memory monitor.", ["stat"]))
+memory_peak_max = registry.add(Gauge("sd_memory_peak_max_bytes", "Highest GPU memory peaks of any job since the start.", ["stat"]))
+
+memory_peak_stats = ("active_peak", "reserved_peak", "system_peak")
+
+
+def record_cache_lookup(cache, hit):
+    cache_requests.inc(cache=cache, result="hit" if hit else "miss")
+
+
+def record_memory(data):
+    """stores peaks from MemUsageMonitor.stop() of a finished job"""
+
+    for stat in memory_peak_stats:
+        if stat in data:
+            memory_peak.set(data[stat], stat=stat)
+            memory_peak_max.set_max(data[stat], stat=stat)
+
+
+def metricsapi():
+    return PlainTextResponse(registry.render(), media_type=content_type)
+
+
+def setup_metrics_api(app):
+    return app.add_api_route("/metrics", metricsapi, methods=["GET"], response_class=PlainTextResponse)
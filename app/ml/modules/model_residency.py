@@ -0,0 +1,245 @@
+"""Which models are on their compute device, and moving them there within a memory budget"""
+import threading
+import time
+
+import torch
+
+from app.logger.logger import configure_logging
+from app.ml.modules import devices
+
+logger = configure_logging(__name__)
+
+mb = 1024 * 1024
+
+
+def module_size(module):
+    if module is None:
+        return 0
+
+    return sum(t.numel() * t.element_size() for t in module.parameters()) + sum(t.numel() * t.element_size() for t in module.buffers())
+
+
+def same_device(a, b):
+    a, b = torch.device(a), torch.device(b)
+    if a.type != b.type:
+        return False
+
+    return a.index is None or b.index is None or a.index == b.index
+
+
+class ResidentModel:
+    """
+    A model tracked by ResidencyManager. get_module returns the module or None if it is not loaded at all;
+    load and offload move it to its device and back to RAM, is_resident and size override how residency
+    and memory use are found out, and keep returns True while the model must not be evicted. unload, if
+    given, drops the module altogether to free RAM; the owner loads it again when it is needed.
+    """
+
+    def __init__(self, name, get_module, device, load=None, offload=None, is_resident=None, size=None, keep=None, unload=None):
+        self.name = name
+        self.get_module = get_module
+        self.device = device
+        self.load_func = load
+        self.offload_func = offload
+        self.is_resident_func = is_resident
+        self.size_func = size
+        self.keep = keep or (lambda: False)
+        self.unload_func = unload
+
+        self.uses = 0
+        self.loads = 0
+        self.evictions = 0
+        self.bytes_moved = 0
+        self.last_used = 0
+
+    def loaded(self):
+        return self.get_module() is not None
+
+    def resident(self):
+        if self.is_resident_func is not None:
+            return self.is_resident_func()
+
+        module = self.get_module()
+        if module is None:
+            return False
+
+        param = next(module.parameters(), None)
+        return param is not None and same_device(param.device, self.device())
+
+    def in_ram(self):
+        return self.loaded() and (torch.device(self.device()).type == "cpu" or not self.resident())
+
+    def size(self):
+        return self.size_func() if self.size_func is not None else module_size(self.get_module())
+
+    def load(self):
+        module = self.get_module()
+        if self.load_func is not None:
+            self.load_func(module)
+        else:
+            module.to(self.device())
+
+        self.loads += 1
+        self.bytes_moved += self.size()
+
+    def offload(self):
+        size = self.size()
+        module = self.get_module()
+        if self.offload_func is not None:
+            self.offload_func(module)
+        else:
+            module.to(devices.cpu)
+
+        self.evictions += 1
+        self.bytes_moved += size
+
+    def unload(self):
+        self.unload_func(self.get_module())
+        self.evictions += 1
+
+    def stats(self):
+        return {
+            "name": self.name,
+            "device": str(self.device()),
+            "loaded": self.loaded(),
+            "resident": self.loaded() and self.resident(),
+            "size_mb": self.size() / mb,
+            "uses": self.uses,
+            "loads": self.loads,
+            "evictions": self.evictions,
+            "moved_mb": self.bytes_moved / mb,
+            "last_used": self.last_used or None,
+        }
+
+
+class ResidencyManager:
+    """
+    Keeps models on their devices for as long as they fit in the model_residency_budget, so switching
+    between img2img and interrogation does not move weights every time. A model is moved to its device
+    when require() is called for it; if that goes over budget, other models on the same device are
+    moved to RAM, least recently used first and, between equally recent ones, least often used first.
+    Models in RAM, whether moved there or running on the CPU, are kept within model_residency_ram_budget
+    the same way, by unloading those that can be.
+    """
+
+    def __init__(self):
+        self.models = {}
+        self.lock = threading.RLock()
+
+    def register(self, name, get_module, device, **kwargs):
+        """registers a model; device is a function returning the torch device the model runs on"""
+
+        with self.lock:
+            self.models[name] = ResidentModel(name, get_module, device, **kwargs)
+
+    def unregister(self, name):
+        with self.lock:
+            self.models.pop(name, None)
+
+    def ram_budget(self):
+        """bytes that models may use in RAM, or None if there is no limit"""
+
+        from app.ml.modules.shared import opts
+
+        return int(opts.model_residency_ram_budget * mb) if opts.model_residency_ram_budget > 0 else None
+
+    def budget(self, device):
+        """bytes that models may use on device, or None if there is no limit"""
+
+        from app.ml.modules.shared import opts
+
+        device = torch.device(device)
+        if device.type == "cpu":
+            return self.ram_budget()
+
+        if opts.model_residency_budget > 0:
+            return int(opts.model_residency_budget * mb)
+
+        if device.type != "cuda":
+            return None
+
+        total = torch.cuda.get_device_properties(device.index if device.index is not None else torch.cuda.current_device()).total_memory
+        return int(total * opts.model_residency_auto_fraction)
+
+    def require(self, *names):
+        """makes sure the named models are on their devices, evicting others if needed; unknown and unloaded models are skipped"""
+
+        with self.lock:
+            wanted = [self.models[name] for name in names if name in self.models and self.models[name].loaded()]
+
+            now = time.time()
+            for model in wanted:
+                model.uses += 1
+                model.last_used = now
+
+            for model in wanted:
+                if model.resident():
+                    continue
+
+                self.make_room(model.device(), model.size(), wanted)
+                model.load()
+
+            # models running on the CPU are always resident, so loading another one is what grows RAM use
+            self.make_room_in_ram(0, wanted)
+
+    def make_room(self, device, needed, keep=()):
+        """evicts models from device until needed more bytes fit in its budget; models moved to RAM may in turn be unloaded"""
+
+        with self.lock:
+            if torch.device(device).type == "cpu":
+                self.make_room_in_ram(needed, keep)
+                return
+
+            budget = self.budget(device)
+            if budget is None:
+                return
+
+            resident = [model for model in self.models.values() if model.loaded() and same_device(model.device(), device) and model.resident()]
+            used = sum(model.size() for model in resident)
+
+            candidates = [model for model in resident if model not in keep and not model.keep()]
+            candidates.sort(key=lambda model: (model.last_used, model.uses))
+
+            evicted = False
+            for model in candidates:
+                if used + needed <= budget:
+                    break
+
+                used -= model.size()
+                model.offload()
+                evicted = True
+
+            if evicted:
+                devices.torch_gc()
+                self.make_room_in_ram(0, keep)
+
+            if used + needed > budget:
+                logger.warning(f"Models need {(used + needed) / mb:.0f} MB on {device}, over the budget of {budget / mb:.0f} MB")
+
+    def make_room_in_ram(self, needed, keep=()):
+        budget = self.ram_budget()
+        if budget is None:
+            return
+
+        in_ram = [model for model in self.models.values() if model.in_ram()]
+        used = sum(model.size() for model in in_ram)
+
+        candidates = [model for model in in_ram if model.unload_func is not None and model not in keep and not model.keep()]
+        candidates.sort(key=lambda model: (model.last_used, model.uses))
+
+        for model in candidates:
+            if used + needed <= budget:
+                break
+
+            used -= model.size()
+            model.unload()
+
+        if used + needed > budget:
+            logger.warning(f"Models need {(used + needed) / mb:.0f} MB of RAM, over the budget of {budget / mb:.0f} MB")
+
+    def stats(self):
+        with self.lock:
+            return [model.stats() for model in self.models.values()]
+
+
+manager = ResidencyManager()
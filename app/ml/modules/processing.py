@@ -2,6 +2,7 @@ import json
 import math
 import os
 import sys
+import time
 
 import torch
 import numpy as np
@@ -13,8 +14,9 @@ from typing import Any, Dict, List
 
 import app.ml.modules.sd_hijack
 from app.api.helpers import generation_parameters_copypaste
-from app.ml.modules import devices, prompt_parser, masking, sd_samplers, lowvram, extra_networks, sd_vae_approx, scripts
+from app.ml.modules import devices, prompt_parser, masking, sd_samplers, lowvram, extra_networks, sd_vae_approx, scripts, rng, metrics, profiling
 from app.ml.modules.sd_hijack import model_hijack
+from app.ml.modules.sd_hijack_optimizations import get_available_vram
 from app.ml.modules.shared import opts, cmd_opts, state
 import app.ml.modules.shared as shared
 import app.ml.modules.paths as paths
@@ -155,6 +157,8 @@ class StableDiffusionProcessing:
             self.seed_resize_from_w = 0
 
         self.scripts = None
+        self.image_ready_callback = None
+        self.profile = False
         self.script_args = script_args
         self.all_prompts = None
         self.all_negative_prompts = None
@@ -375,74 +379,150 @@ def slerp(val, low, high):
 
 def create_random_tensors(shape, seeds, subseeds=None, subseed_strength=0.0, seed_resize_from_h=0, seed_resize_from_w=0, p=None):
     eta_noise_seed_delta = opts.eta_noise_seed_delta or 0
-    xs = []
+
+    noise_shape = shape if seed_resize_from_h <= 0 or seed_resize_from_w <= 0 else (
+        shape[0], seed_resize_from_h // 8, seed_resize_from_w // 8)
+
+    # randn results depend on device; gpu and cpu get different results for same seed;
+    # the way I see it, it's better to do this on CPU, so that everyone gets same result;
+    # but the original script had it like this, so I do not dare change it for now because
+    # it will break everyone's seeds. The Philox noise source gives the same results everywhere.
+    generator = rng.create_generator(seeds)
+    noise = generator.randn(noise_shape)
+
+    if subseeds is not None:
+        subnoise = rng.create_generator([0 if i >= len(subseeds) else subseeds[i] for i in range(len(seeds))]).randn(noise_shape)
+        noise = torch.stack([slerp(subseed_strength, x, subx) for x, subx in zip(noise, subnoise)])
+
+    if noise_shape != shape:
+        generator = rng.create_generator(seeds)
+        x = generator.randn(shape)
+        dx = (shape[2] - noise_shape[2]) // 2
+        dy = (shape[1] - noise_shape[1]) // 2
+        w = noise_shape[2] if dx >= 0 else noise_shape[2] + 2 * dx
+        h = noise_shape[1] if dy >= 0 else noise_shape[1] + 2 * dy
+        tx = 0 if dx < 0 else dx
+        ty = 0 if dy < 0 else dy
+        dx = max(-dx, 0)
+        dy = max(-dy, 0)
+
+        x[:, :, ty:ty + h, tx:tx + w] = noise[:, :, dy:dy + h, dx:dx + w]
+        noise = x
+
+    # code that still uses the global generator continues from the last seed, like it did when seeds were set with torch.manual_seed
+    generator.set_global_state()
 
     # if we have multiple seeds, this means we are working with batch size>1; this then
     # enables the generation of additional tensors with noise that the sampler will use during its processing.
-    # Using those pre-generated tensors instead of simple torch.randn allows a batch with seeds [100, 101] to
-    # produce the same images as with two batches [100], [101].
+    # Using those tensors instead of simple torch.randn allows a batch with seeds [100, 101] to
+    # produce the same images as with two batches [100], [101]. They are made one step at a time as the sampler needs them.
     if p is not None and p.sampler is not None and (len(seeds) > 1 and opts.enable_batch_seeds or eta_noise_seed_delta > 0):
-        sampler_noises = [[] for _ in range(p.sampler.number_of_needed_noises(p))]
-    else:
-        sampler_noises = None
+        if eta_noise_seed_delta > 0:
+            generator = rng.create_generator([seed + eta_noise_seed_delta for seed in seeds])
 
-    for i, seed in enumerate(seeds):
-        noise_shape = shape if seed_resize_from_h <= 0 or seed_resize_from_w <= 0 else (
-            shape[0], seed_resize_from_h // 8, seed_resize_from_w // 8)
+        p.sampler.sampler_noises = rng.sampler_noises(generator, noise_shape, p.sampler.number_of_needed_noises(p))
 
-        subnoise = None
-        if subseeds is not None:
-            subseed = 0 if i >= len(subseeds) else subseeds[i]
+    return noise.to(shared.device)
 
-            subnoise = devices.randn(subseed, noise_shape)
 
-        # randn results depend on device; gpu and cpu get different results for same seed;
-        # the way I see it, it's better to do this on CPU, so that everyone gets same result;
-        # but the original script had it like this, so I do not dare change it for now because
-        # it will break everyone's seeds.
-        noise = devices.randn(seed, noise_shape)
+def decode_first_stage(model, x):
+    with devices.autocast(disable=x.dtype == devices.dtype_vae):
+        x = model.decode_first_stage(x)
 
-        if subnoise is not None:
-            noise = slerp(subseed_strength, noise, subnoise)
+    return x
 
-        if noise_shape != shape:
-            x = devices.randn(seed, shape)
-            dx = (shape[2] - noise_shape[2]) // 2
-            dy = (shape[1] - noise_shape[1]) // 2
-            w = noise_shape[2] if dx >= 0 else noise_shape[2] + 2 * dx
-            h = noise_shape[1] if dy >= 0 else noise_shape[1] + 2 * dy
-            tx = 0 if dx < 0 else dx
-            ty = 0 if dy < 0 else dy
-            dx = max(-dx, 0)
-            dy = max(-dy, 0)
 
-            x[:, ty:ty + h, tx:tx + w] = noise[:, dy:dy + h, dx:dx + w]
-            noise = x
+def vae_decode_chunk_size(samples):
+    """how many latents from samples can be decoded together in the memory that is currently free"""
 
-        if sampler_noises is not None:
-            cnt = p.sampler.number_of_needed_noises(p)
+    _, _, h, w = samples.shape
+    element_size = torch.finfo(devices.dtype_vae).bits // 8
 
-            if eta_noise_seed_delta > 0:
-                torch.manual_seed(seed + eta_noise_seed_delta)
+    # the decoder keeps a few 128-channel activations at full image resolution alive at once,
+    # plus the attention scores of its middle block at latent resolution
+    bytes_per_sample = (h * 8) * (w * 8) * 128 * element_size * 6 + (h * w) ** 2 * element_size * 2
 
-            for j in range(cnt):
-                sampler_noises[j].append(devices.randn_without_seed(tuple(noise_shape)))
+    return max(1, min(samples.shape[0], int(get_available_vram() * 0.8) // bytes_per_sample))
 
-        xs.append(noise)
 
-    if sampler_noises is not None:
-        p.sampler.sampler_noises = [torch.stack(n).to(
-            shared.device) for n in sampler_noises]
+def decode_first_stage_batched(model, samples):
+    """
+    Decodes a batch of latents in chunks sized from free memory and returns the result as a float32 CPU
+    tensor, copied to the host once per chunk. A chunk that runs out of memory is halved; when even a
+    single latent does not fit, it is decoded in tiles.
+    """
+    chunk_size = vae_decode_chunk_size(samples)
+    decoded = []
 
-    x = torch.stack(xs).to(shared.device)
-    return x
+    i = 0
+    while i < samples.shape[0]:
+        chunk = samples[i:i + chunk_size].to(dtype=devices.dtype_vae)
 
+        try:
+            x = decode_first_stage(model, chunk)
+        except RuntimeError as e:
+            if not devices.is_out_of_memory(e):
+                raise
 
-def decode_first_stage(model, x):
-    with devices.autocast(disable=x.dtype == devices.dtype_vae):
-        x = model.decode_first_stage(x)
+            del e
+            devices.torch_gc()
 
-    return x
+            if chunk_size > 1:
+                chunk_size //= 2
+                continue
+
+            x = decode_first_stage_tiled(model, chunk)
+
+        devices.test_for_nans(x, "vae")
+        decoded.append(x.float().cpu())
+        i += chunk.shape[0]
+
+    return torch.cat(decoded)
+
+
+def decode_first_stage_tiled(model, samples, tile_size=None, overlap=8):
+    """decodes latents tile by tile, blending overlapping edges together; returns a float32 CPU tensor"""
+
+    batch, _, h, w = samples.shape
+    tile_size = tile_size or max(min(h, w) // 2, overlap * 2)
+    stride = tile_size - overlap
+
+    def positions(size):
+        if size <= tile_size:
+            return [0]
+
+        res = list(range(0, size - tile_size, stride))
+        return res + [size - tile_size]
+
+    result = None
+    weights = None
+
+    for y in positions(h):
+        for x in positions(w):
+            tile = samples[:, :, y:y + tile_size, x:x + tile_size]
+            decoded = decode_first_stage(model, tile).float().cpu()
+
+            scale = decoded.shape[-1] // tile.shape[-1]
+            if result is None:
+                result = torch.zeros((batch, decoded.shape[1], h * scale, w * scale))
+                weights = torch.zeros((1, 1, h * scale, w * scale))
+
+            # weights fall off towards tile edges so seams between neighbouring tiles fade into each other
+            ramp = overlap * scale
+            mask_y = torch.ones(decoded.shape[-2])
+            mask_x = torch.ones(decoded.shape[-1])
+            edge = torch.linspace(1 / (ramp + 1), 1, ramp)
+            for mask in (mask_y, mask_x):
+                if len(mask) > ramp * 2:
+                    mask[:ramp] = edge
+                    mask[-ramp:] = edge.flip(0)
+            mask = mask_y[:, None] * mask_x[None, :]
+
+            area = (slice(None), slice(None), slice(y * scale, y * scale + decoded.shape[-2]), slice(x * scale, x * scale + decoded.shape[-1]))
+            result[area] += decoded * mask
+            weights[area] += mask
+
+    return result / weights
 
 
 def get_fixed_seed(seed):
@@ -499,24 +579,21 @@ def process_images(p: StableDiffusionProcessing) -> Processed:
         for k, v in p.override_settings.items():
             setattr(opts, k, v)
 
-            if k == 'sd_model_checkpoint':
-                sd_models.reload_model_weights()
+        # a checkpoint or VAE overridden by an earlier job stays loaded until a job needs another one,
+        # so the settings are only restored below and the weights are switched back here if needed
+        sd_models.reload_model_weights()
+        sd_vae.reload_vae_weights()
 
-            if k == 'sd_vae':
-                sd_vae.reload_vae_weights()
+        sd_models.require_resident()
 
-        res = process_images_inner(p)
+        with profiling.profile(p.profile):
+            res = process_images_inner(p)
 
     finally:
         # restore opts to original state
         if p.override_settings_restore_afterwards:
             for k, v in stored_opts.items():
                 setattr(opts, k, v)
-                if k == 'sd_model_checkpoint':
-                    sd_models.reload_model_weights()
-
-                if k == 'sd_vae':
-                    sd_vae.reload_vae_weights()
 
     return res
 
@@ -568,8 +645,9 @@ def process_images_inner(p: StableDiffusionProcessing) -> Processed:
     def infotext(iteration=0, position_in_batch=0):
         return create_infotext(p, p.all_prompts, p.all_seeds, p.all_subseeds, comments, iteration, position_in_batch)
 
-    if os.path.exists(cmd_opts.embeddings_dir) and not p.do_not_reload_embeddings:
-        model_hijack.embedding_db.load_textual_inversion_embeddings()
+    # changed embedding files are picked up in the background, so jobs don't look at the disk for them
+    if not p.do_not_reload_embeddings:
+        model_hijack.embedding_db.start_watcher()
 
     if p.scripts is not None:
         p.scripts.process(p)
@@ -594,14 +672,14 @@ def process_images_inner(p: StableDiffusionProcessing) -> Processed:
         if cache[0] is not None and (required_prompts, steps) == cache[0]:
             return cache[1]
 
-        with devices.autocast():
+        with devices.autocast(), profiling.record("get_conds_with_caching"):
             cache[1] = function(shared.sd_model, required_prompts, steps)
 
         cache[0] = (required_prompts, steps)
         return cache[1]
 
     with torch.no_grad(), p.sd_model.ema_scope():
-        with devices.autocast():
+        with devices.autocast(), metrics.stage_duration.time(stage="init"), profiling.record("p.init"):
             p.init(p.all_prompts, p.all_seeds, p.all_subseeds)
 
             # for OSX, loading the model during sampling changes the generated picture, so it is loaded here
@@ -653,10 +731,11 @@ def process_images_inner(p: StableDiffusionProcessing) -> Processed:
                     processed = Processed(p, [], p.seed, "")
                     file.write(processed.infotext(p, 0))
 
-            uc = get_conds_with_caching(
-                prompt_parser.get_learned_conditioning, negative_prompts, p.steps, cached_uc)
-            c = get_conds_with_caching(
-                prompt_parser.get_multicond_learned_conditioning, prompts, p.steps, cached_c)
+            with metrics.stage_duration.time(stage="conditioning"):
+                uc = get_conds_with_caching(
+                    prompt_parser.get_learned_conditioning, negative_prompts, p.steps, cached_uc)
+                c = get_conds_with_caching(
+                    prompt_parser.get_multicond_learned_conditioning, prompts, p.steps, cached_c)
 
             if len(model_hijack.comments) > 0:
                 for comment in model_hijack.comments:
@@ -665,17 +744,13 @@ def process_images_inner(p: StableDiffusionProcessing) -> Processed:
             if p.n_iter > 1:
                 shared.state.job = f"Batch {n+1} out of {p.n_iter}"
 
-            with devices.without_autocast() if devices.unet_needs_upcast else devices.autocast():
+            with devices.without_autocast() if devices.unet_needs_upcast else devices.autocast(), metrics.stage_duration.time(stage="sampling"):
                 samples_ddim = p.sample(conditioning=c, unconditional_conditioning=uc, seeds=seeds,
                                         subseeds=subseeds, subseed_strength=p.subseed_strength, prompts=prompts)
 
-            x_samples_ddim = [decode_first_stage(p.sd_model, samples_ddim[i:i + 1].to(
-                dtype=devices.dtype_vae))[0].cpu() for i in range(samples_ddim.size(0))]
-            for x in x_samples_ddim:
-                devices.test_for_nans(x, "vae")
-
-            x_samples_ddim = torch.stack(x_samples_ddim).float()
-            x_samples_ddim = torch.clamp((x_samples_ddim + 1.0) / 2.0, min=0.0, max=1.0)
+            with metrics.stage_duration.time(stage="vae_decode"), profiling.record("decode_first_stage"):
+                x_samples_ddim = decode_first_stage_batched(p.sd_model, samples_ddim)
+                x_samples_ddim = torch.clamp((x_samples_ddim + 1.0) / 2.0, min=0.0, max=1.0)
 
             del samples_ddim
 
@@ -684,6 +759,8 @@ def process_images_inner(p: StableDiffusionProcessing) -> Processed:
 
             devices.torch_gc()
 
+            postprocess_started = time.perf_counter()
+
             if p.scripts is not None:
                 p.scripts.postprocess_batch(p, x_samples_ddim, batch_number=n)
 
@@ -728,6 +805,11 @@ def process_images_inner(p: StableDiffusionProcessing) -> Processed:
                     image.info["parameters"] = text
                 output_images.append(image)
 
+                if p.image_ready_callback is not None:
+                    p.image_ready_callback(image)
+
+            metrics.stage_duration.observe(time.perf_counter() - postprocess_started, stage="postprocess")
+
             del x_samples_ddim
 
             devices.torch_gc()
@@ -810,9 +892,10 @@ class StableDiffusionProcessingImg2Img(StableDiffusionProcessing):
 
             if self.inpaint_full_res:
                 self.mask_for_overlay = image_mask
-                mask = image_mask.convert('L')
+                overlay_paste_mask = ImageOps.invert(image_mask)
+                mask = image_mask
                 crop_region = masking.get_crop_region(
-                    np.array(mask), self.inpaint_full_res_padding)
+                    np.asarray(mask), self.inpaint_full_res_padding)
                 crop_region = masking.expand_crop_region(
                     crop_region, self.width, self.height, mask.width, mask.height)
                 x1, y1, x2, y2 = crop_region
@@ -823,10 +906,7 @@ class StableDiffusionProcessingImg2Img(StableDiffusionProcessing):
             else:
                 image_mask = images.resize_image(
                     self.resize_mode, image_mask, self.width, self.height)
-                np_mask = np.array(image_mask)
-                np_mask = np.clip((np_mask.astype(np.float32))
-                                  * 2, 0, 255).astype(np.uint8)
-                self.mask_for_overlay = Image.fromarray(np_mask)
+                self.mask_for_overlay, overlay_paste_mask = masking.overlay_masks(image_mask)
 
             self.overlay_images = []
 
@@ -846,7 +926,7 @@ class StableDiffusionProcessingImg2Img(StableDiffusionProcessing):
             if image_mask is not None:
                 image_masked = Image.new('RGBa', (image.width, image.height))
                 image_masked.paste(image.convert("RGBA").convert(
-                    "RGBa"), mask=ImageOps.invert(self.mask_for_overlay.convert('L')))
+                    "RGBa"), mask=overlay_paste_mask)
 
                 self.overlay_images.append(image_masked.convert('RGBA'))
 
@@ -895,18 +975,12 @@ class StableDiffusionProcessingImg2Img(StableDiffusionProcessing):
                 self.height // opt_f, self.width // opt_f), mode="bilinear")
 
         if image_mask is not None:
-            init_mask = latent_mask
-            latmask = init_mask.convert('RGB').resize(
-                (self.init_latent.shape[3], self.init_latent.shape[2]))
-            latmask = np.moveaxis(np.array(latmask, dtype=np.float32), 2, 0) / 255
-            latmask = latmask[0]
-            latmask = np.around(latmask)
-            latmask = np.tile(latmask[None], (4, 1, 1))
-
-            self.mask = torch.asarray(
-                1.0 - latmask).to(shared.device).type(self.sd_model.dtype)
-            self.nmask = torch.asarray(latmask).to(
-                shared.device).type(self.sd_model.dtype)
+            latmask = masking.latent_mask(
+                latent_mask, self.init_latent.shape[3], self.init_latent.shape[2])
+            latmask = torch.from_numpy(latmask).to(shared.device).type(self.sd_model.dtype)
+
+            self.nmask = latmask[None].repeat(self.init_latent.shape[1], 1, 1)
+            self.mask = 1.0 - self.nmask
 
             # this needs to be fixed to be done in sample() using actual seeds for batches
             if self.inpainting_fill == 2:
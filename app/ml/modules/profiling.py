@@ -0,0 +1,127 @@
+"""torch.profiler capture of chosen jobs, written as Chrome traces to a directory that keeps only the newest ones"""
+import contextlib
+import glob
+import itertools
+import os
+import sys
+import threading
+import time
+
+import torch
+
+lock = threading.Lock()
+armed = 0
+counter = itertools.count()
+
+# True while a job is being profiled, so markers cost nothing otherwise
+active = False
+
+# set in GPU worker processes, where the armed jobs are counted by the server and taken from it
+remote_take = None
+
+
+def arm(jobs):
+    """profiles the next jobs run in this process, in addition to those that ask for it themselves"""
+
+    global armed
+
+    with lock:
+        armed += jobs
+
+
+def take():
+    """returns True and uses up one armed job if there is one"""
+
+    global armed
+
+    if remote_take is not None:
+        return remote_take()
+
+    with lock:
+        if armed <= 0:
+            return False
+
+        armed -= 1
+        return True
+
+
+def pending():
+    return armed
+
+
+def traces_dir():
+    from app.ml.modules import paths
+    from app.ml.modules.shared import opts
+
+    return os.path.join(paths.data_path, opts.profiling_dir)
+
+
+def list_traces():
+    """trace files, oldest first"""
+
+    return sorted(glob.glob(os.path.join(traces_dir(), "*.json")), key=os.path.getmtime)
+
+
+def remove_old_traces():
+    from app.ml.modules.shared import opts
+
+    traces = list_traces()
+    for filename in traces[:max(len(traces) - opts.profiling_max_traces, 0)]:
+        try:
+            os.remove(filename)
+        except OSError as e:
+            print(f"Could not remove old profiler trace {filename}: {e}", file=sys.stderr)
+
+
+@contextlib.contextmanager
+def profile(enabled):
+    """runs the with block under torch.profiler if enabled or a job is armed, and writes its trace on exit"""
+
+    global active
+
+    if not enabled and not take():
+        yield
+        return
+
+    activities = [torch.profiler.ProfilerActivity.CPU]
+    if torch.cuda.is_available():
+        activities.append(torch.profiler.ProfilerActivity.CUDA)
+
+    with torch.profiler.profile(activities=activities, record_shapes=True) as profiler:
+        active = True
+        try:
+            yield
+        finally:
+            active = False
+
+    os.makedirs(traces_dir(), exist_ok=True)
+    filename = os.path.join(traces_dir(), f"{time.strftime('%Y%m%d-%H%M%S')}-{os.getpid()}-{next(counter)}.json")
+    profiler.export_chrome_trace(filename)
+    print(f"Profiler trace written to {filename}")
+
+    remove_old_traces()
+
+
+def record(name):
+    """a torch.profiler.record_function range for the with block, only while profiling"""
+
+    return torch.profiler.record_function(name) if active else contextlib.nullcontext()
+
+
+class Marker:
+    """A record_function range opened and closed by separate calls, for steps run inside a sampler's own loop."""
+
+    def __init__(self):
+        self.range = None
+
+    def start(self, name):
+        self.stop()
+
+        if active:
+            self.range = torch.profiler.record_function(name)
+            self.range.__enter__()
+
+    def stop(self):
+        if self.range is not None:
+            self.range.__exit__(None, None, None)
+            self.range = None
@@ -3,6 +3,8 @@ from collections import namedtuple
 from typing import List
 import lark
 
+from app.ml.modules import caching
+
 # a prompt like this: "fantasy landscape with a [mountain:lake:0.25] and [an oak:a christmas tree:0.75][ in foreground::0.6][ in background:0.25] [shoddy:masterful:0.5]"
 # will be represented with prompt_schedule like this (assuming steps=100):
 # [25, 'fantasy landscape with a mountain and an oak in foreground shoddy']
@@ -99,10 +101,29 @@ def get_learned_conditioning_prompt_schedules(prompts, steps):
             return [[steps, prompt]]
         return [[t, at_step(t, tree)] for t in collect_steps(steps, tree)]
 
-    promptdict = {prompt: get_schedule(prompt) for prompt in set(prompts)}
+    promptdict = {}
+    for prompt in set(prompts):
+        schedule = schedule_cache.get((prompt, steps), None)
+        if schedule is None:
+            schedule = get_schedule(prompt)
+            schedule_cache.put((prompt, steps), schedule)
+
+        promptdict[prompt] = schedule
+
     return [promptdict[prompt] for prompt in prompts]
 
 
+def parse_cache_size():
+    from app.ml.modules import shared
+
+    return shared.opts.prompt_cache_size
+
+
+# results of parsing, which only depend on the text parsed; schedules are returned as they are, so callers must not modify them
+schedule_cache = caching.LRUCache("prompt schedules", parse_cache_size)
+attention_cache = caching.LRUCache("prompt attention", parse_cache_size)
+
+
 ScheduledPromptConditioning = namedtuple("ScheduledPromptConditioning", ["end_at_step", "cond"])
 
 
@@ -126,16 +147,17 @@ def get_learned_conditioning(model, prompts, steps):
     """
     res = []
 
-    prompt_schedules = get_learned_conditioning_prompt_schedules(prompts, steps)
+    context = conditioning_cache_context(model, steps)
     cache = {}
 
-    for prompt, prompt_schedule in zip(prompts, prompt_schedules):
+    for prompt in prompts:
+        if prompt not in cache:
+            cache[prompt] = conditioning_cache.get(context + (prompt,), None)
 
-        cached = cache.get(prompt, None)
-        if cached is not None:
-            res.append(cached)
-            continue
+    missing = [prompt for prompt, cond_schedule in cache.items() if cond_schedule is None]
+    prompt_schedules = get_learned_conditioning_prompt_schedules(missing, steps)
 
+    for prompt, prompt_schedule in zip(missing, prompt_schedules):
         texts = [x[1] for x in prompt_schedule]
         conds = model.get_learned_conditioning(texts)
 
@@ -144,11 +166,42 @@ def get_learned_conditioning(model, prompts, steps):
             cond_schedule.append(ScheduledPromptConditioning(end_at_step, conds[i]))
 
         cache[prompt] = cond_schedule
-        res.append(cond_schedule)
+        conditioning_cache.put(context + (prompt,), cond_schedule)
+
+    for prompt in prompts:
+        res.append(cache[prompt])
 
     return res
 
 
+def conditioning_cache_size():
+    from app.ml.modules import shared
+
+    return shared.opts.text_conditioning_cache_size
+
+
+conditioning_cache = caching.LRUCache("text conditioning", conditioning_cache_size, invalidate_on=("model", "embeddings"))
+
+
+def conditioning_cache_context(model, steps):
+    """everything besides the prompt that the result of model.get_learned_conditioning depends on"""
+
+    from app.ml.modules import shared
+    from app.ml.modules.sd_hijack import model_hijack
+
+    return (
+        getattr(model, 'sd_model_checkpoint', None),
+        getattr(model, 'sd_model_hash', None),
+        steps,
+        model_hijack.embedding_db.generation,
+        tuple(hypernetwork.name for hypernetwork in shared.loaded_hypernetworks),
+        shared.opts.CLIP_stop_at_last_layers,
+        shared.opts.enable_emphasis,
+        shared.opts.use_old_emphasis_implementation,
+        shared.opts.comma_padding_backtrack,
+    )
+
+
 re_AND = re.compile(r"\bAND\b")
 re_weight = re.compile(r"^(.*?)(?:\s*:\s*([-+]?(?:\d+\.?|\d*\.\d+)))?\s*$")
 
@@ -312,6 +365,11 @@ def parse_prompt_attention(text):
      ['.', 1.1]]
     """
 
+    cached = attention_cache.get(text, None)
+    if cached is not None:
+        return [[part, weight] for part, weight in cached]
+
+    prompt = text
     res = []
     round_brackets = []
     square_brackets = []
@@ -364,6 +422,8 @@ def parse_prompt_attention(text):
         else:
             i += 1
 
+    attention_cache.put(prompt, tuple((part, weight) for part, weight in res))
+
     return res
 
 if __name__ == "__main__":
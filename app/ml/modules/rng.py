@@ -0,0 +1,127 @@
+"""Seeded noise for sampling, made for a whole batch at once and step by step as samplers ask for it"""
+import math
+
+import torch
+
+from app.ml.modules import devices
+
+mask32 = 0xFFFFFFFF
+
+philox_m = (0xD2511F53, 0xCD9E8D57)
+philox_w = (0x9E3779B9, 0xBB67AE85)
+
+
+def generator_device():
+    # randn on mps is not reproducible, and mps has no float64 for philox
+    return devices.cpu if devices.device.type == 'mps' else devices.device
+
+
+def mulhilo(m, x):
+    """high and low 32 bits of m * x for a 32-bit constant m and a tensor x of 32-bit values kept in int64"""
+    a = x * (m & 0xFFFF)
+    b = x * (m >> 16)
+    s = (a & mask32) + ((b & 0xFFFF) << 16)
+
+    return ((a >> 32) + (b >> 16) + (s >> 32)) & mask32, s & mask32
+
+
+def philox4x32(counter, key, rounds=10):
+    """Philox4x32 with the usual 10 rounds, on int64 tensors holding 32-bit words; counter is four tensors, key two"""
+    c0, c1, c2, c3 = counter
+    k0, k1 = key
+
+    for _ in range(rounds):
+        hi0, lo0 = mulhilo(philox_m[0], c0)
+        hi1, lo1 = mulhilo(philox_m[1], c2)
+        c0, c1, c2, c3 = hi1 ^ c1 ^ k0, lo1, hi0 ^ c3 ^ k1, lo0
+        k0 = (k0 + philox_w[0]) & mask32
+        k1 = (k1 + philox_w[1]) & mask32
+
+    return c0, c1, c2, c3
+
+
+def philox_randn(seeds, shape, offset):
+    """
+    Normally distributed noise of shape for every seed, as one tensor with a leading batch dimension. Element i of
+    draw number offset for a seed only depends on (seed, offset, i), so the result is the same on every device
+    and for every batch the seed is part of.
+    """
+    numel = 1
+    for size in shape:
+        numel *= size
+    pairs = (numel + 1) // 2
+    device = generator_device()
+
+    seeds = torch.tensor(seeds, dtype=torch.int64, device=device).unsqueeze(1)
+    index = torch.arange(pairs, dtype=torch.int64, device=device).unsqueeze(0).expand(seeds.shape[0], pairs)
+    zeros = torch.zeros_like(index)
+
+    counter = (index, zeros + offset, zeros, zeros)
+    key = ((seeds & mask32).expand_as(index), ((seeds >> 32) & mask32).expand_as(index))
+    r0, r1, _, _ = philox4x32(counter, key)
+
+    # Box-Muller; u1 is in (0, 1] so the log is finite
+    u1 = (r0.double() + 1) / 2 ** 32
+    u2 = r1.double() / 2 ** 32
+    radius = torch.sqrt(-2 * torch.log(u1))
+    theta = 2 * math.pi * u2
+
+    res = torch.cat([radius * torch.cos(theta), radius * torch.sin(theta)], dim=1)[:, :numel]
+    return res.float().reshape(seeds.shape[0], *shape)
+
+
+class TorchGenerator:
+    """
+    One torch.Generator per image, seeded the way devices.randn seeds the global generator, so noise
+    is the same as before for every seed; images are drawn one after another.
+    """
+
+    def __init__(self, seeds):
+        self.generators = []
+        for seed in seeds:
+            generator = torch.Generator(device=generator_device())
+            generator.manual_seed(seed)
+            self.generators.append(generator)
+
+    def randn(self, shape):
+        return torch.stack([torch.randn(shape, generator=generator, device=generator.device) for generator in self.generators]).to(devices.device)
+
+    def set_global_state(self):
+        """continues the global generator from the last image's generator, as if its seed was set with torch.manual_seed"""
+        generator = self.generators[-1]
+        if generator.device.type == 'cuda':
+            torch.cuda.set_rng_state(generator.get_state(), generator.device)
+        else:
+            torch.set_rng_state(generator.get_state())
+
+
+class PhiloxGenerator:
+    """Counter-based noise keyed by seed: the whole batch is made by one vectorized call per draw."""
+
+    def __init__(self, seeds):
+        self.seeds = list(seeds)
+        self.offset = 0
+
+    def randn(self, shape):
+        res = philox_randn(self.seeds, shape, self.offset)
+        self.offset += 1
+
+        return res.to(devices.device)
+
+    def set_global_state(self):
+        pass
+
+
+def create_generator(seeds):
+    from app.ml.modules.shared import opts
+
+    if opts.randn_source == "Philox":
+        return PhiloxGenerator(seeds)
+
+    return TorchGenerator(seeds)
+
+
+def sampler_noises(generator, shape, count):
+    """noise for count sampler steps, each made only when the sampler gets to it"""
+    for _ in range(count):
+        yield generator.randn(shape)
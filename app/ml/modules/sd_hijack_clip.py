@@ -3,7 +3,7 @@ from collections import namedtuple
 
 import torch
 
-from app.ml.modules import prompt_parser, devices, sd_hijack
+from app.ml.modules import prompt_parser, devices, sd_hijack, caching
 from app.ml.modules.shared import opts
 
 
@@ -26,6 +26,10 @@ PromptChunkFix = namedtuple('PromptChunkFix', ['offset', 'embedding'])
 chunk. Thos objects are found in PromptChunk.fixes and, are placed into FrozenCLIPEmbedderWithCustomWordsBase.hijack.fixes, and finally
 are applied by sd_hijack.EmbeddingsWithFixes's forward function."""
 
+chunks_cache = caching.LRUCache("prompt chunks", prompt_parser.parse_cache_size, invalidate_on=("model", "embeddings"))
+"""tokenize_line() results across requests, by the wrapper, embeddings generation and settings used, and the line; the PromptChunk
+objects in them are shared by everyone who gets them, so they must not be modified."""
+
 
 class FrozenCLIPEmbedderWithCustomWordsBase(torch.nn.Module):
     """A pytorch module that is a wrapper for FrozenCLIPEmbedder module. it enhances FrozenCLIPEmbedder, making it possible to
@@ -125,6 +129,8 @@ class FrozenCLIPEmbedderWithCustomWordsBase(torch.nn.Module):
                 next_chunk()
                 continue
 
+            embeddings = self.hijack.embedding_db.find_embeddings(tokens)
+
             position = 0
             while position < len(tokens):
                 token = tokens[position]
@@ -150,8 +156,7 @@ class FrozenCLIPEmbedderWithCustomWordsBase(torch.nn.Module):
                 if len(chunk.tokens) == self.chunk_length:
                     next_chunk()
 
-                embedding, embedding_length_in_tokens = self.hijack.embedding_db.find_embedding_at_position(
-                    tokens, position)
+                embedding, embedding_length_in_tokens = embeddings[position]
                 if embedding is None:
                     chunk.tokens.append(token)
                     chunk.multipliers.append(weight)
@@ -175,22 +180,22 @@ class FrozenCLIPEmbedderWithCustomWordsBase(torch.nn.Module):
 
     def process_texts(self, texts):
         """
-        Accepts a list of texts and calls tokenize_line() on each, with cache. Returns the list of results and maximum
+        Accepts a list of texts and calls tokenize_line() on each, with chunks_cache. Returns the list of results and maximum
         length, in tokens, of all texts.
         """
 
         token_count = 0
+        context = (self, self.hijack.embedding_db.generation, opts.enable_emphasis, opts.comma_padding_backtrack)
 
-        cache = {}
         batch_chunks = []
         for line in texts:
-            if line in cache:
-                chunks = cache[line]
-            else:
-                chunks, current_token_count = self.tokenize_line(line)
-                token_count = max(current_token_count, token_count)
+            cached = chunks_cache.get(context + (line,), None)
+            if cached is None:
+                cached = self.tokenize_line(line)
+                chunks_cache.put(context + (line,), cached)
 
-                cache[line] = chunks
+            chunks, current_token_count = cached
+            token_count = max(current_token_count, token_count)
 
             batch_chunks.append(chunks)
 
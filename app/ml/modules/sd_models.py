@@ -1,9 +1,12 @@
 import collections
+import collections.abc
 import os.path
 import sys
 import gc
 import torch
 import re
+import threading
+import time
 import safetensors.torch
 from omegaconf import OmegaConf
 from os import mkdir
@@ -13,7 +16,7 @@ import ldm.modules.midas as midas
 from ldm.util import instantiate_from_config
 
 from app.api.errors import errors
-from app.ml.modules import paths, shared, modelloader, devices, script_callbacks, sd_vae, sd_disable_initialization, hashes, sd_models_config
+from app.ml.modules import paths, shared, modelloader, devices, script_callbacks, sd_vae, sd_disable_initialization, hashes, sd_models_config, caching, model_residency, metrics
 from app.ml.modules.paths import models_path
 from app.ml.modules.sd_hijack_inpainting import do_inpainting_hijack
 from app.ml.modules.timer import Timer
@@ -23,8 +26,22 @@ model_path = os.path.abspath(os.path.join(paths.models_path, model_dir))
 
 checkpoints_list = {}
 checkpoint_alisases = {}
+
+# guards checkpoints_list, checkpoint_alisases and the checkpoint in opts, which hashing threads update
+checkpoints_lock = threading.RLock()
+
 checkpoints_loaded = collections.OrderedDict()
 
+# prepared models kept on the device besides shared.sd_model, by checkpoint filename
+hot_models = collections.OrderedDict()
+
+# request rates of checkpoints by filename, to choose which ones stay loaded
+checkpoint_usage = {}
+usage_half_life = 600
+
+# parts of the SD model tracked by model_residency, by attribute of the model
+resident_model_parts = {"sd_unet": "model", "sd_vae": "first_stage_model", "sd_text_encoder": "cond_stage_model"}
+
 
 class CheckpointInfo:
     def __init__(self, filename):
@@ -54,24 +71,39 @@ class CheckpointInfo:
         self.ids = [self.hash, self.model_name, self.title, name, f'{name} [{self.hash}]'] + ([self.shorthash, self.sha256, f'{self.name} [{self.shorthash}]'] if self.shorthash else [])
 
     def register(self):
-        checkpoints_list[self.title] = self
-        for id in self.ids:
-            checkpoint_alisases[id] = self
-
-    def calculate_shorthash(self):
-        self.sha256 = hashes.sha256(self.filename, "checkpoint/" + self.name)
-        if self.sha256 is None:
+        with checkpoints_lock:
+            checkpoints_list[self.title] = self
+            for id in self.ids:
+                checkpoint_alisases[id] = self
+
+    def start_hashing(self):
+        """starts calculating sha256 in the background; the hash and the title with it are filled in once it is done"""
+        future = hashes.sha256_async(self.filename, "checkpoint/" + self.name)
+        future.add_done_callback(self.hashed)
+        return future
+
+    def hashed(self, future):
+        sha256 = future.result() if future.exception() is None else None
+        if sha256 is None:
             return
 
-        self.shorthash = self.sha256[0:10]
+        with checkpoints_lock:
+            if sha256 == self.sha256 and self.shorthash in self.ids:
+                return
 
-        if self.shorthash not in self.ids:
-            self.ids += [self.shorthash, self.sha256, f'{self.name} [{self.shorthash}]']
+            self.sha256 = sha256
+            self.shorthash = self.sha256[0:10]
 
-        checkpoints_list.pop(self.title)
-        self.title = f'{self.name} [{self.shorthash}]'
-        self.register()
+            if self.shorthash not in self.ids:
+                self.ids += [self.shorthash, self.sha256, f'{self.name} [{self.shorthash}]']
 
+            checkpoints_list.pop(self.title, None)
+            self.title = f'{self.name} [{self.shorthash}]'
+            self.register()
+
+    def calculate_shorthash(self):
+        """waits for the hash; loading a model doesn't, it serves with the title it has until the hash is done"""
+        self.start_hashing().result()
         return self.shorthash
 
 
@@ -100,12 +132,16 @@ def checkpoint_tiles():
     def alphanumeric_key(key):
         return [convert(c) for c in re.split('([0-9]+)', key)]
 
-    return sorted([x.title for x in checkpoints_list.values()], key=alphanumeric_key)
+    with checkpoints_lock:
+        titles = [x.title for x in checkpoints_list.values()]
+
+    return sorted(titles, key=alphanumeric_key)
 
 
 def list_models():
-    checkpoints_list.clear()
-    checkpoint_alisases.clear()
+    with checkpoints_lock:
+        checkpoints_list.clear()
+        checkpoint_alisases.clear()
 
     cmd_ckpt = shared.cmd_opts.ckpt
     if shared.cmd_opts.no_download_sd_model or cmd_ckpt != shared.sd_model_file or os.path.exists(cmd_ckpt):
@@ -119,7 +155,8 @@ def list_models():
         checkpoint_info = CheckpointInfo(cmd_ckpt)
         checkpoint_info.register()
 
-        shared.opts.data['sd_model_checkpoint'] = checkpoint_info.title
+        with checkpoints_lock:
+            shared.opts.data['sd_model_checkpoint'] = checkpoint_info.title
     elif cmd_ckpt is not None and cmd_ckpt != shared.default_sd_model_file:
         print(f"Checkpoint in --ckpt argument not found (Possible it was moved to {model_path}: {cmd_ckpt}", file=sys.stderr)
 
@@ -133,7 +170,8 @@ def get_closet_checkpoint_match(search_string):
     if checkpoint_info is not None:
         return checkpoint_info
 
-    found = sorted([info for info in checkpoints_list.values() if search_string in info.title], key=lambda x: len(x.title))
+    with checkpoints_lock:
+        found = sorted([info for info in checkpoints_list.values() if search_string in info.title], key=lambda x: len(x.title))
     if found:
         return found[0]
 
@@ -172,7 +210,8 @@ def select_checkpoint():
         print("Can't run without a checkpoint. Find and place a .ckpt or .safetensors file into any of those locations. The program will exit.", file=sys.stderr)
         exit(1)
 
-    checkpoint_info = next(iter(checkpoints_list.values()))
+    with checkpoints_lock:
+        checkpoint_info = next(iter(checkpoints_list.values()))
     if model_checkpoint is not None:
         print(f"Checkpoint {model_checkpoint} not found; loading fallback {checkpoint_info.title}", file=sys.stderr)
 
@@ -235,6 +274,36 @@ def read_metadata_from_safetensors(filename):
         return res
 
 
+class LazySafetensorsStateDict(collections.abc.Mapping):
+    """
+    Read-only state dict backed by a memory-mapped .safetensors file. Keys are translated like
+    get_state_dict_from_checkpoint does, and a tensor is only read from the file when it is looked up,
+    so holding one costs no more than the file mapping.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.file = safetensors.safe_open(filename, framework="pt", device="cpu")
+        self.keys_map = {}
+
+        for k in self.file.keys():
+            new_key = transform_checkpoint_dict_key(k)
+            if new_key is not None:
+                self.keys_map[new_key] = k
+
+    def __getitem__(self, key):
+        return self.file.get_tensor(self.keys_map[key])
+
+    def __contains__(self, key):
+        return key in self.keys_map
+
+    def __iter__(self):
+        return iter(self.keys_map)
+
+    def __len__(self):
+        return len(self.keys_map)
+
+
 def read_state_dict(checkpoint_file, print_global_state=False, map_location=None):
     _, extension = os.path.splitext(checkpoint_file)
     if extension.lower() == ".safetensors":
@@ -250,38 +319,138 @@ def read_state_dict(checkpoint_file, print_global_state=False, map_location=None
     return sd
 
 
-def get_checkpoint_state_dict(checkpoint_info: CheckpointInfo, timer):
-    sd_model_hash = checkpoint_info.calculate_shorthash()
-    timer.record("calculate hash")
+class CheckpointUsage:
+    """How often a checkpoint is used: a request rate that halves every usage_half_life seconds, and the time of the last request."""
+
+    def __init__(self):
+        self.rate = 0.0
+        self.last_used = 0.0
+
+    def rate_at(self, now):
+        return self.rate * 0.5 ** ((now - self.last_used) / usage_half_life)
+
+    def record(self, now):
+        self.rate = self.rate_at(now) + 1
+        self.last_used = now
+
 
+def record_checkpoint_use(checkpoint_info):
+    checkpoint_usage.setdefault(checkpoint_info.filename, CheckpointUsage()).record(time.time())
+
+
+def least_valuable_checkpoint(checkpoint_infos):
+    """the checkpoint least worth keeping loaded: the lowest current request rate, then the least recently used"""
+
+    now = time.time()
+
+    def value(checkpoint_info):
+        usage = checkpoint_usage.get(checkpoint_info.filename)
+        return (usage.rate_at(now), usage.last_used) if usage else (0.0, 0.0)
+
+    return min(checkpoint_infos, key=value)
+
+
+def checkpoint_tier(checkpoint_info):
+    """where switching to checkpoint_info loads it from: a model on the device, a state dict in RAM, or the file"""
+
+    if checkpoint_info.filename in hot_models:
+        return "hot"
     if checkpoint_info in checkpoints_loaded:
+        return "warm"
+    return "cold"
+
+
+def update_tier_metrics():
+    metrics.checkpoints_cached.set(len(hot_models), tier="hot")
+    metrics.checkpoints_cached.set(len(checkpoints_loaded), tier="warm")
+
+
+def state_dict_for_cache(model):
+    """
+    Copies the weights of model to RAM in the dtypes they have after loading, so half-precision models are cached
+    at half size; the copies are pinned when there is CUDA, which makes moving them back to the device faster.
+    """
+    pin_memory = torch.cuda.is_available()
+
+    res = {}
+    for k, v in model.state_dict().items():
+        res[k] = torch.empty_like(v, device=devices.cpu, pin_memory=pin_memory).copy_(v)
+
+    return res
+
+
+def get_checkpoint_state_dict(checkpoint_info: CheckpointInfo, timer):
+    # the hash is calculated in the background while weights load, and filled in whenever it is done
+    checkpoint_info.start_hashing()
+
+    cached = checkpoint_info in checkpoints_loaded
+    if shared.opts.sd_checkpoint_cache > 0:
+        metrics.record_cache_lookup("checkpoint", cached)
+
+    if cached:
         # use checkpoint cache
-        print(f"Loading weights [{sd_model_hash}] from cache")
+        print(f"Loading weights [{checkpoint_info.shorthash}] from cache")
+        checkpoints_loaded.move_to_end(checkpoint_info)
         return checkpoints_loaded[checkpoint_info]
 
-    print(f"Loading weights [{sd_model_hash}] from {checkpoint_info.filename}")
-    res = read_state_dict(checkpoint_info.filename)
+    print(f"Loading weights [{checkpoint_info.shorthash}] from {checkpoint_info.filename}")
+    if use_mmap(checkpoint_info.filename):
+        res = LazySafetensorsStateDict(checkpoint_info.filename)
+    else:
+        res = read_state_dict(checkpoint_info.filename)
     timer.record("load weights from disk")
 
     return res
 
 
-def load_model_weights(model, checkpoint_info: CheckpointInfo, state_dict, timer):
-    sd_model_hash = checkpoint_info.calculate_shorthash()
-    timer.record("calculate hash")
+def use_mmap(filename):
+    return shared.opts.sd_checkpoint_mmap and os.path.splitext(filename)[1].lower() == ".safetensors"
 
-    shared.opts.data["sd_model_checkpoint"] = checkpoint_info.title
+
+def load_state_dict_streaming(model, state_dict):
+    """
+    Same as model.load_state_dict(state_dict, strict=False), but state_dict is read one module at a time,
+    so tensors from a LazySafetensorsStateDict are copied into the model's parameters and released
+    right away instead of all being materialized first. Load hooks of modules still run.
+    """
+    missing_keys = []
+    unexpected_keys = []
+    error_msgs = []
+
+    for prefix, module in model.named_modules():
+        prefix = prefix + '.' if prefix else ''
+        names = list(module._parameters) + list(module._buffers)
+        local_state_dict = {prefix + name: state_dict[prefix + name] for name in names if prefix + name in state_dict}
+
+        module._load_from_state_dict(local_state_dict, prefix, {}, True, missing_keys, unexpected_keys, error_msgs)
+        del local_state_dict
+
+    if error_msgs:
+        raise RuntimeError('Error(s) in loading state_dict for {}:\n\t{}'.format(model.__class__.__name__, "\n\t".join(error_msgs)))
+
+
+def load_model_weights(model, checkpoint_info: CheckpointInfo, state_dict, timer):
+    hashing = checkpoint_info.start_hashing()
 
     if state_dict is None:
         state_dict = get_checkpoint_state_dict(checkpoint_info, timer)
 
-    model.load_state_dict(state_dict, strict=False)
-    del state_dict
+    # weights of the checkpoint's own VAE go into its own module, not into a resident VAE that is swapped in
+    sd_vae.release_resident_vae(model)
+
+    if isinstance(state_dict, LazySafetensorsStateDict):
+        load_state_dict_streaming(model, state_dict)
+    else:
+        model.load_state_dict(state_dict, strict=False)
     timer.record("apply weights to model")
+    metrics.model_loads.inc(kind="checkpoint")
 
-    if shared.opts.sd_checkpoint_cache > 0:
-        # cache newly loaded model
-        checkpoints_loaded[checkpoint_info] = model.state_dict().copy()
+    # None for a checkpoint that hasn't been hashed before until model_hashed fills it in
+    with checkpoints_lock:
+        sd_model_hash = checkpoint_info.shorthash
+        shared.opts.data["sd_model_checkpoint"] = checkpoint_info.title
+
+    del state_dict
 
     if shared.cmd_opts.opt_channelslast:
         model.to(memory_format=torch.channels_last)
@@ -313,14 +482,23 @@ def load_model_weights(model, checkpoint_info: CheckpointInfo, state_dict, timer
     model.first_stage_model.to(devices.dtype_vae)
     timer.record("apply dtype to VAE")
 
-    # clean up cache if limit is reached
+    if shared.opts.sd_checkpoint_cache > 0 and checkpoint_info not in checkpoints_loaded:
+        # cache newly loaded model, with its own VAE as VAE weights are only loaded below
+        checkpoints_loaded[checkpoint_info] = state_dict_for_cache(model)
+        timer.record("cache weights in RAM")
+
+    # clean up cache if limit is reached, dropping the least used checkpoints other than this one
     while len(checkpoints_loaded) > shared.opts.sd_checkpoint_cache:
-        checkpoints_loaded.popitem(last=False)
+        others = [info for info in checkpoints_loaded if info != checkpoint_info]
+        checkpoints_loaded.pop(least_valuable_checkpoint(others or list(checkpoints_loaded)))
 
     model.sd_model_hash = sd_model_hash
     model.sd_model_checkpoint = checkpoint_info.filename
     model.sd_checkpoint_info = checkpoint_info
-    shared.opts.data["sd_checkpoint_hash"] = checkpoint_info.sha256
+    caching.invalidate("model")
+    with checkpoints_lock:
+        shared.opts.data["sd_checkpoint_hash"] = checkpoint_info.sha256
+    hashing.add_done_callback(lambda _: model_hashed(model, checkpoint_info))
 
     model.logvar = model.logvar.to(devices.device)  # fix for training
 
@@ -463,23 +641,207 @@ def load_model(checkpoint_info=None, already_loaded_state_dict=None, time_taken_
     return sd_model
 
 
+def model_hashed(model, checkpoint_info):
+    """fills in the hash of a model whose checkpoint was hashed after it was loaded"""
+
+    with checkpoints_lock:
+        if checkpoint_info.shorthash is None or getattr(model, 'sd_checkpoint_info', None) is not checkpoint_info:
+            return
+
+        model.sd_model_hash = checkpoint_info.shorthash
+
+        # the setting still has the title from before the hash if no other checkpoint was chosen since
+        if shared.opts.data.get("sd_model_checkpoint", None) == checkpoint_info.name:
+            shared.opts.data["sd_model_checkpoint"] = checkpoint_info.title
+            shared.opts.data["sd_checkpoint_hash"] = checkpoint_info.sha256
+
+
+def register_resident_models():
+    from app.ml.modules import lowvram
+
+    if shared.cmd_opts.lowvram or shared.cmd_opts.medvram:
+        # lowvram moves parts of the model to the device by itself as they run; they only ever need to be sent back
+        model_residency.manager.register(
+            "sd_model", lambda: shared.sd_model, lambda: devices.device,
+            load=lambda module: None,
+            offload=lambda module: lowvram.send_everything_to_cpu(),
+            is_resident=lambda: lowvram.module_in_gpu is not None,
+            size=lambda: model_residency.module_size(lowvram.module_in_gpu),
+        )
+        return
+
+    def get_part(attr):
+        return lambda: getattr(shared.sd_model, attr, None)
+
+    for name, attr in resident_model_parts.items():
+        model_residency.manager.register(name, get_part(attr), lambda: devices.device)
+
+
+def require_resident():
+    """moves the parts of the SD model that were evicted to make room for other models back to the device"""
+    if shared.sd_model is not None:
+        record_checkpoint_use(shared.sd_model.sd_checkpoint_info)
+
+    model_residency.manager.require("sd_model", *resident_model_parts)
+
+
+register_resident_models()
+
+
+def hot_models_enabled():
+    return shared.opts.sd_checkpoints_hot > 1 and not shared.cmd_opts.lowvram and not shared.cmd_opts.medvram
+
+
+def hot_model_residency_name(filename):
+    return "sd_model_hot:" + filename
+
+
+def park_model(sd_model):
+    """keeps sd_model on the device, unhijacked, to be switched back to later; model_residency moves it to RAM if others need the room"""
+    from app.ml.modules import sd_hijack
+
+    sd_hijack.model_hijack.undo_hijack(sd_model)
+    sd_model.parked_vae_state = (sd_vae.base_vae, sd_vae.checkpoint_info, sd_vae.loaded_vae_file)
+
+    filename = sd_model.sd_model_checkpoint
+    hot_models[filename] = sd_model
+
+    name = hot_model_residency_name(filename)
+    model_residency.manager.register(name, lambda: hot_models.get(filename), lambda: devices.device, unload=unpark_model)
+    model_residency.manager.require(name)
+
+
+def unpark_model(sd_model):
+    """takes a parked model out of hot_models; returns the sd_vae state to restore when it becomes the current model"""
+    filename = sd_model.sd_model_checkpoint
+    hot_models.pop(filename, None)
+    model_residency.manager.unregister(hot_model_residency_name(filename))
+
+    vae_state = sd_model.parked_vae_state
+    del sd_model.parked_vae_state
+
+    return vae_state
+
+
+def activate_hot_model(sd_model):
+    """makes a parked model the current one again, as it was when it was parked"""
+    from app.ml.modules import sd_hijack
+
+    previous_config = shared.sd_model.used_config if shared.sd_model is not None else None
+
+    sd_vae.base_vae, sd_vae.checkpoint_info, sd_vae.loaded_vae_file = unpark_model(sd_model)
+    sd_model.to(devices.device)
+    sd_hijack.model_hijack.hijack(sd_model)
+    shared.sd_model = sd_model
+
+    checkpoint_info = sd_model.sd_checkpoint_info
+    with checkpoints_lock:
+        shared.opts.data["sd_model_checkpoint"] = checkpoint_info.title
+        shared.opts.data["sd_checkpoint_hash"] = checkpoint_info.sha256
+    devices.dtype_unet = sd_model.model.diffusion_model.dtype
+    devices.unet_needs_upcast = shared.cmd_opts.upcast_sampling and devices.dtype == torch.float16 and devices.dtype_unet == torch.float16
+    caching.invalidate("model")
+
+    if sd_model.used_config != previous_config:
+        sd_hijack.model_hijack.embedding_db.load_textual_inversion_embeddings(force_reload=True)
+
+    # the VAE selected for the checkpoint may have changed while the model was parked
+    sd_vae.reload_vae_weights(sd_model)
+    script_callbacks.model_loaded_callback(sd_model)
+
+    print(f"Switched to model kept on device: {checkpoint_info.title}")
+
+
+def trim_hot_models():
+    """drops the least used parked models when there are more than sd_checkpoints_hot allows"""
+    limit = shared.opts.sd_checkpoints_hot - 1 if hot_models_enabled() else 0
+    if len(hot_models) <= limit:
+        return
+
+    while len(hot_models) > limit:
+        sd_model = hot_models[least_valuable_checkpoint([model.sd_checkpoint_info for model in hot_models.values()]).filename]
+        unpark_model(sd_model)
+        del sd_model
+
+    gc.collect()
+    devices.torch_gc()
+
+
+def switch_hot_model(checkpoint_info):
+    """
+    Makes checkpoint_info the current checkpoint and keeps the current model on the device. If no model of
+    checkpoint_info is kept there and there is no room for another one, the least used model is reused for it:
+    either the current one, whose weights are replaced in place, or a parked one.
+    """
+    current = shared.sd_model
+    sd_model = hot_models.get(checkpoint_info.filename)
+
+    if sd_model is None and len(hot_models) + 1 >= shared.opts.sd_checkpoints_hot:
+        candidates = [current.sd_checkpoint_info] + [model.sd_checkpoint_info for model in hot_models.values()]
+        least_valuable = least_valuable_checkpoint(candidates)
+        if least_valuable.filename == current.sd_model_checkpoint:
+            return replace_model_weights(current, checkpoint_info)
+
+        sd_model = hot_models[least_valuable.filename]
+        park_model(current)
+        sd_vae.base_vae, sd_vae.checkpoint_info, sd_vae.loaded_vae_file = unpark_model(sd_model)
+        shared.sd_model = sd_model
+        return replace_model_weights(sd_model, checkpoint_info)
+
+    park_model(current)
+
+    if sd_model is not None:
+        activate_hot_model(sd_model)
+        return sd_model
+
+    shared.sd_model = None
+    model_residency.manager.make_room(devices.device, model_residency.module_size(current))
+
+    try:
+        load_model(checkpoint_info)
+    except Exception:
+        print("Failed to load checkpoint, restoring previous")
+        activate_hot_model(current)
+        raise
+
+    return shared.sd_model
+
+
 def reload_model_weights(sd_model=None, info=None):
-    from app.ml.modules import lowvram, devices, sd_hijack
     checkpoint_info = info or select_checkpoint()
 
     if not sd_model:
         sd_model = shared.sd_model
 
+    if sd_model is not None and sd_model.sd_model_checkpoint == checkpoint_info.filename:
+        return
+
+    with metrics.checkpoint_switch.time(tier=checkpoint_tier(checkpoint_info)):
+        if sd_model is not None and sd_model is shared.sd_model and hot_models_enabled():
+            sd_model = switch_hot_model(checkpoint_info)
+        else:
+            sd_model = replace_model_weights(sd_model, checkpoint_info)
+
+        trim_hot_models()
+
+    update_tier_metrics()
+
+    return sd_model
+
+
+def replace_model_weights(sd_model, checkpoint_info):
+    """loads checkpoint_info into sd_model, or creates a new model if sd_model is None or has a different config"""
+    from app.ml.modules import lowvram, devices, sd_hijack
+
     if sd_model is None:  # previous model load failed
         current_checkpoint_info = None
     else:
         current_checkpoint_info = sd_model.sd_checkpoint_info
-        if sd_model.sd_model_checkpoint == checkpoint_info.filename:
-            return
 
         if shared.cmd_opts.lowvram or shared.cmd_opts.medvram:
             lowvram.send_everything_to_cpu()
-        else:
+        elif checkpoint_info not in checkpoints_loaded and not use_mmap(checkpoint_info.filename):
+            # weights read whole may be put on the device; make room for them
             sd_model.to(devices.cpu)
 
         sd_hijack.model_hijack.undo_hijack(sd_model)
@@ -494,8 +856,7 @@ def reload_model_weights(sd_model=None, info=None):
 
     if sd_model is None or checkpoint_config != sd_model.used_config:
         del sd_model
-        checkpoints_loaded.clear()
-        load_model(checkpoint_info, already_loaded_state_dict=state_dict, time_taken_to_load_state_dict=timer.records["load weights from disk"])
+        load_model(checkpoint_info, already_loaded_state_dict=state_dict, time_taken_to_load_state_dict=timer.records.get("load weights from disk", 0))
         return shared.sd_model
 
     try:
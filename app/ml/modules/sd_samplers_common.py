@@ -1,8 +1,9 @@
+import time
 from collections import namedtuple
 import numpy as np
 import torch
 from PIL import Image
-from app.ml.modules import devices, processing, images, sd_vae_approx
+from app.ml.modules import devices, processing, images, sd_vae_approx, metrics, profiling
 
 from app.ml.modules.shared import opts, state
 import app.ml.modules.shared as shared
@@ -10,6 +11,29 @@ import app.ml.modules.shared as shared
 SamplerData = namedtuple('SamplerData', ['name', 'constructor', 'aliases', 'options'])
 
 
+def start_step_timing(sampler):
+    sampler.step_started = time.perf_counter()
+    sampler.step_number = 0
+    sampler.step_marker = profiling.Marker()
+    sampler.step_marker.start("sampling step 0")
+
+
+def record_step_time(sampler):
+    """observes the time since the previous step, or since sampling started, as the duration of one step"""
+
+    now = time.perf_counter()
+    name = sampler.config.name if sampler.config is not None else type(sampler).__name__
+    metrics.sampling_step.observe(now - sampler.step_started, sampler=name)
+    sampler.step_started = now
+
+    sampler.step_number += 1
+    sampler.step_marker.start(f"sampling step {sampler.step_number}")
+
+
+def finish_step_timing(sampler):
+    sampler.step_marker.stop()
+
+
 def setup_img2img_steps(p, steps=None):
     if opts.img2img_fix_steps or steps is not None:
         requested_steps = (steps or p.steps)
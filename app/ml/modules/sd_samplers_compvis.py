@@ -50,11 +50,14 @@ class VanillaStableDiffusionSampler:
     def launch_sampling(self, steps, func):
         state.sampling_steps = steps
         state.sampling_step = 0
+        sd_samplers_common.start_step_timing(self)
 
         try:
             return func()
         except sd_samplers_common.InterruptedException:
             return self.last_latent
+        finally:
+            sd_samplers_common.finish_step_timing(self)
 
     def p_sample_ddim_hook(self, x_dec, cond, ts, unconditional_conditioning, *args, **kwargs):
         x_dec, ts, cond, unconditional_conditioning = self.before_sample(
@@ -126,6 +129,7 @@ class VanillaStableDiffusionSampler:
         self.step += 1
         state.sampling_step = self.step
         shared.total_tqdm.update()
+        sd_samplers_common.record_step_time(self)
 
     def after_sample(self, x, ts, cond, uncond, res):
         if not self.is_unipc:
@@ -1,4 +1,3 @@
-from collections import deque
 import torch
 import inspect
 import einops
@@ -49,6 +48,39 @@ sampler_extra_params = {
 }
 
 
+class CFGPlan:
+    """
+    Index and weight tensors for one sampling run, made from conds_list once instead of every step: which
+    image every cond row belongs to, for building the UNet input with index_select, and for combining guidance,
+    the cond rows of every image padded to the same count with their weights (0 for padding), so each step
+    combines all AND-sub-conds with one gather and a sum.
+    """
+
+    def __init__(self, conds_list, device):
+        self.conds_list = conds_list
+
+        repeats = torch.tensor([len(conds) for conds in conds_list], device=device)
+        self.repeat_index = torch.repeat_interleave(torch.arange(len(conds_list), device=device), repeats)
+
+        width = max(len(conds) for conds in conds_list)
+        cond_index = [[cond_index for cond_index, _ in conds] + [0] * (width - len(conds)) for conds in conds_list]
+        weights = [[weight for _, weight in conds] + [0.0] * (width - len(conds)) for conds in conds_list]
+
+        self.cond_index = torch.tensor(cond_index, device=device)
+        self.weights = torch.tensor(weights, device=device)
+
+    def repeat(self, x):
+        """x with each image's row repeated once per cond of that image"""
+        return x.index_select(0, self.repeat_index)
+
+    def combine(self, x_out, denoised_uncond, cond_scale):
+        batch_size, width = self.cond_index.shape
+        denoised_cond = x_out.index_select(0, self.cond_index.flatten()).view(batch_size, width, *x_out.shape[1:])
+        weights = (self.weights * cond_scale).to(x_out.dtype).view(batch_size, width, *[1] * (x_out.dim() - 1))
+
+        return denoised_uncond + ((denoised_cond - denoised_uncond.unsqueeze(1)) * weights).sum(dim=1)
+
+
 class CFGDenoiser(torch.nn.Module):
     """
     Classifier free guidance denoiser. A wrapper for stable diffusion model (specifically for unet)
@@ -65,17 +97,19 @@ class CFGDenoiser(torch.nn.Module):
         self.init_latent = None
         self.step = 0
         self.image_cfg_scale = None
+        self.plan = None
+
+    def get_plan(self, conds_list, device):
+        """the CFGPlan for conds_list; prompts do not change during a run, so it is only made again when they do"""
+        if self.plan is None or self.plan.conds_list != conds_list:
+            self.plan = CFGPlan(conds_list, device)
+
+        return self.plan
 
     def combine_denoised(self, x_out, conds_list, uncond, cond_scale):
         denoised_uncond = x_out[-uncond.shape[0]:]
-        denoised = torch.clone(denoised_uncond)
-
-        for i, conds in enumerate(conds_list):
-            for cond_index, weight in conds:
-                denoised[i] += (x_out[cond_index] - denoised_uncond[i]
-                                ) * (weight * cond_scale)
 
-        return denoised
+        return self.get_plan(conds_list, x_out.device).combine(x_out, denoised_uncond, cond_scale)
 
     def combine_denoised_for_edit_model(self, x_out, cond_scale):
         out_cond, out_img_cond, out_uncond = x_out.chunk(3)
@@ -99,22 +133,16 @@ class CFGDenoiser(torch.nn.Module):
                                         ), "AND is not supported for InstructPix2Pix checkpoint (unless using Image CFG scale = 1.0)"
 
         batch_size = len(conds_list)
-        repeats = [len(conds_list[i]) for i in range(batch_size)]
+        plan = self.get_plan(conds_list, x.device)
 
         if not is_edit_model:
-            x_in = torch.cat([torch.stack([x[i] for _ in range(n)])
-                             for i, n in enumerate(repeats)] + [x])
-            sigma_in = torch.cat([torch.stack([sigma[i] for _ in range(n)])
-                                 for i, n in enumerate(repeats)] + [sigma])
-            image_cond_in = torch.cat([torch.stack([image_cond[i] for _ in range(n)])
-                                      for i, n in enumerate(repeats)] + [image_cond])
+            x_in = torch.cat([plan.repeat(x), x])
+            sigma_in = torch.cat([plan.repeat(sigma), sigma])
+            image_cond_in = torch.cat([plan.repeat(image_cond), image_cond])
         else:
-            x_in = torch.cat([torch.stack([x[i] for _ in range(n)])
-                             for i, n in enumerate(repeats)] + [x] + [x])
-            sigma_in = torch.cat([torch.stack([sigma[i] for _ in range(n)])
-                                 for i, n in enumerate(repeats)] + [sigma] + [sigma])
-            image_cond_in = torch.cat([torch.stack([image_cond[i] for _ in range(n)]) for i, n in enumerate(
-                repeats)] + [image_cond] + [torch.zeros_like(self.init_latent)])
+            x_in = torch.cat([plan.repeat(x), x, x])
+            sigma_in = torch.cat([plan.repeat(sigma), sigma, sigma])
+            image_cond_in = torch.cat([plan.repeat(image_cond), image_cond, torch.zeros_like(self.init_latent)])
 
         denoiser_params = CFGDenoiserParams(
             x_in, image_cond_in, sigma_in, state.sampling_step, state.sampling_steps, tensor, uncond)
@@ -185,9 +213,9 @@ class CFGDenoiser(torch.nn.Module):
 
 class TorchHijack:
     def __init__(self, sampler_noises):
-        # Using a deque to efficiently receive the sampler_noises in the same order as the previous index-based
-        # implementation.
-        self.sampler_noises = deque(sampler_noises)
+        # sampler_noises may be a generator that only makes the noise for a step when it is asked for,
+        # so it is consumed in order rather than copied.
+        self.sampler_noises = iter(sampler_noises)
 
     def __getattr__(self, item):
         if item == 'randn_like':
@@ -200,10 +228,9 @@ class TorchHijack:
             "'{}' object has no attribute '{}'".format(type(self).__name__, item))
 
     def randn_like(self, x):
-        if self.sampler_noises:
-            noise = self.sampler_noises.popleft()
-            if noise.shape == x.shape:
-                return noise
+        noise = next(self.sampler_noises, None)
+        if noise is not None and noise.shape == x.shape:
+            return noise
 
         if x.device.type == 'mps':
             return torch.randn_like(x, device=devices.cpu).to(x.device)
@@ -240,15 +267,19 @@ class KDiffusionSampler:
 
         state.sampling_step = step
         shared.total_tqdm.update()
+        sd_samplers_common.record_step_time(self)
 
     def launch_sampling(self, steps, func):
         state.sampling_steps = steps
         state.sampling_step = 0
+        sd_samplers_common.start_step_timing(self)
 
         try:
             return func()
         except sd_samplers_common.InterruptedException:
             return self.last_latent
+        finally:
+            sd_samplers_common.finish_step_timing(self)
 
     def number_of_needed_noises(self, p):
         return p.steps
@@ -257,6 +288,7 @@ class KDiffusionSampler:
         self.model_wrap_cfg.mask = p.mask if hasattr(p, 'mask') else None
         self.model_wrap_cfg.nmask = p.nmask if hasattr(p, 'nmask') else None
         self.model_wrap_cfg.step = 0
+        self.model_wrap_cfg.plan = None
         self.model_wrap_cfg.image_cfg_scale = getattr(p, 'image_cfg_scale', None)
         self.eta = p.eta if p.eta is not None else opts.eta_ancestral
 
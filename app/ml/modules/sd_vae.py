@@ -3,7 +3,7 @@ import safetensors.torch
 import os
 import collections
 from collections import namedtuple
-from app.ml.modules import paths, shared, devices, script_callbacks, sd_models
+from app.ml.modules import paths, shared, devices, script_callbacks, sd_models, metrics, model_residency
 import glob
 from copy import deepcopy
 
@@ -19,17 +19,26 @@ checkpoint_info = None
 
 checkpoints_loaded = collections.OrderedDict()
 
+# prepared VAE modules by file, on the device in devices.dtype_vae, swapped into the model by reference
+resident_vaes = collections.OrderedDict()
+
+
 def get_base_vae(model):
     if base_vae is not None and checkpoint_info == model.sd_checkpoint_info and model:
         return base_vae
     return None
 
 
-def store_base_vae(model):
+def store_base_vae(model, as_module=False):
+    """keeps the checkpoint's own VAE before another one is loaded: the module itself if as_module, otherwise a copy of its weights"""
     global base_vae, checkpoint_info
+    if base_vae is not None and isinstance(base_vae, torch.nn.Module) != as_module:
+        # resident VAEs were turned on or off since the base VAE was stored
+        restore_base_vae(model)
+
     if checkpoint_info != model.sd_checkpoint_info:
         assert not loaded_vae_file, "Trying to store non-base VAE!"
-        base_vae = deepcopy(model.first_stage_model.state_dict())
+        base_vae = model.first_stage_model if as_module else deepcopy(model.first_stage_model.state_dict())
         checkpoint_info = model.sd_checkpoint_info
 
 
@@ -43,11 +52,20 @@ def restore_base_vae(model):
     global loaded_vae_file
     if base_vae is not None and checkpoint_info == model.sd_checkpoint_info:
         print("Restoring base VAE")
-        _load_vae_dict(model, base_vae)
+        if isinstance(base_vae, torch.nn.Module):
+            model.first_stage_model = base_vae.to(devices.device)
+        else:
+            _load_vae_dict(model, base_vae)
         loaded_vae_file = None
     delete_base_vae()
 
 
+def release_resident_vae(model):
+    """puts the model's own VAE back before its weights are replaced, so they don't end up in a resident VAE"""
+    if isinstance(base_vae, torch.nn.Module) and checkpoint_info == getattr(model, "sd_checkpoint_info", None):
+        restore_base_vae(model)
+
+
 def get_filename(filepath):
     return os.path.basename(filepath)
 
@@ -132,22 +150,30 @@ def load_vae(model, vae_file=None, vae_source="from unknown source"):
     cache_enabled = shared.opts.sd_vae_checkpoint_cache > 0
 
     if vae_file:
-        if cache_enabled and vae_file in checkpoints_loaded:
-            # use vae checkpoint cache
-            print(f"Loading VAE weights {vae_source}: cached {get_filename(vae_file)}")
-            store_base_vae(model)
-            _load_vae_dict(model, checkpoints_loaded[vae_file])
+        metrics.model_loads.inc(kind="vae")
+
+        if use_resident_vaes():
+            swap_resident_vae(model, vae_file, vae_source)
         else:
-            assert os.path.isfile(vae_file), f"VAE {vae_source} doesn't exist: {vae_file}"
-            print(f"Loading VAE weights {vae_source}: {vae_file}")
-            store_base_vae(model)
+            if cache_enabled:
+                metrics.record_cache_lookup("vae", vae_file in checkpoints_loaded)
 
-            vae_dict_1 = load_vae_dict(vae_file, map_location=shared.weight_load_location)
-            _load_vae_dict(model, vae_dict_1)
+            if cache_enabled and vae_file in checkpoints_loaded:
+                # use vae checkpoint cache
+                print(f"Loading VAE weights {vae_source}: cached {get_filename(vae_file)}")
+                store_base_vae(model)
+                _load_vae_dict(model, checkpoints_loaded[vae_file])
+            else:
+                assert os.path.isfile(vae_file), f"VAE {vae_source} doesn't exist: {vae_file}"
+                print(f"Loading VAE weights {vae_source}: {vae_file}")
+                store_base_vae(model)
 
-            if cache_enabled:
-                # cache newly loaded vae
-                checkpoints_loaded[vae_file] = vae_dict_1.copy()
+                vae_dict_1 = load_vae_dict(vae_file, map_location=shared.weight_load_location)
+                _load_vae_dict(model, vae_dict_1)
+
+                if cache_enabled:
+                    # cache newly loaded vae
+                    checkpoints_loaded[vae_file] = vae_dict_1.copy()
 
         # clean up cache if limit is reached
         if cache_enabled:
@@ -165,6 +191,77 @@ def load_vae(model, vae_file=None, vae_source="from unknown source"):
 
     loaded_vae_file = vae_file
 
+    trim_resident_vaes(model.first_stage_model)
+
+
+def use_resident_vaes():
+    return shared.opts.sd_vae_resident_memory > 0 and not shared.cmd_opts.lowvram and not shared.cmd_opts.medvram
+
+
+def resident_vae_name(vae_file):
+    return "sd_vae_resident:" + vae_file
+
+
+def inactive_module(get_module):
+    """a getter for model_residency that hides the module while it is the VAE of the model, which is tracked as sd_vae already"""
+
+    def get():
+        module = get_module()
+        return module if module is not getattr(shared.sd_model, "first_stage_model", None) else None
+
+    return get
+
+
+def swap_resident_vae(model, vae_file, vae_source):
+    """makes a resident module with the weights of vae_file the VAE of model, preparing one if there is none yet"""
+    module = resident_vaes.get(vae_file, None)
+    metrics.record_cache_lookup("vae_resident", module is not None)
+
+    store_base_vae(model, as_module=True)
+
+    if module is None:
+        assert os.path.isfile(vae_file), f"VAE {vae_source} doesn't exist: {vae_file}"
+        print(f"Loading VAE weights {vae_source}: {vae_file}")
+
+        vae_dict_1 = load_vae_dict(vae_file, map_location=shared.weight_load_location)
+        model_residency.manager.make_room(devices.device, model_residency.module_size(base_vae))
+
+        # the checkpoint's own VAE is the template, so the new module has the same architecture and hijacks
+        module = deepcopy(base_vae)
+        module.load_state_dict(vae_dict_1)
+        module.to(devices.device, devices.dtype_vae)
+
+        resident_vaes[vae_file] = module
+        model_residency.manager.register(resident_vae_name(vae_file), inactive_module(lambda: resident_vaes.get(vae_file, None)), lambda: devices.device,
+                                         unload=lambda module: drop_resident_vae(vae_file))
+    else:
+        print(f"Switching to resident VAE {vae_source}: {get_filename(vae_file)}")
+        resident_vaes.move_to_end(vae_file)
+
+    model.first_stage_model = module.to(devices.device)
+
+
+def trim_resident_vaes(active=None):
+    """drops least recently used resident VAEs other than active while all of them take more than sd_vae_resident_memory MB"""
+    limit = shared.opts.sd_vae_resident_memory * model_residency.mb if use_resident_vaes() else 0
+    sizes = {vae_file: model_residency.module_size(module) for vae_file, module in resident_vaes.items()}
+    total = sum(sizes.values())
+
+    for vae_file in list(resident_vaes):
+        if total <= limit:
+            break
+
+        if resident_vaes[vae_file] is active:
+            continue
+
+        total -= sizes[vae_file]
+        drop_resident_vae(vae_file)
+
+
+def drop_resident_vae(vae_file):
+    resident_vaes.pop(vae_file, None)
+    model_residency.manager.unregister(resident_vae_name(vae_file))
+
 
 # don't call this from outside
 def _load_vae_dict(model, vae_dict_1):
@@ -199,7 +296,7 @@ def reload_vae_weights(sd_model=None, vae_file=unspecified):
 
     if shared.cmd_opts.lowvram or shared.cmd_opts.medvram:
         lowvram.send_everything_to_cpu()
-    else:
+    elif not use_resident_vaes():
         sd_model.to(devices.cpu)
 
     sd_hijack.model_hijack.undo_hijack(sd_model)
@@ -214,3 +311,7 @@ def reload_vae_weights(sd_model=None, vae_file=unspecified):
 
     print("VAE weights loaded.")
     return sd_model
+
+
+# the checkpoint's own VAE while another one is swapped in; it stays on the device until other models need the room
+model_residency.manager.register("sd_vae_base", inactive_module(lambda: base_vae if isinstance(base_vae, torch.nn.Module) else None), lambda: devices.device)
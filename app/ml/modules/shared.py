@@ -194,8 +194,22 @@ parser.add_argument("--skip-version-check", action='store_true',
                     help="Do not check versions of torch and xformers")
 parser.add_argument("--no-hashing", action='store_true',
                     help="disable sha256 hashing of checkpoints to help loading performance", default=False)
+parser.add_argument("--hashing-workers", type=int,
+                    help="number of threads calculating sha256 of model files in the background", default=2)
 parser.add_argument("--no-download-sd-model", action='store_true',
                     help="don't download SD1.5 model even if no model is found in --ckpt-dir", default=False)
+parser.add_argument("--api-queue-size", type=int,
+                    help="maximum number of API jobs waiting for the GPU worker; further requests are rejected with 429", default=32)
+parser.add_argument("--api-batch-window", type=float,
+                    help="seconds the GPU worker waits for compatible img2img requests to batch together", default=0.05)
+parser.add_argument("--api-max-batch-size", type=int,
+                    help="maximum number of img2img requests run together in one batch; 1 disables batching", default=4)
+parser.add_argument("--api-interrogate-max-images", type=int,
+                    help="maximum number of images in one /interrogate/batch request; larger requests are rejected with 413", default=64)
+parser.add_argument("--api-affinity-limit", type=int,
+                    help="how many times a queued job may be passed over by later jobs for the checkpoint and VAE already loaded; 0 runs jobs in order", default=4)
+parser.add_argument("--gpu-workers", type=str,
+                    help="comma-separated device ids; runs API jobs in one worker process per device, each with its own copy of the model", default="")
 
 
 script_loading.preload_extensions(extensions.extensions_dir, parser)
@@ -486,6 +500,11 @@ options_templates.update(options_section(('system', "System"), {
     "samples_log_stdout": OptionInfo(False, "Always print all generation info to standard output"),
     "multiple_tqdm": OptionInfo(True, "Add a second progress bar to the console that shows progress for an entire job."),
     "print_hypernet_extra": OptionInfo(False, "Print extra hypernetwork information to console."),
+    "model_residency_budget": OptionInfo(0, "MB of device memory models may occupy before least recently used ones are moved to RAM (0 = a fraction of the GPU's memory)"),
+    "model_residency_auto_fraction": OptionInfo(0.75, "Fraction of GPU memory for models when the budget above is 0", gr.Slider, {"minimum": 0.1, "maximum": 1.0, "step": 0.05}),
+    "model_residency_ram_budget": OptionInfo(0, "MB of RAM models off their device may occupy before least recently used ones that can be loaded again are dropped (0 = no limit)"),
+    "profiling_dir": OptionInfo("profiles", "Directory for torch.profiler traces of profiled jobs, relative to the data directory"),
+    "profiling_max_traces": OptionInfo(20, "Profiler traces to keep; older ones are deleted", gr.Slider, {"minimum": 1, "maximum": 200, "step": 1}),
 }))
 
 options_templates.update(options_section(('training', "Training"), {
@@ -505,8 +524,11 @@ options_templates.update(options_section(('training', "Training"), {
 
 options_templates.update(options_section(('sd', "Stable Diffusion"), {
     "sd_model_checkpoint": OptionInfo(None, "Stable Diffusion checkpoint", gr.Dropdown, lambda: {"choices": list_checkpoint_tiles()}, refresh=refresh_checkpoints),
-    "sd_checkpoint_cache": OptionInfo(0, "Checkpoints to cache in RAM", gr.Slider, {"minimum": 0, "maximum": 10, "step": 1}),
-    "sd_vae_checkpoint_cache": OptionInfo(0, "VAE Checkpoints to cache in RAM", gr.Slider, {"minimum": 0, "maximum": 10, "step": 1}),
+    "sd_checkpoint_cache": OptionInfo(0, "Checkpoints to cache in RAM, in the precision the model uses", gr.Slider, {"minimum": 0, "maximum": 10, "step": 1}),
+    "sd_checkpoints_hot": OptionInfo(1, "Checkpoints to keep loaded on the GPU, counting the current one; others are moved to RAM when models need the room. Not used with --lowvram and --medvram", gr.Slider, {"minimum": 1, "maximum": 4, "step": 1}),
+    "sd_checkpoint_mmap": OptionInfo(True, "Load .safetensors checkpoints from a memory-mapped file, one module at a time"),
+    "sd_vae_checkpoint_cache": OptionInfo(0, "VAE Checkpoints to cache in RAM when resident VAEs are off", gr.Slider, {"minimum": 0, "maximum": 10, "step": 1}),
+    "sd_vae_resident_memory": OptionInfo(1024, "MB of GPU memory for VAEs kept ready to be swapped in without loading weights (0 = off). Not used with --lowvram and --medvram"),
     "sd_vae": OptionInfo("Automatic", "SD VAE", gr.Dropdown, lambda: {"choices": shared_items.sd_vae_items()}, refresh=shared_items.refresh_vae_list),
     "sd_vae_as_default": OptionInfo(True, "Ignore selected VAE for stable diffusion checkpoints that have their own .vae.pt next to them"),
     "inpainting_mask_weight": OptionInfo(1.0, "Inpainting conditioning mask strength", gr.Slider, {"minimum": 0.0, "maximum": 1.0, "step": 0.01}),
@@ -519,6 +541,8 @@ options_templates.update(options_section(('sd', "Stable Diffusion"), {
     "enable_batch_seeds": OptionInfo(True, "Make K-diffusion samplers produce same images in a batch as when making a single image"),
     "comma_padding_backtrack": OptionInfo(20, "Increase coherency by padding from the last comma within n tokens when using more than 75 tokens", gr.Slider, {"minimum": 0, "maximum": 74, "step": 1}),
     "CLIP_stop_at_last_layers": OptionInfo(1, "Clip skip", gr.Slider, {"minimum": 1, "maximum": 12, "step": 1}),
+    "text_conditioning_cache_size": OptionInfo(64, "Prompts whose text conditioning is kept in memory across requests", gr.Slider, {"minimum": 0, "maximum": 1024, "step": 1}),
+    "prompt_cache_size": OptionInfo(1024, "Prompts whose parsing and tokenization is kept in memory across requests", gr.Slider, {"minimum": 0, "maximum": 8192, "step": 1}),
     "upcast_attn": OptionInfo(False, "Upcast cross attention layer to float32"),
 }))
 
@@ -536,6 +560,7 @@ options_templates.update(options_section(('interrogate', "Interrogate Options"),
     "interrogate_clip_min_length": OptionInfo(24, "Interrogate: minimum description length (excluding artists, etc..)", gr.Slider, {"minimum": 1, "maximum": 128, "step": 1}),
     "interrogate_clip_max_length": OptionInfo(48, "Interrogate: maximum description length", gr.Slider, {"minimum": 1, "maximum": 256, "step": 1}),
     "interrogate_clip_dict_limit": OptionInfo(1500, "CLIP: maximum number of lines in text file (0 = No limit)"),
+    "interrogate_batch_size": OptionInfo(8, "Interrogate: number of images captioned and encoded together in batch requests", gr.Slider, {"minimum": 1, "maximum": 64, "step": 1}),
     "interrogate_clip_skip_categories": OptionInfo([], "CLIP: skip inquire categories", gr.CheckboxGroup, lambda: {"choices": app.ml.modules.interrogate.category_types()}, refresh=app.ml.modules.interrogate.category_types),
     "interrogate_deepbooru_score_threshold": OptionInfo(0.5, "Interrogate: deepbooru score threshold", gr.Slider, {"minimum": 0, "maximum": 1, "step": 0.01}),
     "deepbooru_sort_alpha": OptionInfo(True, "Interrogate: deepbooru sort alphabetically"),
@@ -593,6 +618,7 @@ options_templates.update(options_section(('sampler-params', "Sampler parameters"
     's_tmin': OptionInfo(0.0, "sigma tmin", gr.Slider, {"minimum": 0.0, "maximum": 1.0, "step": 0.01}),
     's_noise': OptionInfo(1.0, "sigma noise", gr.Slider, {"minimum": 0.0, "maximum": 1.0, "step": 0.01}),
     'eta_noise_seed_delta': OptionInfo(0, "Eta noise seed delta", gr.Number, {"precision": 0}),
+    'randn_source': OptionInfo("Torch", "Random number generator for noise; Torch keeps existing seeds, Philox makes a batch in one call and gives the same images on every device", gr.Radio, {"choices": ["Torch", "Philox"]}),
     'always_discard_next_to_last_sigma': OptionInfo(False, "Always discard next-to-last sigma"),
     'uni_pc_variant': OptionInfo("bh1", "UniPC variant", gr.Radio, {"choices": ["bh1", "bh2", "vary_coeff"]}),
     'uni_pc_skip_type': OptionInfo("time_uniform", "UniPC skip type", gr.Radio, {"choices": ["time_uniform", "time_quadratic", "logSNR"]}),
@@ -606,6 +632,13 @@ options_templates.update(options_section(('postprocessing', "Postprocessing"), {
     'upscaling_max_images_in_cache': OptionInfo(5, "Maximum number of images in upscaling cache", gr.Slider, {"minimum": 0, "maximum": 10, "step": 1}),
 }))
 
+options_templates.update(options_section(('api', "API"), {
+    "api_image_encoding_workers": OptionInfo(2, "Processes used to encode output images for API responses; 0 encodes in a thread of the server process", gr.Slider, {"minimum": 0, "maximum": 16, "step": 1}),
+    "api_png_compress_level": OptionInfo(6, "PNG compression level for API responses; lower is faster, higher is smaller", gr.Slider, {"minimum": 0, "maximum": 9, "step": 1}),
+    "api_webp_method": OptionInfo(4, "WEBP encoding method for API responses; 0 is fastest, 6 is smallest", gr.Slider, {"minimum": 0, "maximum": 6, "step": 1}),
+    "api_lossless_fast": OptionInfo(False, "Lossless-fast mode for API responses: lowest PNG compression level, lossless WEBP with the fastest method"),
+}))
+
 options_templates.update(options_section((None, "Hidden options"), {
     "disabled_extensions": OptionInfo([], "Disable those extensions"),
     "sd_checkpoint_hash": OptionInfo("", "SHA256 hash of the current checkpoint"),
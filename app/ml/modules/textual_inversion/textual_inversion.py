@@ -1,5 +1,6 @@
 import os
 import sys
+import threading
 import traceback
 import inspect
 from collections import namedtuple
@@ -15,9 +16,10 @@ import numpy as np
 from PIL import Image, PngImagePlugin
 from torch.utils.tensorboard import SummaryWriter
 
-from app.ml.modules import shared, devices, sd_hijack, processing, sd_models, images, sd_samplers, sd_hijack_checkpoint
+from app.ml.modules import shared, devices, sd_hijack, processing, sd_models, images, sd_samplers, sd_hijack_checkpoint, caching, file_watcher
 import app.ml.modules.textual_inversion.dataset
 from app.ml.modules.textual_inversion.learn_schedule import LearnRateScheduler
+from app.ml.modules.textual_inversion.token_trie import EmbeddingTrie
 
 from app.ml.modules.textual_inversion.image_embedding import embedding_to_b64, embedding_from_b64, insert_image_data_embed, extract_image_data_embed, caption_image_overlay
 from app.ml.modules.textual_inversion.logging import save_settings_to_file
@@ -88,31 +90,45 @@ class Embedding:
 class DirWithTextualInversionEmbeddings:
     def __init__(self, path):
         self.path = path
-        self.mtime = None
 
-    def has_changed(self):
+    def scan(self):
+        """returns (mtime, size) of every non-empty file under the directory, by path"""
+
+        files = {}
         if not os.path.isdir(self.path):
-            return False
+            return files
 
-        mt = os.path.getmtime(self.path)
-        if self.mtime is None or mt > self.mtime:
-            return True
+        for root, dirs, fns in os.walk(self.path, followlinks=True):
+            for fn in fns:
+                fullfn = os.path.join(root, fn)
 
-    def update(self):
-        if not os.path.isdir(self.path):
-            return
+                try:
+                    st = os.stat(fullfn)
+                except OSError:
+                    continue
 
-        self.mtime = os.path.getmtime(self.path)
+                if st.st_size == 0:
+                    continue
+
+                files[fullfn] = (st.st_mtime_ns, st.st_size)
+
+        return files
 
 
 class EmbeddingDatabase:
     def __init__(self):
-        self.ids_lookup = {}
+        self.token_trie = EmbeddingTrie([])
         self.word_embeddings = {}
         self.skipped_embeddings = {}
         self.expected_shape = -1
         self.embedding_dirs = {}
         self.previously_displayed_embeddings = ()
+        self.generation = 0
+
+        # (mtime, size) and the embedding loaded from it, or None, by file path; replaced as a whole, never modified
+        self.files = None
+        self.lock = threading.Lock()
+        self.watcher = file_watcher.DirectoryWatcher("embeddings watcher", lambda: list(self.embedding_dirs), self.update_from_disk)
 
     def add_embedding_dir(self, path):
         self.embedding_dirs[path] = DirWithTextualInversionEmbeddings(path)
@@ -120,17 +136,26 @@ class EmbeddingDatabase:
     def clear_embedding_dirs(self):
         self.embedding_dirs.clear()
 
-    def register_embedding(self, embedding, model):
-        self.word_embeddings[embedding.name] = embedding
+    def build_token_trie(self, word_embeddings, model):
+        names = list(word_embeddings)
+        ids = model.cond_stage_model.tokenize(names) if names else []
+
+        return EmbeddingTrie(zip(ids, word_embeddings.values()))
 
-        ids = model.cond_stage_model.tokenize([embedding.name])[0]
+    def set_word_embeddings(self, word_embeddings, skipped_embeddings):
+        """tokenizes the names with the current model and swaps in new lookup tables, leaving the old ones as they were for whoever still reads them"""
 
-        first_id = ids[0]
-        if first_id not in self.ids_lookup:
-            self.ids_lookup[first_id] = []
+        token_trie = self.build_token_trie(word_embeddings, shared.sd_model)
 
-        self.ids_lookup[first_id] = sorted(
-            self.ids_lookup[first_id] + [(ids, embedding)], key=lambda x: len(x[0]), reverse=True)
+        self.word_embeddings, self.skipped_embeddings, self.token_trie = word_embeddings, skipped_embeddings, token_trie
+        self.generation += 1
+        caching.invalidate("embeddings")
+
+    def register_embedding(self, embedding, model):
+        with self.lock:
+            word_embeddings = dict(self.word_embeddings)
+            word_embeddings[embedding.name] = embedding
+            self.set_word_embeddings(word_embeddings, self.skipped_embeddings)
 
         return embedding
 
@@ -139,13 +164,15 @@ class EmbeddingDatabase:
         return vec.shape[1]
 
     def load_from_file(self, path, filename):
+        """returns the embedding in the file, or None if the file isn't one"""
+
         name, ext = os.path.splitext(filename)
         ext = ext.upper()
 
         if ext in ['.PNG', '.WEBP', '.JXL', '.AVIF']:
             _, second_ext = os.path.splitext(name)
             if second_ext.upper() == '.PREVIEW':
-                return
+                return None
 
             embed_image = Image.open(path)
             if hasattr(embed_image, 'text') and 'sd-ti-embedding' in embed_image.text:
@@ -159,7 +186,7 @@ class EmbeddingDatabase:
         elif ext in ['.SAFETENSORS']:
             data = safetensors.torch.load_file(path, device="cpu")
         else:
-            return
+            return None
 
         # textual inversion embeddings
         if 'string_to_param' in data:
@@ -189,48 +216,61 @@ class EmbeddingDatabase:
         embedding.shape = vec.shape[-1]
         embedding.filename = path
 
-        if self.expected_shape == -1 or self.expected_shape == embedding.shape:
-            self.register_embedding(embedding, shared.sd_model)
-        else:
-            self.skipped_embeddings[name] = embedding
+        return embedding
 
-    def load_from_dir(self, embdir):
-        if not os.path.isdir(embdir.path):
-            return
+    def scan_files(self):
+        files = {}
+        for embdir in list(self.embedding_dirs.values()):
+            files.update(embdir.scan())
 
-        for root, dirs, fns in os.walk(embdir.path, followlinks=True):
-            for fn in fns:
-                try:
-                    fullfn = os.path.join(root, fn)
+        return files
 
-                    if os.stat(fullfn).st_size == 0:
-                        continue
+    def read_files(self, scanned):
+        """
+        Returns a new version of self.files for the files found by scan_files, loading only those that were added or
+        changed since, or None if nothing was
+        """
 
-                    self.load_from_file(fullfn, fn)
-                except Exception:
-                    print(f"Error loading embedding {fn}:", file=sys.stderr)
-                    print(traceback.format_exc(), file=sys.stderr)
-                    continue
+        known = self.files or {}
+        if self.files is not None and scanned == {path: entry[0] for path, entry in known.items()}:
+            return None
 
-    def load_textual_inversion_embeddings(self, force_reload=False):
-        if not force_reload:
-            need_reload = False
-            for path, embdir in self.embedding_dirs.items():
-                if embdir.has_changed():
-                    need_reload = True
-                    break
+        files = {}
+        for fullfn, signature in scanned.items():
+            entry = known.get(fullfn)
+            if entry is not None and entry[0] == signature:
+                files[fullfn] = entry
+                continue
 
-            if not need_reload:
-                return
+            try:
+                embedding = self.load_from_file(fullfn, os.path.basename(fullfn))
+            except Exception:
+                print(f"Error loading embedding {os.path.basename(fullfn)}:", file=sys.stderr)
+                print(traceback.format_exc(), file=sys.stderr)
+                embedding = None
+
+            files[fullfn] = (signature, embedding)
+
+        return files
+
+    def apply_files(self, files):
+        """makes the embeddings in files the ones in use, sorted into usable and skipped by the current model's shape"""
+
+        word_embeddings = {}
+        skipped_embeddings = {}
 
-        self.ids_lookup.clear()
-        self.word_embeddings.clear()
-        self.skipped_embeddings.clear()
-        self.expected_shape = self.get_expected_shape()
+        for fullfn in sorted(files):
+            embedding = files[fullfn][1]
+            if embedding is None:
+                continue
 
-        for path, embdir in self.embedding_dirs.items():
-            self.load_from_dir(embdir)
-            embdir.update()
+            if self.expected_shape == -1 or self.expected_shape == embedding.shape:
+                word_embeddings[embedding.name] = embedding
+            else:
+                skipped_embeddings[embedding.name] = embedding
+
+        self.files = files
+        self.set_word_embeddings(word_embeddings, skipped_embeddings)
 
         displayed_embeddings = (tuple(self.word_embeddings.keys()),
                                 tuple(self.skipped_embeddings.keys()))
@@ -242,18 +282,57 @@ class EmbeddingDatabase:
                 print(
                     f"Textual inversion embeddings skipped({len(self.skipped_embeddings)}): {', '.join(self.skipped_embeddings.keys())}")
 
-    def find_embedding_at_position(self, tokens, offset):
-        token = tokens[offset]
-        possible_matches = self.ids_lookup.get(token, None)
+    def load_textual_inversion_embeddings(self, force_reload=False):
+        """
+        Loads embeddings from files added or changed since the last time and drops those of files that are gone.
+        force_reload is for a newly loaded model: embeddings already loaded are sorted by its shape and tokenized
+        with it again, without reading their files.
+        """
+
+        with self.lock:
+            if force_reload or self.expected_shape == -1:
+                self.expected_shape = self.get_expected_shape()
+
+            files = self.read_files(self.scan_files()) if self.files is None or not force_reload else None
+            if files is None and not force_reload:
+                return
+
+            self.apply_files(files if files is not None else self.files)
 
-        if possible_matches is None:
-            return None, None
+    def update_from_disk(self):
+        """run by the watcher: reads changed files on its own thread, then swaps the tables in between jobs"""
+
+        from app.ml.modules.call_queue import queue_lock
+
+        if self.files is None or shared.sd_model is None:
+            return
+
+        base = self.files
+        files = self.read_files(self.scan_files())
+        if files is None:
+            return
+
+        with queue_lock, self.lock:
+            if self.files is not base:
+                # another reload got in first; compare against what it left, which reads few files if any
+                files = self.read_files(self.scan_files())
+                if files is None:
+                    return
+
+            self.apply_files(files)
+
+    def start_watcher(self):
+        """starts reloading changed embeddings in the background, once; cheap to call for every job"""
+
+        self.watcher.start()
+
+    def find_embedding_at_position(self, tokens, offset):
+        return self.token_trie.match(tokens, offset)
 
-        for ids, embedding in possible_matches:
-            if tokens[offset:offset + len(ids)] == ids:
-                return embedding, len(ids)
+    def find_embeddings(self, tokens):
+        """the embedding with the longest name starting at each position of tokens and its length, or None, None"""
 
-        return None, None
+        return self.token_trie.match_all(tokens)
 
 
 def create_embedding(name, num_vectors_per_token, overwrite_old, init_text='*'):
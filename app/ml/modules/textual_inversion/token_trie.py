@@ -0,0 +1,39 @@
+class EmbeddingTrie:
+    """
+    Embeddings by the token ids of their names, as nested dicts keyed by token id, with the embedding whose name
+    ends at a node under the key None. Built once whenever the embeddings change and never modified after.
+    """
+
+    def __init__(self, embeddings_with_ids):
+        self.root = {}
+
+        for ids, embedding in embeddings_with_ids:
+            node = self.root
+            for token in ids:
+                node = node.setdefault(token, {})
+
+            # the first of embeddings whose names tokenize the same wins
+            node.setdefault(None, embedding)
+
+    def match(self, tokens, offset):
+        """returns the embedding with the longest name at tokens[offset:] and its length in tokens, or None, None"""
+
+        node = self.root
+        found = None, None
+
+        for position in range(offset, len(tokens)):
+            node = node.get(tokens[position])
+            if node is None:
+                break
+
+            embedding = node.get(None)
+            if embedding is not None:
+                found = embedding, position + 1 - offset
+
+        return found
+
+    def match_all(self, tokens):
+        """match() for every position of tokens, in one pass over them"""
+
+        root = self.root
+        return [self.match(tokens, offset) if token in root else (None, None) for offset, token in enumerate(tokens)]
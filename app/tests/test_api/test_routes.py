@@ -1,12 +1,14 @@
 """Unittest for api"""
 from __future__ import annotations
 
+import base64
 import json
 from typing import Any
 
 from fastapi.testclient import TestClient
 
 from app.main import app
+from app.ml.modules import shared
 
 client = TestClient(app)
 
@@ -36,3 +38,79 @@ def test_clip():
     """
     response = client.post("/api/clip", json=clip_request)
     assert response.status_code == 200
+
+
+def test_img2img_multipart():
+    """
+    It uploads the init images of `img2img_request` as binary files to `/api/img2img/multipart` and
+    checks that a multipart/mixed response comes back
+    """
+    params = {key: value for key, value in img2img_request.items() if key not in ("init_images", "mask")}
+    files = [("init_images", (f"{i}.png", base64.b64decode(image.split(",")[-1]), "image/png"))
+             for i, image in enumerate(img2img_request["init_images"])]
+    response = client.post("/api/img2img/multipart", data={"params": json.dumps(params)}, files=files)
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("multipart/mixed")
+
+
+def test_clip_multipart():
+    """
+    It uploads the image of `clip_request` as a binary file to `/api/clip/multipart`
+    """
+    image = base64.b64decode(clip_request["image"].split(",")[-1])
+    response = client.post("/api/clip/multipart", files={"image": ("image.png", image, "image/png")})
+    assert response.status_code == 200
+
+
+def test_clip_batch():
+    """
+    It sends two images to `/api/clip/batch` and expects one caption per image
+    """
+    response = client.post("/api/clip/batch", json={"images": [clip_request["image"]] * 2})
+    assert response.status_code == 200
+    assert len(response.json()["captions"]) == 2
+
+
+def test_clip_batch_too_large():
+    """
+    It sends one image more than `--api-interrogate-max-images` to `/api/clip/batch` and expects 413
+    """
+    images = [clip_request["image"]] * (shared.cmd_opts.api_interrogate_max_images + 1)
+    response = client.post("/api/clip/batch", json={"images": images})
+    assert response.status_code == 413
+
+
+def test_model_residency():
+    """
+    It checks that `/api/system/models` lists the loaded SD model parts
+    """
+    response = client.get("/api/system/models")
+    assert response.status_code == 200
+    assert any(model["name"] == "sd_unet" or model["name"] == "sd_model" for model in response.json()["models"])
+
+
+def test_metrics():
+    """
+    It checks that `/metrics` serves stage latencies in the Prometheus text format after an img2img request
+    """
+    client.post("/api/img2img", json=img2img_request)
+    response = client.get("/metrics")
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/plain")
+    assert 'sd_stage_duration_seconds_count{stage="sampling"}' in response.text
+
+
+def test_profiling():
+    """
+    It checks that a job armed through `/api/system/profiling` writes a trace when it runs
+    """
+    response = client.post("/api/system/profiling", json={"jobs": 1})
+    assert response.status_code == 200
+    assert response.json()["pending"] >= 1
+
+    client.post("/api/img2img", json=img2img_request)
+
+    response = client.get("/api/system/profiling")
+    assert response.status_code == 200
+    assert response.json()["pending"] == 0
+    assert len(response.json()["traces"]) > 0
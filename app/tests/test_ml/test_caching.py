@@ -0,0 +1,140 @@
+"""Unittest for caches of conditioning and prompt chunks being emptied when the model or embeddings change"""
+from types import SimpleNamespace
+
+import pytest
+import torch
+
+from app.ml.modules import caching, prompt_parser, shared
+from app.ml.modules.sd_hijack import model_hijack
+from app.ml.modules.sd_hijack_clip import FrozenCLIPEmbedderWithCustomWordsBase
+from app.ml.modules.textual_inversion.textual_inversion import EmbeddingDatabase
+
+
+class FakeModel:
+    """Conditions on the text and a version that stands for the weights of the loaded model"""
+
+    sd_model_checkpoint = "fake.ckpt"
+    sd_model_hash = "fake"
+
+    def __init__(self):
+        self.version = 1
+
+    def get_learned_conditioning(self, texts):
+        return [f"{text} v{self.version}" for text in texts]
+
+
+class FakeEmbedder(FrozenCLIPEmbedderWithCustomWordsBase):
+    """Tokenizes words into made-up ids that also depend on a version standing for the loaded model"""
+
+    id_start = 1
+    id_end = 2
+    comma_token = 3
+
+    def __init__(self, hijack):
+        super().__init__(torch.nn.Identity(), hijack)
+        self.version = 1
+
+    def tokenize(self, texts):
+        return [[sum(map(ord, word)) * 10 + self.version for word in text.split()] for text in texts]
+
+
+@pytest.fixture
+def embedding_db(monkeypatch):
+    monkeypatch.setitem(shared.opts.data, "text_conditioning_cache_size", 16)
+    monkeypatch.setitem(shared.opts.data, "prompt_cache_size", 16)
+
+    db = EmbeddingDatabase()
+    monkeypatch.setattr(model_hijack, "embedding_db", db)
+
+    # entries left by other tests have the same fake model and embeddings generation in their keys
+    caching.invalidate("model")
+
+    return db
+
+
+def conditioning(model, prompt="a cat"):
+    return prompt_parser.get_learned_conditioning(model, [prompt], 20)[0][0].cond
+
+
+def test_lru_cache_invalidate():
+    """
+    invalidate() only empties the caches registered for the event, and the least recently used entries go first
+    """
+    cache = caching.LRUCache("test cache", 2, invalidate_on=("model",))
+    cache.put("a", 1)
+    cache.put("b", 2)
+    assert cache.get("a") == 1
+    cache.put("c", 3)
+    assert cache.get("b") is None
+    assert cache.get("a") == 1
+
+    caching.invalidate("embeddings")
+    assert cache.get("a") == 1
+
+    caching.invalidate("model")
+    assert cache.get("a") is None
+    assert len(cache) == 0
+
+    del caching.caches["test cache"]
+
+
+def test_conditioning_not_served_after_model_change(embedding_db):
+    """
+    Conditioning is served from the cache until caching.invalidate("model"), and made again after it
+    """
+    model = FakeModel()
+    assert conditioning(model) == "a cat v1"
+
+    model.version = 2
+    assert conditioning(model) == "a cat v1"
+
+    caching.invalidate("model")
+    assert conditioning(model) == "a cat v2"
+
+
+def test_conditioning_not_served_after_embeddings_change(embedding_db):
+    """
+    New embeddings set with EmbeddingDatabase.set_word_embeddings make the cached conditioning stale
+    """
+    model = FakeModel()
+    assert conditioning(model) == "a cat v1"
+
+    model.version = 2
+    assert conditioning(model) == "a cat v1"
+
+    embedding_db.set_word_embeddings({}, {})
+    assert conditioning(model) == "a cat v2"
+
+
+def test_prompt_chunks_not_served_after_model_change(embedding_db):
+    """
+    Tokenized prompt chunks are served from the cache until caching.invalidate("model"), and made again after it
+    """
+    embedder = FakeEmbedder(SimpleNamespace(embedding_db=embedding_db))
+    batch_chunks, _ = embedder.process_texts(["a cat"])
+    old_tokens = batch_chunks[0][0].tokens
+
+    embedder.version = 2
+    batch_chunks, _ = embedder.process_texts(["a cat"])
+    assert batch_chunks[0][0].tokens == old_tokens
+
+    caching.invalidate("model")
+    batch_chunks, _ = embedder.process_texts(["a cat"])
+    assert batch_chunks[0][0].tokens != old_tokens
+
+
+def test_prompt_chunks_not_served_after_embeddings_change(embedding_db, monkeypatch):
+    """
+    A prompt tokenized before an embedding named in it was added is tokenized again, with the embedding
+    """
+    embedder = FakeEmbedder(SimpleNamespace(embedding_db=embedding_db))
+    monkeypatch.setattr(shared, "sd_model", SimpleNamespace(cond_stage_model=embedder))
+
+    batch_chunks, _ = embedder.process_texts(["a cat"])
+    assert batch_chunks[0][0].fixes == []
+
+    embedding = SimpleNamespace(name="cat", vec=torch.zeros(2, 4))
+    embedding_db.set_word_embeddings({"cat": embedding}, {})
+
+    batch_chunks, _ = embedder.process_texts(["a cat"])
+    assert [fix.embedding for fix in batch_chunks[0][0].fixes] == [embedding]
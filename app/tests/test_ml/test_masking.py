@@ -0,0 +1,109 @@
+"""Unittest for inpainting masks, against the per-pixel code they replaced"""
+import numpy as np
+import pytest
+from PIL import Image, ImageOps
+
+from app.ml.modules import masking
+
+
+def old_get_crop_region(mask, pad=0):
+    h, w = mask.shape
+
+    crop_left = 0
+    for i in range(w):
+        if not (mask[:, i] == 0).all():
+            break
+        crop_left += 1
+
+    crop_right = 0
+    for i in reversed(range(w)):
+        if not (mask[:, i] == 0).all():
+            break
+        crop_right += 1
+
+    crop_top = 0
+    for i in range(h):
+        if not (mask[i] == 0).all():
+            break
+        crop_top += 1
+
+    crop_bottom = 0
+    for i in reversed(range(h)):
+        if not (mask[i] == 0).all():
+            break
+        crop_bottom += 1
+
+    return (
+        int(max(crop_left-pad, 0)),
+        int(max(crop_top-pad, 0)),
+        int(min(w - crop_right + pad, w)),
+        int(min(h - crop_bottom + pad, h))
+    )
+
+
+def old_overlay_masks(mask):
+    np_mask = np.array(mask)
+    np_mask = np.clip((np_mask.astype(np.float32)) * 2, 0, 255).astype(np.uint8)
+    mask_for_overlay = Image.fromarray(np_mask)
+
+    return mask_for_overlay, ImageOps.invert(mask_for_overlay.convert('L'))
+
+
+def old_latent_mask(mask, width, height):
+    latmask = mask.convert('RGB').resize((width, height))
+    latmask = np.moveaxis(np.array(latmask, dtype=np.float32), 2, 0) / 255
+    latmask = latmask[0]
+
+    return np.around(latmask)
+
+
+def make_mask(name):
+    np_mask = np.zeros((48, 64), dtype=np.uint8)
+
+    if name == "edges":
+        np_mask[0, 10:20] = 255
+        np_mask[30:, 63] = 200
+        np_mask[47, 0] = 1
+    elif name == "inside":
+        np_mask[12:30, 20:41] = 255
+        np_mask[15, 45] = 64
+    elif name == "gradient":
+        np_mask[:] = np.arange(64, dtype=np.uint8)[None, :] * 4
+
+    return Image.fromarray(np_mask)
+
+
+masks = ["empty", "edges", "inside", "gradient"]
+
+
+@pytest.mark.parametrize("pad", [0, 4, 100])
+@pytest.mark.parametrize("name", masks)
+def test_get_crop_region(name, pad):
+    """
+    get_crop_region finds the same region as the column and row scans, with and without padding
+    """
+    np_mask = np.array(make_mask(name))
+    assert masking.get_crop_region(np_mask, pad) == old_get_crop_region(np_mask, pad)
+
+
+@pytest.mark.parametrize("name", masks)
+def test_overlay_masks(name):
+    """
+    overlay_masks gives the same overlay mask and inverse as doubling and clipping, then inverting
+    """
+    mask = make_mask(name)
+    overlay, inverse = masking.overlay_masks(mask)
+    old_overlay, old_inverse = old_overlay_masks(mask)
+
+    assert np.array_equal(np.asarray(overlay), np.asarray(old_overlay))
+    assert np.array_equal(np.asarray(inverse), np.asarray(old_inverse))
+
+
+@pytest.mark.parametrize("mode", ["L", "RGB"])
+@pytest.mark.parametrize("name", masks)
+def test_latent_mask(name, mode):
+    """
+    latent_mask rounds the resized mask the same way as resizing its RGB version and rounding the red channel
+    """
+    mask = make_mask(name).convert(mode)
+    assert np.array_equal(masking.latent_mask(mask, 8, 6), old_latent_mask(mask, 8, 6))
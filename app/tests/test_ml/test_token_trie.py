@@ -0,0 +1,70 @@
+"""Unittest for finding textual inversion embeddings in tokenized prompts"""
+import random
+
+import pytest
+
+from app.ml.modules.textual_inversion.token_trie import EmbeddingTrie
+
+
+def old_ids_lookup(embeddings_with_ids):
+    ids_lookup = {}
+
+    for ids, embedding in embeddings_with_ids:
+        first_id = ids[0]
+        if first_id not in ids_lookup:
+            ids_lookup[first_id] = []
+
+        ids_lookup[first_id] = sorted(ids_lookup[first_id] + [(ids, embedding)], key=lambda x: len(x[0]), reverse=True)
+
+    return ids_lookup
+
+
+def old_match(ids_lookup, tokens, offset):
+    for ids, embedding in ids_lookup.get(tokens[offset], ()):
+        if tokens[offset:offset + len(ids)] == ids:
+            return embedding, len(ids)
+
+    return None, None
+
+
+def assert_same_matches(embeddings_with_ids, tokens):
+    trie = EmbeddingTrie(embeddings_with_ids)
+    ids_lookup = old_ids_lookup(embeddings_with_ids)
+    expected = [old_match(ids_lookup, tokens, offset) for offset in range(len(tokens))]
+
+    assert [trie.match(tokens, offset) for offset in range(len(tokens))] == expected
+    assert trie.match_all(tokens) == expected
+
+
+@pytest.mark.parametrize("embeddings_with_ids, tokens", [
+    # names sharing prefixes: the longest one that fits wins, shorter ones are found where it doesn't
+    ([([1], "a"), ([1, 2], "ab"), ([1, 2, 3], "abc")], [1, 2, 3, 1, 2, 4, 1, 5, 1]),
+    # a longer name that only partly fits does not hide a shorter one
+    ([([7, 8, 9, 10], "long"), ([7, 8], "short")], [7, 8, 9, 11, 7, 8, 9, 10]),
+    # names that tokenize the same: the first registered wins
+    ([([4, 5], "first"), ([4, 5], "second"), ([4], "single"), ([4], "single again")], [4, 5, 4, 6, 4]),
+    # no embeddings at all
+    ([], [1, 2, 3]),
+])
+def test_matches_like_ids_lookup(embeddings_with_ids, tokens):
+    """
+    EmbeddingTrie finds the same embedding and length at every position as the longest-first candidate lists
+    """
+    assert_same_matches(embeddings_with_ids, tokens)
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_random_matches_like_ids_lookup(seed):
+    """
+    The same for made-up names with many shared prefixes and duplicates, put into random prompts
+    """
+    rng = random.Random(seed)
+    names = [[rng.randrange(20) for _ in range(rng.randrange(1, 5))] for _ in range(60)]
+    embeddings_with_ids = [(ids, f"embedding-{i}") for i, ids in enumerate(names)]
+
+    tokens = [rng.randrange(20) for _ in range(100)]
+    for _ in range(20):
+        position = rng.randrange(len(tokens))
+        tokens[position:position] = rng.choice(names)
+
+    assert_same_matches(embeddings_with_ids, tokens)
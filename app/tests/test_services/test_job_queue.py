@@ -0,0 +1,225 @@
+"""Unittest for job queue"""
+import threading
+
+import pytest
+from fastapi import HTTPException
+
+from app.api.services.job_queue import JobQueue, NoWorkersError, QueueFullError
+from app.ml.modules.call_queue import queue_lock
+
+
+def test_jobs_run_by_priority():
+    """
+    While the worker is held up, queued jobs are reordered so the highest priority runs first
+    and equal priorities keep their submission order
+    """
+    queue = JobQueue(max_size=8)
+    order = []
+
+    with queue_lock:
+        blocker = queue.submit(lambda: order.append("blocker"), priority=10)
+        low = queue.submit(lambda: order.append("low"), priority=0)
+        high = queue.submit(lambda: order.append("high"), priority=5)
+        low2 = queue.submit(lambda: order.append("low2"), priority=0)
+
+    for job in (blocker, low, high, low2):
+        job.future.result(timeout=10)
+
+    assert order == ["blocker", "high", "low", "low2"]
+
+
+def test_queue_full():
+    """
+    Submitting past max_size raises QueueFullError instead of growing the queue
+    """
+    queue = JobQueue(max_size=1)
+    started = threading.Event()
+    release = threading.Event()
+
+    def wait():
+        started.set()
+        release.wait(10)
+
+    running = queue.submit(wait)
+    started.wait(10)
+    queue.submit(lambda: None)
+
+    with pytest.raises(QueueFullError):
+        queue.submit(lambda: None)
+
+    release.set()
+    running.future.result(timeout=10)
+
+
+def test_cancel_queued_job():
+    """
+    A job cancelled while waiting never runs and its future fails
+    """
+    queue = JobQueue(max_size=8)
+    ran = []
+
+    with queue_lock:
+        queue.submit(lambda: None)
+        job = queue.submit(lambda: ran.append(True))
+        assert queue.cancel(job.id_task)
+
+    with pytest.raises(Exception):
+        job.future.result(timeout=10)
+
+    assert ran == []
+    assert job.status() == "cancelled"
+
+
+def test_compatible_jobs_are_batched():
+    """
+    Jobs sharing a batch_key that are waiting together run as one call with all their payloads,
+    and each caller gets its own result back
+    """
+    queue = JobQueue(max_size=8, batch_window=0, max_batch_size=3)
+    calls = []
+
+    def double(payloads):
+        calls.append(list(payloads))
+        return [payload * 2 for payload in payloads]
+
+    with queue_lock:
+        queue.submit(lambda: None, priority=10)
+        first = queue.submit(double, batch_key="a", payload=1)
+        other = queue.submit(double, batch_key="b", payload=2)
+        second = queue.submit(double, batch_key="a", payload=3)
+
+    assert first.future.result(timeout=10) == 2
+    assert second.future.result(timeout=10) == 6
+    assert other.future.result(timeout=10) == 4
+    assert calls == [[1, 3], [2]]
+
+
+class FakeExecutor:
+    def __init__(self, name, checkpoint):
+        self.name = name
+        self.checkpoint = checkpoint
+
+    def start(self):
+        pass
+
+    def interrupt(self):
+        pass
+
+    def run(self, func, payloads, image_ready_callbacks):
+        return [func(self)]
+
+
+def test_jobs_run_on_every_executor():
+    """
+    With several executors jobs run side by side, and a job asking for a checkpoint goes to the
+    executor that already has it loaded
+    """
+    executors = [FakeExecutor("cuda:0", "a.safetensors"), FakeExecutor("cuda:1", "b.safetensors")]
+    queue = JobQueue(max_size=8, executors=executors)
+    barrier = threading.Barrier(2, timeout=10)
+
+    def wait_for_other(executor):
+        barrier.wait()
+        return executor.name
+
+    first = queue.submit(wait_for_other)
+    second = queue.submit(wait_for_other)
+
+    assert {first.future.result(timeout=10), second.future.result(timeout=10)} == {"cuda:0", "cuda:1"}
+
+    job = queue.submit(lambda executor: executor.name, checkpoint="b.safetensors")
+
+    assert job.future.result(timeout=10) == "cuda:1"
+
+
+def test_jobs_for_loaded_checkpoint_run_first():
+    """
+    A job for the checkpoint the worker has loaded runs before an older job for another checkpoint,
+    which is passed over at most affinity_limit times; switches of checkpoint are counted
+    """
+    executor = FakeExecutor("cuda:0", "a.safetensors")
+    queue = JobQueue(max_size=8, executors=[executor], affinity_limit=1)
+    started = threading.Event()
+    release = threading.Event()
+    order = []
+
+    def block(executor):
+        started.set()
+        release.wait(10)
+
+    def run_on(checkpoint, name):
+        def func(executor):
+            executor.checkpoint = checkpoint
+            order.append(name)
+
+        return func
+
+    queue.submit(block, checkpoint="a.safetensors")
+    started.wait(10)
+
+    jobs = [
+        queue.submit(run_on("b.safetensors", "b1"), checkpoint="b.safetensors"),
+        queue.submit(run_on("a.safetensors", "a1"), checkpoint="a.safetensors"),
+        queue.submit(run_on("a.safetensors", "a2"), checkpoint="a.safetensors"),
+    ]
+    switches = queue.submit(lambda executor: queue.switches_last_hour(), checkpoint="a.safetensors")
+    release.set()
+
+    for job in jobs:
+        job.future.result(timeout=10)
+
+    assert order == ["a1", "b1", "a2"]
+    assert switches.future.result(timeout=10) == 2
+
+
+class CrashingExecutor(FakeExecutor):
+    """Its process dies in every job; it starts again once, then can't be started any more"""
+
+    def __init__(self, name, checkpoint):
+        super().__init__(name, checkpoint)
+        self.starts = 0
+        self.crash = threading.Event()
+
+    def start(self):
+        self.starts += 1
+        if self.starts > 2:
+            raise RuntimeError("worker failed to start")
+
+    def run(self, func, payloads, image_ready_callbacks):
+        self.crash.wait(10)
+        raise RuntimeError("worker exited")
+
+
+def test_dead_executor_is_restarted_then_dropped():
+    """
+    An executor is started again before every job; once it can't be, waiting jobs fail and new ones are
+    refused instead of waiting forever
+    """
+    executor = CrashingExecutor("cuda:0", "a.safetensors")
+    queue = JobQueue(max_size=8, executors=[executor])
+
+    first = queue.submit(lambda executor: None)
+    second = queue.submit(lambda executor: None)
+    executor.crash.set()
+
+    with pytest.raises(RuntimeError):
+        first.future.result(timeout=10)
+    with pytest.raises(HTTPException) as e:
+        second.future.result(timeout=10)
+
+    assert e.value.status_code == 503
+    assert executor.starts == 3
+    with pytest.raises(NoWorkersError):
+        queue.submit(lambda executor: None)
+
+
+def test_jobs_without_model_do_not_switch():
+    """A job that doesn't use the SD model neither counts as a switch nor changes the VAE the worker is known to have"""
+
+    queue = JobQueue(max_size=8, executors=[FakeExecutor("cuda:0", "a.safetensors")])
+
+    queue.submit(lambda executor: None, checkpoint="a.safetensors", vae="b.vae.pt").future.result(timeout=10)
+    queue.submit(lambda executor: None, checkpoint=False).future.result(timeout=10)
+    switches = queue.submit(lambda executor: queue.switches_last_hour(), checkpoint="a.safetensors", vae="b.vae.pt")
+
+    assert switches.future.result(timeout=10) == 0